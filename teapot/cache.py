@@ -0,0 +1,523 @@
+"""
+Response caching
+################
+
+The :class:`~teapot.routing.Router` can keep fully rendered responses of
+selected routables around, so that repeated requests for the same resource do
+not need to run the routable (and, for example, a whole templating pipeline)
+again.
+
+Caching is opt-in per routable, using the :func:`cached` decorator::
+
+    @teapot.cache.cached(ttl=60, vary=("Accept", "Accept-Language"))
+    @teapot.route("/news")
+    def news(self):
+        ...
+
+and requires a :class:`ResponseCache` to be passed to the router::
+
+    router = teapot.routing.Router(
+        root,
+        response_cache=teapot.cache.ResponseCache(
+            teapot.cache.MemoryBackend(max_bytes=32*1024*1024)))
+
+Responses are looked up using a key composed of the routable, the request path,
+the query arguments, the user agent features and the values of the request
+headers listed in the *vary* argument of :func:`cached`. For the ``Accept``
+header, the content type which was negotiated by the router is used instead of
+the raw header value, so that clients with different but equivalent ``Accept``
+headers share cache entries. The user agent features (see
+:class:`~teapot.request.UserAgentFeatures`) are always part of the key, as
+output formats such as :class:`~xsltea.pipeline.XHTMLPipeline` choose between
+different representations based on them.
+
+``HEAD`` requests are answered from the cache if an entry exists, but are
+passed to the routable otherwise, without storing the result; routables may
+skip generating the body for ``HEAD`` requests.
+
+Only ``200 OK`` responses without cookies and with a body consisting of
+:class:`bytes` (or :class:`str`) chunks are cached. While a response is being
+generated, other threads requesting the same key wait for the result instead
+of generating it again.
+
+.. autofunction:: cached
+
+.. autofunction:: getcacheinfo
+
+.. autoclass:: ResponseCache
+   :members:
+
+.. autoclass:: CachedResponse
+   :members:
+
+Backends
+========
+
+.. autoclass:: Backend
+   :members:
+
+.. autoclass:: MemoryBackend
+
+.. autoclass:: SQLiteBackend
+
+"""
+
+import abc
+import collections
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+
+import teapot.request
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "cached",
+    "ResponseCache",
+    "MemoryBackend",
+    "SQLiteBackend"]
+
+cacheinfo_attr = "__net_zombofant_teapot_cacheinfo__"
+
+class CacheInfo:
+    """
+    Per-routable caching information, as attached by :func:`cached`.
+    """
+
+    def __init__(self, ttl, vary):
+        self.ttl = ttl
+        self.vary = tuple(vary)
+
+def cached(ttl, vary=("Accept",)):
+    """
+    Mark a routable as cacheable. Responses are kept for *ttl* seconds. *vary*
+    is an iterable of request header names whose values distinguish different
+    representations of the resource; they are also announced to the client in
+    a ``Vary`` header.
+
+    The decorator can be applied before or after :func:`~teapot.routing.route`.
+    """
+
+    if ttl <= 0:
+        raise ValueError("ttl must be positive")
+
+    def decorator(obj):
+        setattr(obj, cacheinfo_attr, CacheInfo(ttl, vary))
+        return obj
+
+    return decorator
+
+def getcacheinfo(obj):
+    """
+    Return the :class:`CacheInfo` of *obj*, or :data:`None` if *obj* has not
+    been marked as cacheable.
+    """
+    return getattr(obj, cacheinfo_attr, None)
+
+class CachedResponse:
+    """
+    A snapshot of a response, suitable for storing in a :class:`Backend`. All
+    attributes are plain data, so that instances can be pickled.
+    """
+
+    def __init__(self,
+                 response_code,
+                 response_message,
+                 content_type,
+                 last_modified,
+                 headers,
+                 body,
+                 expires):
+        self.response_code = response_code
+        self.response_message = response_message
+        self.content_type = content_type
+        self.last_modified = last_modified
+        self.headers = tuple(headers)
+        self.body = body
+        self.expires = expires
+
+    @classmethod
+    def from_response(cls, response, body, expires):
+        return cls(response.http_response_code,
+                   response.http_response_message,
+                   response.content_type,
+                   response.last_modified,
+                   response.custom_headers,
+                   body,
+                   expires)
+
+    @property
+    def size(self):
+        """
+        Approximate number of bytes occupied by this entry.
+        """
+        return len(self.body) + sum(
+            len(key) + len(value)
+            for key, value in self.headers)
+
+    def is_expired(self, now=None):
+        return (now or time.time()) >= self.expires
+
+    def to_response(self):
+        """
+        Create a new :class:`~teapot.response.Response` instance which carries
+        the cached body.
+        """
+        import teapot.response
+
+        response = teapot.response.Response(
+            self.content_type,
+            body=self.body,
+            response_code=self.response_code,
+            response_message=self.response_message,
+            last_modified=self.last_modified)
+        response.custom_headers.extend(self.headers)
+        return response
+
+class Backend(metaclass=abc.ABCMeta):
+    """
+    Storage for :class:`CachedResponse` objects. Keys are strings.
+    """
+
+    @abc.abstractmethod
+    def get(self, key):
+        """
+        Return the :class:`CachedResponse` stored for *key* or :data:`None`, if
+        there is none or it has expired.
+        """
+
+    @abc.abstractmethod
+    def put(self, key, entry):
+        """
+        Store the :class:`CachedResponse` *entry* for *key*, evicting other
+        entries if neccessary.
+        """
+
+    @abc.abstractmethod
+    def discard(self, key):
+        """
+        Remove the entry for *key*, if any.
+        """
+
+    @abc.abstractmethod
+    def clear(self):
+        """
+        Remove all entries.
+        """
+
+class MemoryBackend(Backend):
+    """
+    An in-process backend which keeps at most *max_bytes* bytes of responses
+    around. If that budget is exceeded, the least recently used entries are
+    evicted. Entries larger than the budget are not stored at all.
+    """
+
+    def __init__(self, max_bytes=16*1024*1024):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._size -= entry.size
+
+    def get(self, key):
+        with self._lock:
+            try:
+                entry = self._entries[key]
+            except KeyError:
+                return None
+            if entry.is_expired():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        size = entry.size
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._size += size
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def discard(self, key):
+        with self._lock:
+            try:
+                self._remove(key)
+            except KeyError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    @property
+    def size(self):
+        """
+        Number of bytes currently in use.
+        """
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+class SQLiteBackend(Backend):
+    """
+    A backend which stores the responses in the SQLite database at *path*. This
+    allows to share the cache between several worker processes on the same
+    host. The same *max_bytes* budget semantics as for :class:`MemoryBackend`
+    apply, with the least recently used entries being evicted first.
+
+    Each thread uses its own database connection.
+    """
+
+    def __init__(self, path, max_bytes=64*1024*1024, timeout=5.0):
+        super().__init__()
+        self.path = path
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS teapot_responses ("
+                "key TEXT PRIMARY KEY, "
+                "expires REAL NOT NULL, "
+                "atime REAL NOT NULL, "
+                "size INTEGER NOT NULL, "
+                "data BLOB NOT NULL)")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS teapot_responses_atime "
+                "ON teapot_responses (atime)")
+
+    def _connection(self):
+        try:
+            return self._local.connection
+        except AttributeError:
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            self._local.connection = conn
+            return conn
+
+    def get(self, key):
+        now = time.time()
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT expires, data FROM teapot_responses WHERE key = ?",
+                (key,)).fetchone()
+            if row is None:
+                return None
+            expires, data = row
+            if expires <= now:
+                conn.execute(
+                    "DELETE FROM teapot_responses WHERE key = ?",
+                    (key,))
+                return None
+            conn.execute(
+                "UPDATE teapot_responses SET atime = ? WHERE key = ?",
+                (now, key))
+        return pickle.loads(data)
+
+    def put(self, key, entry):
+        size = entry.size
+        if size > self.max_bytes:
+            return
+        data = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO teapot_responses "
+                "(key, expires, atime, size, data) VALUES (?, ?, ?, ?, ?)",
+                (key, entry.expires, time.time(), size,
+                 sqlite3.Binary(data)))
+            total, = conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM teapot_responses"
+            ).fetchone()
+            if total <= self.max_bytes:
+                return
+            victims = []
+            for victim, victim_size in conn.execute(
+                    "SELECT key, size FROM teapot_responses "
+                    "ORDER BY atime ASC"):
+                if total <= self.max_bytes:
+                    break
+                victims.append((victim,))
+                total -= victim_size
+            conn.executemany(
+                "DELETE FROM teapot_responses WHERE key = ?",
+                victims)
+
+    def discard(self, key):
+        with self._connection() as conn:
+            conn.execute(
+                "DELETE FROM teapot_responses WHERE key = ?",
+                (key,))
+
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM teapot_responses")
+
+class ResponseCache:
+    """
+    Cache full responses of routables marked with :func:`cached` in the given
+    *backend*. Instances are passed to :class:`~teapot.routing.Router` as
+    *response_cache* argument.
+
+    .. attribute:: hits
+
+       Number of requests which were served from the cache.
+
+    .. attribute:: misses
+
+       Number of requests for which the routable had to be called.
+    """
+
+    def __init__(self, backend):
+        super().__init__()
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+        self._inflight_lock = threading.Lock()
+        self._inflight = {}
+
+    @staticmethod
+    def _vary_value(request, header):
+        if header.lower() == "accept":
+            return str(request.accepted_content_type)
+        return request.raw_http_headers.get(header)
+
+    def get_key(self, request, routable, cacheinfo):
+        """
+        Return the cache key for the given *request* to *routable*.
+        """
+        route = "{}.{}".format(
+            getattr(routable, "__module__", ""),
+            getattr(routable, "__qualname__", repr(routable)))
+        query = sorted(
+            (key, tuple(values))
+            for key, values in request.query_data.items())
+        vary = tuple(
+            self._vary_value(request, header)
+            for header in cacheinfo.vary)
+        features = sorted(request.user_agent_info.features)
+        return repr((route, request.path, query, vary, features))
+
+    def _acquire_inflight(self, key):
+        with self._inflight_lock:
+            try:
+                lock, refs = self._inflight[key]
+            except KeyError:
+                lock, refs = threading.Lock(), 0
+            self._inflight[key] = lock, refs+1
+        lock.acquire()
+
+    def _release_inflight(self, key):
+        with self._inflight_lock:
+            lock, refs = self._inflight[key]
+            if refs == 1:
+                del self._inflight[key]
+            else:
+                self._inflight[key] = lock, refs-1
+        lock.release()
+
+    @staticmethod
+    def _add_vary_header(response, cacheinfo):
+        if cacheinfo.vary and not any(
+                key.lower() == "vary"
+                for key, _ in response.custom_headers):
+            response.custom_headers.append(
+                ("Vary", ", ".join(cacheinfo.vary)))
+
+    @staticmethod
+    def _collect(result):
+        """
+        Convert the *result* of a routable into a tuple ``(response, body)``,
+        where *body* is a list of body chunks.
+        """
+        if hasattr(result, "__iter__"):
+            result = iter(result)
+            response = next(result)
+            if response.body is None:
+                body = list(result)
+            else:
+                if hasattr(result, "close"):
+                    result.close()
+                body = [response.body]
+        else:
+            response = result
+            body = [] if response.body is None else [response.body]
+        return response, body
+
+    @staticmethod
+    def _is_cacheable(response, body):
+        if response.http_response_code != 200 or response.cookies:
+            return False
+        if not all(isinstance(chunk, bytes) for chunk in body) and \
+           not (len(body) == 1 and isinstance(body[0], str)):
+            return False
+        return True
+
+    def _lookup(self, key):
+        entry = self.backend.get(key)
+        if entry is None:
+            return None
+        with self._stats_lock:
+            self.hits += 1
+        response = entry.to_response()
+        return [response]
+
+    def get_result(self, request, routable, callable, cacheinfo):
+        """
+        Return the result for the *request*, which has been routed to the
+        *callable* of *routable*, either from the cache or by calling
+        *callable*. The result follows the return-by-generator-with-body
+        protocol.
+        """
+        key = self.get_key(request, routable, cacheinfo)
+        result = self._lookup(key)
+        if result is not None:
+            return result
+
+        if request.method == teapot.request.Method.HEAD:
+            # the routable may omit the body, which must not end up in the
+            # cache
+            return callable()
+
+        self._acquire_inflight(key)
+        try:
+            # another thread may have finished the same response while we were
+            # waiting
+            result = self._lookup(key)
+            if result is not None:
+                return result
+
+            with self._stats_lock:
+                self.misses += 1
+            response, body = self._collect(callable())
+            self._add_vary_header(response, cacheinfo)
+            if self._is_cacheable(response, body):
+                if body and isinstance(body[0], str):
+                    body = body[0]
+                else:
+                    body = b"".join(body)
+                self.backend.put(
+                    key,
+                    CachedResponse.from_response(
+                        response,
+                        body,
+                        time.time() + cacheinfo.ttl))
+                response.body = body
+            elif response.body is None:
+                return [response] + body
+            return [response]
+        finally:
+            self._release_inflight(key)
@@ -7,8 +7,21 @@ Throwable error responses
 .. autoclass:: ResponseError
    :members:
 
+Prebuilt error responses
+========================
+
+Common error responses are built once at import time, including their encoded
+body and serialised headers. Obtaining one of them does not involve any
+formatting or encoding.
+
+.. autofunction:: prebuilt_response_error
+
+.. autoclass:: PrebuiltResponseError
+
 """
 
+import copy
+
 import teapot.response
 import teapot.mime
 
@@ -45,3 +58,58 @@ def make_response_error(response_code, plain_message, **kwargs):
                          **kwargs)
 
 make_error_response = make_response_error
+
+class PrebuiltResponseError(ResponseError):
+    """
+    An immutable ``text/plain`` :class:`ResponseError` with the given
+    *response_code*. The body is the *plain_message*, which defaults to the
+    status message of the code, and is encoded as UTF-8 once upon
+    construction. Responses with code ``304`` have no body.
+
+    Attempting to modify any attribute raises :class:`AttributeError`. Use
+    :func:`copy.copy` (as :func:`prebuilt_response_error` does) to obtain an
+    instance which can be raised independently; copies share the body and the
+    serialised headers.
+    """
+
+    def __init__(self, response_code, plain_message=None):
+        if response_code == 304:
+            content_type, body = None, None
+        else:
+            content_type = teapot.mime.Type.text_plain.with_charset("utf-8")
+            body = (plain_message or
+                    teapot.response.lookup_response_message(response_code))
+            body = body.encode("utf-8")
+        super().__init__(response_code, content_type, body)
+        if body is not None:
+            self.custom_headers.append(("Content-Length", str(len(body))))
+        self.get_header_tuples()
+        self._custom_headers = tuple(self._custom_headers)
+        self.cookies = {}
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if self.__dict__.get("_frozen", False):
+            raise AttributeError("{} is immutable".format(
+                type(self).__qualname__))
+        super().__setattr__(name, value)
+
+    def __copy__(self):
+        result = type(self).__new__(type(self))
+        result.__dict__.update(self.__dict__)
+        Exception.__init__(result, *self.args)
+        return result
+
+_prebuilt_response_errors = {
+    code: PrebuiltResponseError(code)
+    for code in (304, 403, 404, 500)
+}
+
+def prebuilt_response_error(response_code):
+    """
+    Return a :class:`PrebuiltResponseError` for the given *response_code*,
+    which can be raised or returned like any other :class:`ResponseError`.
+    Prebuilt responses exist for the codes ``304``, ``403``, ``404`` and
+    ``500``; for other codes, :class:`KeyError` is raised.
+    """
+    return copy.copy(_prebuilt_response_errors[response_code])
@@ -67,6 +67,7 @@ class Type:
                 pass
         else:
             self.__parameters["charset"] = charset
+        self.__str = None
 
     def __copy__(self):
         return Type(self.__type, self.__subtype,
@@ -96,11 +97,14 @@ class Type:
         return self.__parameters[key]
 
     def __str__(self):
+        if self.__str is not None:
+            return self.__str
         base = "{}/{}".format(self.__type, self.__subtype)
         if self.__parameters:
             base += "; " + "; ".join(
                 "{!s}={!s}".format(k, v)
                 for k, v in self.__parameters.items())
+        self.__str = base
         return base
 
     def __repr__(self):
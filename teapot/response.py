@@ -10,6 +10,8 @@ neccessary information to create a suitable response for the client.
 
 .. autofunction:: make_redirect_response
 
+.. autodata:: FLUSH
+
 .. autofunction:: lookup_response_message
 
 .. automodule:: teapot.mime
@@ -29,11 +31,42 @@ from datetime import datetime, timedelta
 
 import teapot.accept
 import teapot.timeutils
+import teapot.utils
 import teapot.routing
 import teapot.routing.info
 
 logger = logging.getLogger(__name__)
 
+class _HeaderList(teapot.utils.InstrumentedList):
+    """
+    A list of header tuples which calls *on_change* whenever it is modified.
+    """
+
+    def __init__(self, on_change, sequence=None):
+        self._on_change = on_change
+        super().__init__(sequence)
+
+    def _acquire_item(self, item):
+        self._on_change()
+
+    def _release_item(self, item):
+        self._on_change()
+
+    def reverse(self):
+        super().reverse()
+        self._on_change()
+
+class _FlushMarker:
+    def __repr__(self):
+        return "teapot.response.FLUSH"
+
+#: Marker object which can be yielded as part of a response body sequence in
+#: the return-by-generator protocol. It asks the server interface to pass all
+#: body data produced so far to the client, instead of waiting for more data to
+#: coalesce it into larger chunks. Server interfaces which do not buffer the
+#: body must drop the marker.
+FLUSH = _FlushMarker()
+
 def lookup_response_message(response_code, default="Unknown Status"):
     """
     Look up the status code message as defined in RFC 2616 using the given
@@ -104,6 +137,11 @@ class Response:
 
     *last_modified* may be a :class:`datetime.datetime` object representing the
     timestamp of last modification of the response.
+
+    The serialised headers are cached between calls to
+    :meth:`get_header_tuples`. Assigning to :attr:`content_type` or
+    :attr:`last_modified` or modifying :attr:`custom_headers` invalidates the
+    cache. ``Set-Cookie`` headers are always generated from :attr:`cookies`.
     """
 
     charset_preferences = [
@@ -141,6 +179,7 @@ class Response:
                  response_message=None,
                  last_modified=None):
         super().__init__()
+        self._header_cache = None
         self.http_response_code = response_code
         self.http_response_message = response_message or \
                                      lookup_response_message(response_code)
@@ -158,20 +197,65 @@ class Response:
                         "this.")
             self.body = self.body.encode(self.content_type.charset)
 
+    def _invalidate_headers(self):
+        self._header_cache = None
+
+    @property
+    def content_type(self):
+        return self._content_type
+
+    @content_type.setter
+    def content_type(self, value):
+        self._content_type = value
+        self._header_cache = None
+
+    @property
+    def last_modified(self):
+        return self._last_modified
+
+    @last_modified.setter
+    def last_modified(self, value):
+        self._last_modified = value
+        self._header_cache = None
+
+    @property
+    def custom_headers(self):
+        """
+        A list of additional ``(header, value)`` tuples.
+        """
+        return self._custom_headers
+
+    @custom_headers.setter
+    def custom_headers(self, value):
+        self._custom_headers = _HeaderList(self._invalidate_headers, value)
+        self._header_cache = None
+
+    def _serialise_headers(self):
+        headers = []
+        if self.content_type:
+            headers.append(("Content-Type", str(self.content_type)))
+        if self.last_modified:
+            headers.append(
+                ("Last-Modified",
+                 teapot.timeutils.format_http_date(self.last_modified)))
+        headers.extend(self.custom_headers)
+        return tuple(headers)
+
     def get_header_tuples(self):
         """
         Return an iterable af tuples which provide key-value pairs the HTTP
         headers for this response.
         """
 
-        if self.content_type:
-            yield ("Content-Type", str(self.content_type))
-        if self.last_modified:
-            yield ("Last-Modified",
-                   teapot.timeutils.format_http_date(self.last_modified))
-        for v in self.cookies.values():
-            yield ("Set-Cookie", v.output(header="").lstrip())
-        yield from self.custom_headers
+        headers = self._header_cache
+        if headers is None:
+            headers = self._serialise_headers()
+            self._header_cache = headers
+        if self.cookies:
+            headers += tuple(
+                ("Set-Cookie", v.output(header="").lstrip())
+                for v in self.cookies.values())
+        return headers
 
     def negotiate_charset(self, preference_list, strict=False):
         """
@@ -85,7 +85,8 @@ If it is a **sequence**, the sequence must match one of the following patterns:
 
 1. the empty sequence
 2. one or more :class:`bytes` instances or other objects which support the
-   buffer protocol (they can be mixed)
+   buffer protocol (they can be mixed), optionally interleaved with
+   :data:`teapot.response.FLUSH` markers
 3. exactly one file-like, whose contents resemble the response body
 
 The gateway implementation **may** interpret :data:`None` (or the empty
@@ -259,6 +260,7 @@ import re
 import string
 import sys
 
+import teapot.cache
 import teapot.errors
 import teapot.mime
 import teapot.request
@@ -787,24 +789,51 @@ class Router:
     :meth:`~teapot.response.Response.negotiate_charset` method is called with
     the :attr:`~teapot.request.Request.accept_charset` preference list from
     the request.
+
+    If *response_cache* is not :data:`None`, it must be a
+    :class:`~teapot.cache.ResponseCache` instance, which is used to serve
+    requests to routables which have been marked with
+    :func:`~teapot.cache.cached`.
     """
 
-    def __init__(self, root=None):
+    def __init__(self, root=None, response_cache=None):
         if root is None:
             self._owns_root = True
             self._root = teapot.routing.info.CustomGroup([])
         else:
             self._owns_root = False
             self._root = getrouteinfo(root)
+        self.response_cache = response_cache
+
+    def call_routable(self, request, destination):
+        """
+        Call the routable which has been selected by routing the *request*
+        (*destination*) and return its result.
+
+        If a response cache is set up and the routable is cacheable, ``GET``
+        requests are served through the cache. ``HEAD`` requests are answered
+        from existing cache entries, but their results are not stored.
+        """
+        if self.response_cache is not None and \
+           request.method in (teapot.request.Method.GET,
+                              teapot.request.Method.HEAD):
+            cacheinfo = teapot.cache.getcacheinfo(destination.routable)
+            if cacheinfo is not None:
+                return self.response_cache.get_result(
+                    request,
+                    destination.routable,
+                    destination,
+                    cacheinfo)
+        return destination()
 
     def handle_not_found(self, request):
         """
         Handle a failure while routing the *request*.
 
-        By default, this raises a ``404 Not Found`` error.
+        By default, this raises a prebuilt ``404 Not Found`` error.
         """
-        raise teapot.errors.make_response_error(
-            404, "cannot find resource {!r}".format(request.path))
+        logger.debug("cannot find resource %r", request.path)
+        raise teapot.errors.prebuilt_response_error(404)
 
     def handle_charset_negotiation_failure(self, request, response):
         """
@@ -820,10 +849,9 @@ class Router:
         """
         Handle an internal server error.
 
-        By default, this raises an ``500 Internal Server Error`` error.
+        By default, this raises a prebuilt ``500 Internal Server Error`` error.
         """
-        raise teapot.errors.make_response_error(
-            500, "Internal Server Error")
+        raise teapot.errors.prebuilt_response_error(500)
 
     def post_response_cleanup(self, request):
         """
@@ -856,7 +884,7 @@ class Router:
            request.if_modified_since is not None:
             if abs((response.last_modified -
                     request.if_modified_since).total_seconds()) < 1:
-                raise teapot.errors.ResponseError(304, None, None)
+                raise teapot.errors.prebuilt_response_error(304)
         return response
 
     def wrap_result(self, request, result):
@@ -872,6 +900,11 @@ class Router:
         :class:`~teapot.routing.Response` object containing all metadata of the
         request and afterwards yields zero or more :class:`bytes` instances
         which form the body of the response.
+
+        For ``HEAD`` requests, only the response object is yielded. Generators
+        returned by the routable are closed right after they produced the
+        response object. If the body is known at that point, a
+        ``Content-Length`` header is added.
         """
         if hasattr(result, "__iter__"):
             # data was a generator or pretends to be one. the only thing we need
@@ -903,6 +936,19 @@ class Router:
                 result.close()
             raise
 
+        if request.method == teapot.request.Method.HEAD:
+            # the client is only interested in the headers; do not let the
+            # routable generate a body we would throw away anyways
+            if hasattr(result, "close"):
+                result.close()
+            if isinstance(response.body, (bytes, bytearray)) and not any(
+                    key.lower() == "content-length"
+                    for key, _ in response.custom_headers):
+                response.custom_headers.append(
+                    ("Content-Length", str(len(response.body))))
+            yield response
+            return
+
         # function does not want to return any data by itself
         # we wrap the response headers and everything else into the generator
         # format
@@ -941,7 +987,7 @@ class Router:
                     raise data
 
                 request.current_routable = data.routable
-                result = data()
+                result = self.call_routable(request, data)
             except teapot.errors.ResponseError:
                 # re-raise
                 raise
@@ -0,0 +1,171 @@
+"""
+Server-Sent Events
+##################
+
+Routables can hold a response open and push events to the client using the
+`Server-Sent Events <https://html.spec.whatwg.org/multipage/server-sent-events.html>`_
+protocol (``text/event-stream``). :func:`event_stream` implements the
+return-by-generator protocol, so a routable can simply return its result::
+
+    @teapot.route("/status/events")
+    def status_events(self):
+        return teapot.sse.event_stream(
+            teapot.sse.queue_source(self.status_queue, timeout=15))
+
+Each event is followed by a :data:`teapot.response.FLUSH` marker, so that it is
+passed to the client immediately instead of being buffered by
+:class:`teapot.wsgi.Application`.
+
+.. autofunction:: event_stream
+
+.. autofunction:: queue_source
+
+.. autoclass:: Event
+   :members:
+
+.. autodata:: CLOSE
+
+"""
+
+import logging
+import queue
+import re
+import time
+
+import teapot.mime
+import teapot.response
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "Event",
+    "event_stream",
+    "queue_source",
+    "CLOSE"]
+
+#: Put this object into a queue consumed by :func:`queue_source` to end the
+#: event stream.
+CLOSE = object()
+
+event_stream_type = teapot.mime.Type("text", "event-stream", charset="utf-8")
+
+_line_break_re = re.compile("\r\n|\r|\n")
+
+class Event:
+    """
+    A single event. *data* is the payload, which is converted to a string. It
+    may span multiple lines. The optional *event* is the event type, *id* the
+    event ID which the client reports back in the ``Last-Event-ID`` header when
+    reconnecting and *retry* the reconnection delay in milliseconds.
+    """
+
+    def __init__(self, data, event=None, id=None, retry=None):
+        self.data = data
+        self.event = event
+        self.id = id
+        self.retry = retry
+
+    @staticmethod
+    def _check_field(name, value):
+        value = str(value)
+        if "\r" in value or "\n" in value:
+            raise ValueError("{} of an event must not contain line breaks:"
+                             " {!r}".format(name, value))
+        return value
+
+    def encode(self):
+        """
+        Return the event as framed, UTF-8 encoded :class:`bytes`.
+
+        The data is split into one ``data`` field per line, treating
+        ``"\\r\\n"``, ``"\\r"`` and ``"\\n"`` as line breaks. Raises
+        :class:`ValueError` if the event type or the ID contain a line break.
+        """
+        lines = []
+        if self.event is not None:
+            lines.append("event: {}".format(
+                self._check_field("event", self.event)))
+        if self.id is not None:
+            lines.append("id: {}".format(
+                self._check_field("id", self.id)))
+        if self.retry is not None:
+            lines.append("retry: {:d}".format(self.retry))
+        lines.extend(
+            "data: {}".format(line)
+            for line in _line_break_re.split(str(self.data)))
+        return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+def event_stream(source, heartbeat=15.0, retry=None, response=None):
+    """
+    Generate a ``text/event-stream`` response from the iterable *source*,
+    following the return-by-generator protocol.
+
+    *source* yields either :class:`Event` instances or plain payloads, which
+    are wrapped in an :class:`Event`. To allow heartbeats to be sent, *source*
+    may yield :data:`None` whenever it has been idle for a while (see
+    :func:`queue_source`); if no data has been sent for *heartbeat* seconds at
+    that point, a comment line is sent to keep intermediate proxies from
+    dropping the connection.
+
+    *retry* sets the reconnection delay of the client in milliseconds. A custom
+    *response* object may be passed, otherwise a ``200 OK`` response with
+    suitable headers is created.
+
+    When the client disconnects, the server interface closes the generator,
+    which in turn closes *source*, if it has a ``close`` method.
+    """
+
+    if response is None:
+        response = teapot.response.Response(event_stream_type)
+        response.custom_headers.extend([
+            ("Cache-Control", "no-cache"),
+            ("X-Accel-Buffering", "no"),
+        ])
+
+    try:
+        yield response
+
+        # send something right away, so that the server interface passes the
+        # headers to the client
+        if retry is not None:
+            yield "retry: {:d}\n\n".format(retry).encode("ascii")
+        else:
+            yield b":\n\n"
+        yield teapot.response.FLUSH
+
+        last_write = time.monotonic()
+        for item in source:
+            now = time.monotonic()
+            if item is None:
+                if heartbeat is not None and now - last_write >= heartbeat:
+                    yield b":\n\n"
+                    yield teapot.response.FLUSH
+                    last_write = now
+                continue
+
+            if not isinstance(item, Event):
+                item = Event(item)
+            yield item.encode()
+            yield teapot.response.FLUSH
+            last_write = now
+    finally:
+        if hasattr(source, "close"):
+            source.close()
+
+def queue_source(queue_obj, timeout=15.0):
+    """
+    Yield items from the :class:`queue.Queue` *queue_obj* as a source for
+    :func:`event_stream`. If no item arrives within *timeout* seconds,
+    :data:`None` is yielded so that heartbeats can be sent. The source ends
+    when :data:`CLOSE` is taken from the queue.
+    """
+
+    while True:
+        try:
+            item = queue_obj.get(timeout=timeout)
+        except queue.Empty:
+            yield None
+            continue
+        if item is CLOSE:
+            return
+        yield item
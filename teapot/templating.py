@@ -97,6 +97,28 @@ class Source:
         Must be implemented by subclasses.
         """
 
+    def get_mtime(self, name):
+        """
+        Return the modification timestamp of the template with the given
+        *name*, which is used to detect changes of templates which have been
+        loaded before.
+
+        If the template cannot be found, :class:`FileNotFoundError` should be
+        raised. The default implementation returns :data:`None`, indicating
+        that the source cannot provide timestamps.
+        """
+        return None
+
+    def iter_names(self):
+        """
+        Iterate over the names of all templates which can be opened from this
+        source. This is used to find the templates to precompile.
+
+        The default implementation yields nothing, for sources which cannot
+        enumerate their templates.
+        """
+        return iter(())
+
 class FileSystemSource(Source):
     def __init__(self, search_path, **kwargs):
         super().__init__(**kwargs)
@@ -115,3 +137,24 @@ class FileSystemSource(Source):
         return open(os.path.join(self._search_path, name),
                     "rb" if binary else "r",
                     encoding=encoding)
+
+    def get_mtime(self, name):
+        """
+        Return the modification time of the file with the given *name* in the
+        search path, as reported by :func:`os.stat`.
+        """
+        return os.stat(os.path.join(self._search_path, name)).st_mtime_ns
+
+    def iter_names(self):
+        """
+        Yield the names of all files below the search path, relative to the
+        search path and using ``/`` as separator.
+        """
+        for dirpath, dirnames, filenames in os.walk(self._search_path):
+            dirnames.sort()
+            relpath = os.path.relpath(dirpath, self._search_path)
+            for filename in sorted(filenames):
+                if relpath == os.curdir:
+                    yield filename
+                else:
+                    yield "/".join(relpath.split(os.sep) + [filename])
@@ -0,0 +1,213 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import teapot
+import teapot.cache
+import teapot.mime
+import teapot.request
+import teapot.response
+import teapot.routing
+
+class TestMemoryBackend(unittest.TestCase):
+    def _entry(self, body, ttl=60):
+        return teapot.cache.CachedResponse(
+            200, "OK", teapot.mime.Type.text_plain, None, [], body,
+            time.time() + ttl)
+
+    def test_get_put(self):
+        backend = teapot.cache.MemoryBackend()
+        self.assertIsNone(backend.get("foo"))
+        backend.put("foo", self._entry(b"foo"))
+        self.assertEqual(backend.get("foo").body, b"foo")
+
+    def test_expiry(self):
+        backend = teapot.cache.MemoryBackend()
+        backend.put("foo", self._entry(b"foo", ttl=-1))
+        self.assertIsNone(backend.get("foo"))
+        self.assertEqual(len(backend), 0)
+
+    def test_lru_byte_budget(self):
+        backend = teapot.cache.MemoryBackend(max_bytes=10)
+        backend.put("a", self._entry(b"aaaa"))
+        backend.put("b", self._entry(b"bbbb"))
+        # touch a, so that b is the least recently used entry
+        backend.get("a")
+        backend.put("c", self._entry(b"cccc"))
+        self.assertIsNone(backend.get("b"))
+        self.assertIsNotNone(backend.get("a"))
+        self.assertIsNotNone(backend.get("c"))
+        self.assertEqual(backend.size, 8)
+
+    def test_oversized_entry(self):
+        backend = teapot.cache.MemoryBackend(max_bytes=2)
+        backend.put("a", self._entry(b"aaaa"))
+        self.assertIsNone(backend.get("a"))
+
+class TestSQLiteBackend(TestMemoryBackend):
+    def setUp(self):
+        fd, self._path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self._path)
+
+    def test_get_put(self):
+        backend = teapot.cache.SQLiteBackend(self._path)
+        self.assertIsNone(backend.get("foo"))
+        backend.put("foo", self._entry(b"foo"))
+        entry = teapot.cache.SQLiteBackend(self._path).get("foo")
+        self.assertEqual(entry.body, b"foo")
+        self.assertEqual(entry.content_type, teapot.mime.Type.text_plain)
+
+    def test_expiry(self):
+        backend = teapot.cache.SQLiteBackend(self._path)
+        backend.put("foo", self._entry(b"foo", ttl=-1))
+        self.assertIsNone(backend.get("foo"))
+
+    def test_lru_byte_budget(self):
+        backend = teapot.cache.SQLiteBackend(self._path, max_bytes=10)
+        backend.put("a", self._entry(b"aaaa"))
+        time.sleep(0.01)
+        backend.put("b", self._entry(b"bbbb"))
+        time.sleep(0.01)
+        backend.get("a")
+        time.sleep(0.01)
+        backend.put("c", self._entry(b"cccc"))
+        self.assertIsNone(backend.get("b"))
+        self.assertIsNotNone(backend.get("a"))
+        self.assertIsNotNone(backend.get("c"))
+
+    def test_oversized_entry(self):
+        backend = teapot.cache.SQLiteBackend(self._path, max_bytes=2)
+        backend.put("a", self._entry(b"aaaa"))
+        self.assertIsNone(backend.get("a"))
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self._calls = 0
+        self._cache = teapot.cache.ResponseCache(
+            teapot.cache.MemoryBackend())
+        self._router = teapot.routing.Router(response_cache=self._cache)
+
+        @teapot.cache.cached(ttl=60, vary=("Accept", "Accept-Language"))
+        @self._router.route("/", "/other")
+        def index():
+            self._calls += 1
+            response = teapot.response.Response(
+                teapot.mime.Type.text_plain.with_charset("utf8"))
+            yield response
+            yield b"foo"
+            yield b"bar"
+
+        @self._router.route("/uncached")
+        def uncached():
+            self._calls += 1
+            return teapot.response.Response(
+                teapot.mime.Type.text_plain.with_charset("utf8"),
+                body=b"baz")
+
+    def _request(self, path="/", query_data=None, headers={}, **kwargs):
+        request = teapot.request.Request(
+            local_path=path,
+            query_data=query_data,
+            raw_http_headers=teapot.mime.CaseFoldedDict(headers),
+            **kwargs)
+        return list(self._router.route_request(request))
+
+    def test_hit(self):
+        response, *body = self._request()
+        self.assertEqual(b"".join(body), b"foobar")
+        self.assertIn(("Vary", "Accept, Accept-Language"),
+                      response.custom_headers)
+        response, *body = self._request()
+        self.assertEqual(b"".join(body), b"foobar")
+        self.assertEqual(
+            teapot.mime.Type.text_plain.with_charset("utf8"),
+            response.content_type)
+        self.assertEqual(
+            1,
+            [key.lower() for key, _ in response.custom_headers].count("vary"))
+        self.assertEqual(self._calls, 1)
+        self.assertEqual(self._cache.hits, 1)
+        self.assertEqual(self._cache.misses, 1)
+
+    def test_key_components(self):
+        self._request()
+        self._request(path="/other")
+        self._request(query_data={"foo": ["bar"]})
+        self._request(headers={"Accept-Language": "de"})
+        self.assertEqual(self._calls, 4)
+        self._request(headers={"Accept-Language": "de"})
+        self._request(query_data={"foo": ["bar"]})
+        self.assertEqual(self._calls, 4)
+
+    def test_uncached_routable(self):
+        self._request(path="/uncached")
+        self._request(path="/uncached")
+        self.assertEqual(self._calls, 2)
+
+    def test_post_bypasses_cache(self):
+        self._request(method=teapot.request.Method.POST)
+        self._request(method=teapot.request.Method.POST)
+        self.assertEqual(self._calls, 2)
+
+    def test_head_then_get(self):
+        @teapot.cache.cached(ttl=60)
+        @self._router.route("/head")
+        def head_aware(*, request: teapot.request.Request):
+            self._calls += 1
+            yield teapot.response.Response(
+                teapot.mime.Type.text_plain.with_charset("utf8"))
+            if request.method != teapot.request.Method.HEAD:
+                yield b"body"
+
+        response, *body = self._request(path="/head",
+                                        method=teapot.request.Method.HEAD)
+        self.assertEqual(b"".join(body), b"")
+        self.assertEqual(self._cache.misses, 0)
+
+        response, *body = self._request(path="/head")
+        self.assertEqual(b"".join(body), b"body")
+        # HEAD requests are served from existing entries
+        response, *body = self._request(path="/head",
+                                        method=teapot.request.Method.HEAD)
+        self.assertEqual(self._calls, 2)
+        self.assertEqual(self._cache.hits, 1)
+
+    def test_user_agent_features(self):
+        self._request(user_agent="Firefox/6.0")
+        self._request(user_agent="Firefox/8.0")
+        self.assertEqual(self._calls, 2)
+        self._request(user_agent="Firefox/8.0")
+        self.assertEqual(self._calls, 2)
+
+    def test_single_flight(self):
+        cache = teapot.cache.ResponseCache(teapot.cache.MemoryBackend())
+        router = teapot.routing.Router(response_cache=cache)
+        calls = []
+
+        @teapot.cache.cached(ttl=60)
+        @router.route("/")
+        def slow():
+            calls.append(None)
+            time.sleep(0.05)
+            return teapot.response.Response(
+                teapot.mime.Type.text_plain.with_charset("utf8"),
+                body=b"slow")
+
+        results = []
+        def worker():
+            results.append(list(router.route_request(
+                teapot.request.Request(local_path="/")))[1])
+
+        threads = [threading.Thread(target=worker) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertSequenceEqual(results, [b"slow"]*4)
@@ -0,0 +1,44 @@
+import unittest
+
+import teapot.errors
+import teapot.mime
+
+class TestPrebuiltResponseError(unittest.TestCase):
+    def test_not_found(self):
+        error = teapot.errors.prebuilt_response_error(404)
+        self.assertIsInstance(error, teapot.errors.ResponseError)
+        self.assertEqual(error.http_response_code, 404)
+        self.assertEqual(error.body, b"Not Found")
+        self.assertSequenceEqual(
+            list(error.get_header_tuples()),
+            [
+                ("Content-Type", "text/plain; charset=utf-8"),
+                ("Content-Length", "9"),
+            ])
+        self.assertEqual(str(error), "404 Not Found")
+
+    def test_not_modified(self):
+        error = teapot.errors.prebuilt_response_error(304)
+        self.assertIsNone(error.body)
+        self.assertSequenceEqual(list(error.get_header_tuples()), [])
+
+    def test_copies_share_state(self):
+        error1 = teapot.errors.prebuilt_response_error(500)
+        error2 = teapot.errors.prebuilt_response_error(500)
+        self.assertIsNot(error1, error2)
+        self.assertIs(error1.body, error2.body)
+        self.assertIs(error1.get_header_tuples(),
+                      error2.get_header_tuples())
+
+    def test_immutable(self):
+        error = teapot.errors.prebuilt_response_error(403)
+        with self.assertRaises(AttributeError):
+            error.body = b"foo"
+        with self.assertRaises(AttributeError):
+            error.content_type = teapot.mime.Type.text_html
+        with self.assertRaises(AttributeError):
+            error.custom_headers.append(("X-Foo", "bar"))
+
+    def test_unknown_code(self):
+        with self.assertRaises(KeyError):
+            teapot.errors.prebuilt_response_error(418)
@@ -76,3 +76,28 @@ class TestResponse(unittest.TestCase):
                 ("Set-Cookie", "foo=bar; Path=/; secure"),
                 ("Set-Cookie", "bar=baz; httponly")
             })
+
+    def test_header_cache_invalidation(self):
+        response = teapot.response.Response(teapot.mime.Type.text_plain)
+        self.assertSequenceEqual(
+            list(response.get_header_tuples()),
+            [("Content-Type", "text/plain")])
+
+        response.content_type = teapot.mime.Type.text_html
+        response.custom_headers.append(("X-Foo", "bar"))
+        self.assertSequenceEqual(
+            list(response.get_header_tuples()),
+            [("Content-Type", "text/html"),
+             ("X-Foo", "bar")])
+
+        del response.custom_headers[0]
+        response.custom_headers = [("X-Bar", "baz")]
+        self.assertSequenceEqual(
+            list(response.get_header_tuples()),
+            [("Content-Type", "text/html"),
+             ("X-Bar", "baz")])
+
+        response.cookies["foo"] = "bar"
+        self.assertIn(
+            ("Set-Cookie", "foo=bar"),
+            list(response.get_header_tuples()))
@@ -800,6 +800,47 @@ class TestRouter(unittest.TestCase):
             response.content_type)
         self.assertEqual(result[0], b"foo")
 
+    def test_head_closes_generator(self):
+        router = teapot.routing.Router()
+        closed = []
+
+        @router.route("/")
+        def foo():
+            try:
+                yield teapot.response.Response(
+                    teapot.mime.Type.text_plain.with_charset("utf8"))
+                self.fail("body generated for HEAD request")
+            finally:
+                closed.append(True)
+
+        request = teapot.request.Request(
+            method=teapot.request.Method.HEAD,
+            local_path="/")
+        result = list(router.route_request(request))
+        self.assertEqual(len(result), 1)
+        self.assertSequenceEqual(closed, [True])
+        self.assertNotIn(
+            "Content-Length",
+            [key for key, _ in result[0].get_header_tuples()])
+
+    def test_head_content_length(self):
+        router = teapot.routing.Router()
+
+        @router.route("/")
+        def foo():
+            return teapot.response.Response(
+                teapot.mime.Type.text_plain.with_charset("utf8"),
+                body=b"foobar")
+
+        request = teapot.request.Request(
+            method=teapot.request.Method.HEAD,
+            local_path="/")
+        result = list(router.route_request(request))
+        self.assertEqual(len(result), 1)
+        self.assertIn(
+            ("Content-Length", "6"),
+            list(result[0].get_header_tuples()))
+
     def tearDown(self):
         del self._root
         del self._now
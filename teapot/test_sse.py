@@ -0,0 +1,108 @@
+import queue
+import unittest
+
+import teapot.request
+import teapot.response
+import teapot.routing
+import teapot.sse
+import teapot.wsgi
+
+class TestEvent(unittest.TestCase):
+    def test_encode(self):
+        self.assertEqual(
+            teapot.sse.Event("foo\nbar", event="update", id=3).encode(),
+            b"event: update\nid: 3\ndata: foo\ndata: bar\n\n")
+
+    def test_encode_line_breaks(self):
+        self.assertEqual(
+            teapot.sse.Event("a\r\nb\rc\nd").encode(),
+            b"data: a\ndata: b\ndata: c\ndata: d\n\n")
+
+    def test_reject_line_breaks_in_fields(self):
+        for kwargs in [{"event": "a\nid: 1"}, {"event": "a\r"},
+                       {"id": "1\r\nevent: x"}]:
+            with self.assertRaises(ValueError):
+                teapot.sse.Event("foo", **kwargs).encode()
+
+    def test_retry(self):
+        self.assertEqual(
+            teapot.sse.Event("", retry=1000).encode(),
+            b"retry: 1000\ndata: \n\n")
+
+class TestEventStream(unittest.TestCase):
+    def test_events_are_flushed(self):
+        result = list(teapot.sse.event_stream(["a", "b"]))
+        response = result.pop(0)
+        self.assertEqual(response.content_type,
+                         teapot.sse.event_stream_type)
+        self.assertIn(("Cache-Control", "no-cache"),
+                      response.custom_headers)
+        self.assertSequenceEqual(
+            result,
+            [
+                b":\n\n", teapot.response.FLUSH,
+                b"data: a\n\n", teapot.response.FLUSH,
+                b"data: b\n\n", teapot.response.FLUSH,
+            ])
+
+    def test_heartbeat(self):
+        result = list(teapot.sse.event_stream([None, None], heartbeat=0))
+        self.assertSequenceEqual(
+            result[1:],
+            [b":\n\n", teapot.response.FLUSH]*3)
+
+    def test_no_heartbeat_when_busy(self):
+        result = list(teapot.sse.event_stream([None], heartbeat=3600))
+        self.assertSequenceEqual(
+            result[1:],
+            [b":\n\n", teapot.response.FLUSH])
+
+    def test_close_closes_source(self):
+        closed = []
+        def source():
+            try:
+                while True:
+                    yield "x"
+            finally:
+                closed.append(True)
+
+        stream = teapot.sse.event_stream(source())
+        for i in range(4):
+            next(stream)
+        stream.close()
+        self.assertSequenceEqual(closed, [True])
+
+    def test_queue_source(self):
+        q = queue.Queue()
+        q.put("foo")
+        q.put(teapot.sse.CLOSE)
+        self.assertSequenceEqual(
+            list(teapot.sse.queue_source(q, timeout=0)),
+            ["foo"])
+
+        source = teapot.sse.queue_source(queue.Queue(), timeout=0)
+        self.assertIsNone(next(source))
+
+    def test_through_wsgi(self):
+        router = teapot.routing.Router()
+
+        @router.route("/")
+        def events():
+            return teapot.sse.event_stream(["a", "b"])
+
+        app = teapot.wsgi.Application(router)
+        headers = []
+        body = app(
+            {
+                "REQUEST_METHOD": "GET",
+                "PATH_INFO": "/",
+                "wsgi.url_scheme": "http",
+                "wsgi.input": None,
+                "SCRIPT_NAME": "",
+            },
+            lambda status, hdrs: headers.extend(hdrs))
+        self.assertIn(("Content-Type", "text/event-stream; charset=utf-8"),
+                      headers)
+        self.assertSequenceEqual(
+            list(body),
+            [b":\n\n", b"data: a\n\n", b"data: b\n\n"])
@@ -0,0 +1,75 @@
+import unittest
+
+import teapot.mime
+import teapot.request
+import teapot.response
+import teapot.routing
+import teapot.wsgi
+
+class TestApplication(unittest.TestCase):
+    def setUp(self):
+        self._status = None
+        self._headers = None
+
+    def _start_response(self, status, headers):
+        self._status = status
+        self._headers = headers
+
+    def _generate(self, chunks, buffer_size=16, method="GET", body=None):
+        app = teapot.wsgi.Application(
+            teapot.routing.Router(),
+            buffer_size=buffer_size)
+        response = teapot.response.Response(teapot.mime.Type.text_plain,
+                                            body=body)
+        body = app._generate_response(
+            self._start_response,
+            {"REQUEST_METHOD": method},
+            response,
+            iter(chunks))
+        return list(body)
+
+    def test_content_length_for_complete_body(self):
+        body = self._generate([b"foo", b"bar", b"baz"])
+        self.assertSequenceEqual(body, [b"foobarbaz"])
+        self.assertIn(("Content-Length", "9"), self._headers)
+
+    def test_content_length_for_large_response_body(self):
+        data = b"0123456789"*4
+        for buffer_size in [16, None]:
+            body = self._generate([data], buffer_size=buffer_size, body=data)
+            self.assertSequenceEqual(body, [data])
+            self.assertIn(("Content-Length", "40"), self._headers)
+
+    def test_empty_body(self):
+        body = self._generate([])
+        self.assertSequenceEqual(body, [])
+        self.assertIn(("Content-Length", "0"), self._headers)
+
+    def test_coalescing(self):
+        body = self._generate([b"0123456789"]*4)
+        self.assertSequenceEqual(
+            body,
+            [b"0123456789"*2]*2)
+        self.assertNotIn(
+            "Content-Length",
+            [key for key, _ in self._headers])
+
+    def test_flush(self):
+        body = self._generate([b"foo", teapot.response.FLUSH,
+                               b"bar", teapot.response.FLUSH,
+                               teapot.response.FLUSH,
+                               b"baz"])
+        self.assertSequenceEqual(body, [b"foo", b"bar", b"baz"])
+        self.assertNotIn(
+            "Content-Length",
+            [key for key, _ in self._headers])
+
+    def test_unbuffered(self):
+        body = self._generate([b"foo", teapot.response.FLUSH, b"bar"],
+                              buffer_size=None)
+        self.assertSequenceEqual(body, [b"foo", b"bar"])
+
+    def test_head(self):
+        body = self._generate([b"foo"], method="HEAD")
+        self.assertSequenceEqual(body, [])
+        self.assertEqual(self._status, "200 OK")
@@ -15,6 +15,7 @@ import logging
 import urllib.parse
 
 import teapot.request
+import teapot.response
 import teapot.errors
 import teapot.accept
 import teapot.routing
@@ -31,15 +32,27 @@ class Application:
 
     If *force_slash_root* is set to :data:`True`, requests pointing to empty
     string (``b""``) will be rewritten to ``b"/"``.
+
+    Body chunks produced by the router are coalesced until at least
+    *buffer_size* bytes are available, before they are handed to the server. A
+    :data:`teapot.response.FLUSH` marker in the body sequence passes the
+    buffered data to the server immediately. If the whole body fits into the
+    buffer, a ``Content-Length`` header is added to the response. If
+    *buffer_size* is :data:`None` or zero, chunks are passed on unmodified.
+
+    Responses whose complete body is set as :class:`bytes` on the response
+    object always get a ``Content-Length`` header, regardless of their size.
     """
 
     def __init__(self,
                  router,
                  force_slash_root=True,
-                 script_name_prefix=None):
+                 script_name_prefix=None,
+                 buffer_size=8192):
         self._router = router
         self._force_slash_root = force_slash_root
         self._script_name_prefix = script_name_prefix or ""
+        self._buffer_size = buffer_size
 
     def decode_string(self, s):
         if isinstance(s, str):
@@ -95,8 +108,7 @@ class Application:
 
     def handle_exception(self, exc):
         logger.exception(exc)
-        raise teapot.errors.make_response_error(
-            500, teapot.response.lookup_response_message(500))
+        raise teapot.errors.prebuilt_response_error(500)
 
     def handle_path_decoding_error(self, path):
         """
@@ -136,16 +148,67 @@ class Application:
                 yield data
                 data = f.read(block_size)
 
+    @staticmethod
+    def _may_have_content_length(response_obj):
+        code = response_obj.http_response_code
+        if code < 200 or code in (204, 304):
+            return False
+        return not any(key.lower() == "content-length"
+                       for key, _ in response_obj.custom_headers)
+
+    @staticmethod
+    def _coalesce(result_iter, buffer_size):
+        buffered = []
+        size = 0
+        for chunk in result_iter:
+            if chunk is teapot.response.FLUSH:
+                if buffered:
+                    yield b"".join(buffered)
+                    buffered.clear()
+                    size = 0
+                continue
+            buffered.append(chunk)
+            size += len(chunk)
+            if size >= buffer_size:
+                yield b"".join(buffered)
+                buffered.clear()
+                size = 0
+
+        if buffered:
+            yield b"".join(buffered)
+
     def _generate_response(self, start_response, environ,
                            response_obj, result_iter):
-        self._start_response(start_response, response_obj)
+        if environ.get("REQUEST_METHOD") == teapot.request.Method.HEAD:
+            logger.debug("HEAD request, discarding body")
+            self._start_response(start_response, response_obj)
+            if hasattr(result_iter, "close"):
+                result_iter.close()
+            return []
+
         try:
             first_object = next(result_iter)
         except StopIteration:
             logger.debug("empty sequence response")
+            if self._may_have_content_length(response_obj):
+                response_obj.custom_headers.append(("Content-Length", "0"))
+            self._start_response(start_response, response_obj)
             return []
 
+        if (isinstance(response_obj.body, (bytes, bytearray)) and
+                first_object is response_obj.body):
+            # the router passed on the complete body of the response
+            logger.debug("complete response with %d bytes", len(first_object))
+            if hasattr(result_iter, "close"):
+                result_iter.close()
+            if self._may_have_content_length(response_obj):
+                response_obj.custom_headers.append(
+                    ("Content-Length", str(len(first_object))))
+            self._start_response(start_response, response_obj)
+            return [first_object]
+
         if hasattr(first_object, "read"):
+            self._start_response(start_response, response_obj)
             try:
                 file_wrapper = environ["wsgi.file_wrapper"]
             except KeyError:
@@ -154,9 +217,48 @@ class Application:
             else:
                 logger.debug("wrapped file")
                 return file_wrapper(first_object)
-        else:
+
+        if not self._buffer_size:
             logger.debug("normal, iterable response")
-            return itertools.chain((first_object,), result_iter)
+            self._start_response(start_response, response_obj)
+            return (chunk
+                    for chunk in itertools.chain((first_object,), result_iter)
+                    if chunk is not teapot.response.FLUSH)
+
+        # fill the buffer once before starting the response; if the body ends
+        # before the buffer is full, we know its length
+        buffered = []
+        size = 0
+        chunk = first_object
+        while True:
+            if chunk is teapot.response.FLUSH:
+                complete = False
+                break
+            buffered.append(chunk)
+            size += len(chunk)
+            if size >= self._buffer_size:
+                complete = False
+                break
+            try:
+                chunk = next(result_iter)
+            except StopIteration:
+                complete = True
+                break
+
+        if complete:
+            logger.debug("buffered response with %d bytes", size)
+            body = b"".join(buffered)
+            if self._may_have_content_length(response_obj):
+                response_obj.custom_headers.append(
+                    ("Content-Length", str(len(body))))
+            self._start_response(start_response, response_obj)
+            return [body]
+
+        logger.debug("buffered, streamed response")
+        self._start_response(start_response, response_obj)
+        return itertools.chain(
+            (b"".join(buffered),) if buffered else (),
+            self._coalesce(result_iter, self._buffer_size))
 
     def __call__(self, environ, start_response):
         """
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+import importlib
+import inspect
+import logging
+import pkgutil
+import time
+import unittest
+
+import xsltea
+import xsltea.exec
+import xsltea.safe
+import xsltea.template
+
+logger = logging.getLogger(__name__)
+
+def sources_from_tests(package=xsltea):
+    """
+    Yield ``(name, source)`` tuples for all template sources defined as
+    ``xmlsrc*`` class attributes of the test cases in *package*.
+    """
+    for _, modname, _ in pkgutil.iter_modules(package.__path__):
+        if not modname.startswith("test_"):
+            continue
+        module = importlib.import_module(
+            "{}.{}".format(package.__name__, modname))
+        for clsname, cls in inspect.getmembers(module, inspect.isclass):
+            if not issubclass(cls, unittest.TestCase):
+                continue
+            for attrname, value in sorted(vars(cls).items()):
+                if attrname.startswith("xmlsrc") and isinstance(value, str):
+                    yield "{}.{}.{}".format(modname, clsname, attrname), value
+
+def make_loader():
+    safety_level = xsltea.safe.SafetyLevel.experimental
+    loader = xsltea.template.XMLTemplateLoader()
+    loader.add_processor(xsltea.exec.ExecProcessor)
+    loader.add_processor(xsltea.safe.BranchingProcessor)
+    loader.add_processor(xsltea.safe.ForeachProcessor(
+        safety_level=safety_level))
+    loader.add_processor(xsltea.safe.FunctionProcessor(
+        safety_level=safety_level))
+    loader.add_processor(xsltea.safe.GlobalsProcessor)
+    return loader
+
+def compilable_sources(loader, sources):
+    for name, source in sources:
+        try:
+            loader.load_template(source, name)
+        except Exception as err:
+            logger.info("skipping %s: %s", name, err)
+            continue
+        yield name, source
+
+def bench_compile(loader, sources, rounds):
+    """
+    Compile all *sources* *rounds* times using *loader* and return the
+    minimum time a round took.
+    """
+    timings = []
+    for i in range(rounds):
+        start = time.perf_counter()
+        for name, source in sources:
+            loader.load_template(source, name)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+if __name__ == "__main__":
+    import argparse
+    import os
+    import sys
+
+    parser = argparse.ArgumentParser(
+        description="Measure the time needed to compile the templates used"
+                    " by the xsltea test suite.")
+    parser.add_argument(
+        "-n", "--rounds",
+        type=int,
+        default=20,
+        help="Number of rounds to run (the fastest one is reported)")
+    parser.add_argument(
+        "-v",
+        dest="verbosity",
+        action="count",
+        default=0,
+        help="Increase verbosity")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level={
+            0: logging.ERROR,
+            1: logging.WARNING,
+            2: logging.INFO
+        }.get(args.verbosity, logging.DEBUG),
+        format='{0}:%(levelname)-8s %(message)s'.format(
+            os.path.basename(sys.argv[0]))
+    )
+
+    loader = make_loader()
+    sources = list(compilable_sources(loader, sources_from_tests()))
+    best = bench_compile(loader, sources, args.rounds)
+    print("{} templates: {:.2f} ms per round, {:.3f} ms per template".format(
+        len(sources),
+        best * 1000,
+        best * 1000 / max(len(sources), 1)))
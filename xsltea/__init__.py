@@ -18,6 +18,12 @@ The following modules and classes provide extension points to xsltea.
 
 .. automodule:: xsltea.template
 
+.. automodule:: xsltea.bytecode
+
+.. automodule:: xsltea.stream
+
+.. automodule:: xsltea.instrumentation
+
 .. automodule:: xsltea.processor
 
 .. automodule:: xsltea.safe
@@ -43,7 +49,7 @@ from .errors import TemplateEvaluationError
 from .exec import ExecProcessor
 from .forms import FormProcessor
 from .safe import ForeachProcessor, IncludeProcessor, SafetyLevel, \
-    FunctionProcessor, BranchingProcessor
+    FunctionProcessor, BranchingProcessor, CacheProcessor
 from .pipeline import Pipeline, XHTMLPipeline, XMLPipeline, TransformLoader
 from .sortable_table import SortableTableProcessor
 
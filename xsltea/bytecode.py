@@ -0,0 +1,124 @@
+"""
+``xsltea.bytecode`` – Persistent caches for compiled templates
+###############################################################
+
+Compiling a template involves running all template processors on the tree and
+compiling the resulting python AST. To avoid paying that price on every process
+start, a :class:`~xsltea.template.TemplateLoader` can be given a bytecode cache
+which persists the compiled templates::
+
+    loader = xsltea.template.XMLTemplateLoader(
+        source,
+        bytecode_cache=xsltea.bytecode.FileSystemBytecodeCache(
+            "/var/cache/myapp/templates"))
+
+The cache key covers the template source, the python bytecode version and a
+fingerprint of the processors registered at the loader (see
+:meth:`~xsltea.processor.TemplateProcessor.get_fingerprint`). In addition, the
+sources of all templates which were pulled in using ``tea:include`` or
+``tea:call`` are checked before a cache entry is used.
+
+Templates whose stored objects cannot be serialised are compiled as usual, but
+not persisted.
+
+.. autoclass:: BytecodeCache
+   :members:
+
+.. autoclass:: FileSystemBytecodeCache
+
+"""
+
+import abc
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+class BytecodeCache(metaclass=abc.ABCMeta):
+    """
+    Base class for bytecode caches. The cache is a simple key-value store,
+    mapping string *key* values to :class:`bytes` objects.
+    """
+
+    @abc.abstractmethod
+    def load(self, key):
+        """
+        Return the data stored under *key* or :data:`None`, if no data has been
+        stored under that key.
+        """
+
+    @abc.abstractmethod
+    def dump(self, key, data):
+        """
+        Store the :class:`bytes` object *data* under the given *key*.
+        """
+
+    def clear(self):
+        """
+        Drop all entries from the cache. The default implementation does
+        nothing.
+        """
+
+class FileSystemBytecodeCache(BytecodeCache):
+    """
+    Store cache entries as files in the given *directory*, which is created if
+    it does not exist. Each entry is saved in a separate file, named after the
+    key and the given *suffix*.
+
+    Files are replaced atomically, so it is safe to share the directory between
+    multiple processes.
+    """
+
+    def __init__(self, directory, suffix=".xtc", **kwargs):
+        super().__init__(**kwargs)
+        self._directory = directory
+        self._suffix = suffix
+        os.makedirs(directory, exist_ok=True)
+
+    def _get_path(self, key):
+        return os.path.join(self._directory, key + self._suffix)
+
+    def load(self, key):
+        try:
+            with open(self._get_path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as err:
+            logger.warning("failed to read bytecode cache entry %s: %s",
+                           key, err)
+            return None
+
+    def dump(self, key, data):
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                dir=self._directory,
+                prefix=".tmp-",
+                suffix=self._suffix)
+        except OSError as err:
+            logger.warning("failed to write bytecode cache entry %s: %s",
+                           key, err)
+            return
+
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._get_path(key))
+        except OSError as err:
+            logger.warning("failed to write bytecode cache entry %s: %s",
+                           key, err)
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+    def clear(self):
+        for filename in os.listdir(self._directory):
+            if not filename.endswith(self._suffix):
+                continue
+            try:
+                os.unlink(os.path.join(self._directory, filename))
+            except OSError as err:
+                logger.warning("failed to remove bytecode cache entry %s: %s",
+                               filename, err)
@@ -68,12 +68,8 @@ class FormProcessor(TemplateProcessor):
                 lineno=sourceline,
                 col_offset=0)
 
-        form_ast = compile(formstr,
-                           context.filename,
-                           "eval",
-                           ast.PyCF_ONLY_AST).body
-
-        self._safety_level.check_safety(form_ast)
+        form_ast = self._safety_level.compile_expression(formstr,
+                                                         context.filename)
 
         return form_ast
 
@@ -171,12 +167,8 @@ class FormProcessor(TemplateProcessor):
     def handle_attr_form(self, template, elem, key, value, context):
         sourceline = elem.sourceline or 0
 
-        form_ast = compile(value,
-                           context.filename,
-                           "eval",
-                           ast.PyCF_ONLY_AST).body
-
-        self._safety_level.check_safety(form_ast)
+        form_ast = self._safety_level.compile_expression(value,
+                                                         context.filename)
 
         elemcode = [
             ast.Assign(
@@ -475,7 +467,7 @@ class FormProcessor(TemplateProcessor):
                             lineno=sourceline,
                             col_offset=0),
                         template.ast_get_util(
-                            "append_children",
+                            "materialize_children",
                             sourceline),
                         input_type,
                         form_ast,
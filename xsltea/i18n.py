@@ -102,6 +102,7 @@ import gettext
 import logging
 import numbers
 import os
+import weakref
 
 from datetime import datetime, date, time, timedelta
 
@@ -134,6 +135,73 @@ class TextLookupError(LookupError):
             super_key = (super_key, ctxt)
         super().__init__(super_key)
 
+@functools.lru_cache(maxsize=None)
+def _get_babel_locale(locale):
+    """
+    Return the :class:`babel.Locale` to use for the given *locale* (in tuple
+    notation), falling back to the language without variant if babel does not
+    know the variant. Raise :class:`ValueError` if babel knows neither.
+    """
+    locale_str = teapot.accept.format_locale(locale)
+    try:
+        return babel.Locale.parse(locale_str)
+    except babel.core.UnknownLocaleError:
+        pass
+
+    babel_locale_str = teapot.accept.format_locale(locale[:1] + (None,))
+    try:
+        babel_locale = babel.Locale.parse(babel_locale_str)
+    except babel.core.UnknownLocaleError:
+        raise ValueError("Babel doesn’t know {}".format(
+            locale_str)) from None
+
+    logger.warn("Using fallback locale for babel "
+                "(%s instead of %s)",
+                babel_locale_str,
+                locale_str)
+    return babel_locale
+
+@functools.lru_cache(maxsize=256)
+def _parse_number_pattern(pattern):
+    return babel.numbers.parse_pattern(pattern)
+
+@functools.lru_cache(maxsize=256)
+def _parse_date_pattern(pattern):
+    if pattern in ("short", "medium", "long", "full"):
+        return pattern
+    return babel.dates.parse_pattern(pattern)
+
+# position of the format argument of babel functions which accept custom
+# patterns, along with the function to parse the pattern
+_PATTERN_ARGUMENTS = {
+    "format_currency": (2, _parse_number_pattern),
+    "format_decimal": (1, _parse_number_pattern),
+    "format_percent": (1, _parse_number_pattern),
+    "format_scientific": (1, _parse_number_pattern),
+    "format_date": (1, _parse_date_pattern),
+    "format_datetime": (1, _parse_date_pattern),
+    "format_time": (1, _parse_date_pattern),
+}
+
+def _with_cached_pattern(func, index, parse):
+    """
+    Wrap the babel function *func* so that a pattern string passed as
+    ``format`` argument (or as positional argument at *index*) is parsed using
+    the cached *parse* function, instead of on each call.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if len(args) > index:
+            if isinstance(args[index], str):
+                args = list(args)
+                args[index] = parse(args[index])
+        else:
+            format = kwargs.get("format")
+            if isinstance(format, str):
+                kwargs["format"] = parse(format)
+        return func(*args, **kwargs)
+    return wrapper
+
 class Localizer:
     """
     A :class:`Localizer` is a convenience object to provide general
@@ -156,6 +224,11 @@ class Localizer:
     objects will be translated into that timezone before printing. If the
     objects have no timezone assigned, they are assumed to be UTC.
 
+    The babel functions are bound on first access. Custom format patterns
+    passed to them are parsed only once. To obtain a localizer for a different
+    timezone, use :meth:`with_timezone`, which shares localizers per
+    timezone.
+
     Localizer objects are callable; calling a localizer will do something sane
     with the value, if it knows something sane to do (and :class:`TypeError`
     otherwise). Date/time values are passed to the according babel formatter, as
@@ -181,37 +254,41 @@ class Localizer:
         if funcname.startswith("format_") or funcname.startswith("get_")
     ]
 
-    def _map_functions(self, from_module, namelist):
-        for name in namelist:
-            obj = getattr(from_module, name)
-            # safeguard against babel adding non-callable module members with
-            # the name patterns from above here
-            if not hasattr(obj, "__call__"):
-                continue
+    _BABEL_MODULES = dict(
+        [(name, babel.numbers) for name in NUMBERS_FUNCTIONS] +
+        [(name, babel.dates) for name in DATES_FUNCTIONS])
+
+    def _wrap_datetime(self, func):
+        @functools.wraps(func)
+        def wrapper(value, *args, **kwargs):
+            if hasattr(value, "tzinfo"):
+                value = self.to_timezone(value)
+            return func(value, *args, **kwargs)
+        return wrapper
 
-            setattr(self, name, self.locale_ifyer(obj))
-
-    def _map_datetimes(self, from_module, namelist):
-        if self.timezone is not None:
-            def wrap(func):
-                @functools.wraps(func)
-                def wrapper(value, *args, **kwargs):
-                    if hasattr(value, "tzinfo"):
-                        value = self.to_timezone(value)
-                    return func(value, *args, **kwargs)
-                return wrapper
+    def _bind(self, name):
+        try:
+            from_module = self._BABEL_MODULES[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+        obj = getattr(from_module, name)
+        # safeguard against babel adding non-callable module members with
+        # the name patterns from above here
+        if not hasattr(obj, "__call__"):
+            raise AttributeError(name)
+
+        try:
+            index, parse = _PATTERN_ARGUMENTS[name]
+        except KeyError:
+            pass
         else:
-            def wrap(func):
-                return func
-
-        for name in namelist:
-            obj = getattr(from_module, name)
-            # safeguard against babel adding non-callable module members with
-            # the name patterns from above here
-            if not hasattr(obj, "__call__"):
-                continue
+            obj = _with_cached_pattern(obj, index, parse)
+
+        if from_module is babel.dates and self.timezone is not None:
+            obj = self._wrap_datetime(obj)
 
-            setattr(self, name, self.locale_ifyer(wrap(obj)))
+        return self.locale_ifyer(obj)
 
     def __init__(self, locale, text_source_chain, timezone=None, textdb=None):
         if not text_source_chain:
@@ -222,30 +299,38 @@ class Localizer:
         self._locale_str = teapot.accept.format_locale(locale)
         self._text_source_chain = tuple(text_source_chain)
         self._timezone = timezone
+        self._timezone_variants = {timezone: self}
 
-        babel_locale_str = self._locale_str
-        try:
-            babel.numbers.format_number(1, locale=babel_locale_str)
-        except babel.core.UnknownLocaleError:
-            babel_locale_str = teapot.accept.format_locale(
-                locale[:1] + (None,))
-            try:
-                babel.numbers.format_number(1, locale=babel_locale_str)
-            except babel.core.UnknownLocaleError:
-                raise ValueError("Babel doesn’t know {}".format(
-                    self._locale_str)) from None
-            else:
-                logger.warn("Using fallback locale for babel "
-                            "(%s instead of %s)",
-                            babel_locale_str,
-                            self._locale_str)
-
+        self.babel_locale = _get_babel_locale(tuple(locale))
         self.locale_ifyer = functools.partial(
             functools.partial,
-            locale=babel_locale_str)
+            locale=self.babel_locale)
+
+    def __getattr__(self, name):
+        # the babel functions are bound on first use
+        if name.startswith("_"):
+            raise AttributeError(name)
+        func = self._bind(name)
+        setattr(self, name, func)
+        return func
+
+    def with_timezone(self, timezone):
+        """
+        Return a :class:`Localizer` for the same locale and text sources, which
+        uses the given *timezone*. Localizers are created only once per
+        timezone and shared afterwards.
+        """
+        try:
+            return self._timezone_variants[timezone]
+        except KeyError:
+            pass
 
-        self._map_datetimes(babel.dates, self.DATES_FUNCTIONS)
-        self._map_functions(babel.numbers, self.NUMBERS_FUNCTIONS)
+        localizer = Localizer(self._locale,
+                              self._text_source_chain,
+                              timezone=timezone,
+                              textdb=self._textdb)
+        localizer._timezone_variants = self._timezone_variants
+        return self._timezone_variants.setdefault(timezone, localizer)
 
     def __hash__(self):
         return hash(self._locale) ^ hash(self._text_source_chain)
@@ -487,7 +572,7 @@ class TextDatabaseFallback(TextSource):
         assert False
 
 
-def _get_localizer(textdb, locale, timezone):
+def _get_localizer(textdb, locale):
     """
     .. warning::
 
@@ -522,10 +607,32 @@ def _get_localizer(textdb, locale, timezone):
 
     return Localizer(locale,
                      text_source_chain,
-                     timezone=timezone,
                      textdb=textdb)
 
 
+def _negotiate_locale(textdb, preferences):
+    """
+    .. warning::
+
+       Do not call this directly. This is the outsourced implementation of
+       :meth:`TextDatabase.get_localizer_by_client_preference`. The actual
+       implementation on :class:`TextDatabase` objects is equipped with a
+       cache, keyed on the tuple of client *preferences*.
+
+    """
+
+    client_preferences = teapot.accept.LanguagePreferenceList(preferences)
+    if len(textdb):
+        candidates = client_preferences.get_candidates(
+            textdb.get_preference_list())
+
+        return candidates.pop()[1].values
+
+    try:
+        return client_preferences.get_sorted_by_preference()[0].values
+    except IndexError:
+        return textdb.fallback_locale
+
 class TextDatabase:
     """
     The text database provides a mapping from locales to text sources. It
@@ -545,6 +652,10 @@ class TextDatabase:
     be created (e.g. ``Accept-Language`` HTTP headers). To disable caching
     altogether, set *cache_size* to a non-positive number (e.g. ``0``).
 
+    Likewise, *negotiation_cache_size* is the maximum amount of client
+    preference lists for which the result of
+    :meth:`get_localizer_by_client_preference` is remembered.
+
     The cache is automatically cleared when the :class:`TextDatabase` is altered
     in any relevant way.
 
@@ -557,7 +668,8 @@ class TextDatabase:
     (that is, all variants of a locale appear together).
     """
 
-    def __init__(self, fallback_locale, fallback_mode="error", cache_size=32):
+    def __init__(self, fallback_locale, fallback_mode="error", cache_size=32,
+                 negotiation_cache_size=256):
         super().__init__()
         self._source_tree = {}
         self._cached_get_localizer = functools.partial(_get_localizer, self)
@@ -569,17 +681,28 @@ class TextDatabase:
                 self._cached_get_localizer
             )
 
+        self._cached_negotiate_locale = functools.partial(
+            _negotiate_locale, self)
+        if negotiation_cache_size is None or negotiation_cache_size > 0:
+            self._cached_negotiate_locale = functools.lru_cache(
+                maxsize=negotiation_cache_size
+            )(
+                self._cached_negotiate_locale
+            )
+
         self.fallback_handler = TextDatabaseFallback(fallback_mode)
         self.fallback_locale = fallback_locale
 
         self._preferences_cache = None
 
     def _clear_caches(self):
-        try:
-            self._cached_get_localizer.cache_clear()
-        except AttributeError:
-            # this happens if cache_size=0
-            pass
+        for cached in [self._cached_get_localizer,
+                       self._cached_negotiate_locale]:
+            try:
+                cached.cache_clear()
+            except AttributeError:
+                # this happens if the cache size is 0
+                pass
 
         self._preferences_cache = None
 
@@ -709,11 +832,15 @@ class TextDatabase:
         or replacing texts sources will not affect already created
         :class:`Localizer` objects.
 
-        The *timezone* argument is passed to the :class:`Localizer` constructor.
+        If *timezone* is not :data:`None`, the localizer for that timezone is
+        obtained using :meth:`Localizer.with_timezone`, so that all timezones
+        share one cache entry.
         """
 
-        return self._cached_get_localizer(self._mapkey(locale),
-                                          timezone=timezone)
+        localizer = self._cached_get_localizer(self._mapkey(locale))
+        if timezone is not None:
+            localizer = localizer.with_timezone(timezone)
+        return localizer
 
     def get_localizer_by_client_preference(self, client_preferences,
                                            **kwargs):
@@ -722,19 +849,13 @@ class TextDatabase:
         the list of text sources available. The result of this is passed to
         :meth:`get_localizer`, along with the *kwargs*, to create and return a
         new :class:`Localizer`.
-        """
-
-        if len(self):
-            candidates = client_preferences.get_candidates(
-                self.get_preference_list())
 
-            locale = candidates.pop()[1].values
-        else:
-            try:
-                locale = client_preferences.get_sorted_by_preference()[0].values
-            except IndexError:
-                locale = self.fallback_locale
+        The negotiation result is cached per list of client preferences, so
+        that repeated requests with the same ``Accept-Language`` header do not
+        need to be matched against the available locales again.
+        """
 
+        locale = self._cached_negotiate_locale(tuple(client_preferences))
         return self.get_localizer(locale, **kwargs)
 
     def load_all(self, base_path):
@@ -808,6 +929,68 @@ def node_to_msgid(node, filename=None, **kwargs):
     msg.sourceline = node.sourceline
     return msg
 
+@functools.lru_cache(maxsize=4096)
+def _parse_translation(translated):
+    """
+    Parse a *translated* message which contains inline markup. Return a tuple
+    ``(text, placeholders)``, where *text* is the text before the first
+    element and *placeholders* is a tuple of ``(id, text, tail, parent_id)``
+    tuples, one for each ``<xml/>`` element in document order. *parent_id* is
+    :data:`None` for elements at the top level.
+
+    The result only depends on the translated string, which in turn is
+    determined by the localizer, the message id and the plural form, so it is
+    cached.
+    """
+    root = etree.fromstring("<root>"+translated+"</root>")
+    placeholders = []
+    for child in root.iter("xml"):
+        parent = child.getparent()
+        placeholders.append((
+            child.get("id"),
+            child.text,
+            child.tail,
+            None if parent is root else parent.get("id")))
+    return root.text, tuple(placeholders)
+
+class _FoldedTranslation:
+    """
+    A translation with a constant message id and without format arguments,
+    as folded by the :class:`I18NProcessor`. The result of the lookup is kept
+    for each :class:`Localizer` it is requested for, as long as the localizer
+    is alive.
+
+    If *markup* is true, the translation is treated like the content of an
+    ``i18n:_`` element without children; otherwise it is looked up like the
+    value of an ``@i18n:*`` attribute.
+    """
+
+    def __init__(self, msgid, markup):
+        self.msgid = msgid
+        self.markup = markup
+        self.translations = weakref.WeakKeyDictionary()
+
+    def lookup(self, localizer):
+        try:
+            return self.translations[localizer]
+        except KeyError:
+            pass
+
+        translated = localizer.gettext(self.msgid)
+        if self.markup:
+            if "<" in translated or "&" in translated:
+                translated, _ = _parse_translation(translated)
+            translated = translated.format() if translated else ""
+
+        self.translations[localizer] = translated
+        return translated
+
+    def __getstate__(self):
+        return self.msgid, self.markup
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
 class I18NProcessor(xsltea.processor.TemplateProcessor):
     """
     Processor which allows the use of the *textdb* :class:`TextDatabase` object
@@ -878,6 +1061,13 @@ class I18NProcessor(xsltea.processor.TemplateProcessor):
       In that case, if the request has a ``timezone`` attribute, it will be used
       to specify the output timezone.
 
+    If *fold_translations* is true, the translations of ``i18n:_`` elements
+    with constant content (no attributes and no child elements) and of
+    ``@i18n:*`` attributes are looked up only once per localizer and then
+    used as constants. This assumes that the text sources of a localizer are
+    not modified; the :class:`TextDatabase` creates new localizers when text
+    sources are replaced.
+
     The namespace of ``i18n:`` elements is
     ``https://xmlns.zombofant.net/xsltea/i18n``.
     """
@@ -887,6 +1077,7 @@ class I18NProcessor(xsltea.processor.TemplateProcessor):
     def __init__(self, textdb,
                  safety_level=xsltea.safe.SafetyLevel.conservative,
                  varname="i18n",
+                 fold_translations=False,
                  **kwargs):
         super().__init__(**kwargs)
 
@@ -932,6 +1123,7 @@ class I18NProcessor(xsltea.processor.TemplateProcessor):
         self._textdb = textdb
         self._varname = varname
         self._safety_level = safety_level
+        self.fold_translations = fold_translations
 
     def _access_var(self, template, ctx, sourceline):
         return template.ast_get_from_object(
@@ -940,6 +1132,23 @@ class I18NProcessor(xsltea.processor.TemplateProcessor):
             sourceline,
             ctx=ctx)
 
+    def _lookup_folded(self, template, msgid, markup, sourceline):
+        return astwrap.Call(
+            template.ast_get_from_object(
+                "lookup",
+                template.ast_get_stored(
+                    template.store(_FoldedTranslation(msgid, markup)),
+                    sourceline),
+                sourceline),
+            [
+                self._access_var(template, ast.Load(), sourceline),
+            ],
+            [],
+            None,
+            None,
+            lineno=sourceline,
+            col_offset=0)
+
     def _make_attrs_dict(self, attrs, sourceline):
         attrs_dict = ast.Dict([], [], lineno=sourceline, col_offset=0)
         for key, value in attrs.items():
@@ -1003,7 +1212,11 @@ class I18NProcessor(xsltea.processor.TemplateProcessor):
             lineno=sourceline,
             col_offset=0)
 
-        valuecode = self._lookup_type(template, value, None, sourceline)
+        if self.fold_translations:
+            valuecode = self._lookup_folded(template, value, False,
+                                            sourceline)
+        else:
+            valuecode = self._lookup_type(template, value, None, sourceline)
 
         return [], [], keycode, valuecode, []
 
@@ -1039,8 +1252,6 @@ class I18NProcessor(xsltea.processor.TemplateProcessor):
 
     def elemcode_main(self, context, append_children, childfun, msgid, n,
                       attrs):
-        nsmap = {"i18n": str(xmlns)}
-
         if n is not None:
             translated = context.i18n.ngettext(msgid.singular,
                                                msgid.plural,
@@ -1048,45 +1259,53 @@ class I18NProcessor(xsltea.processor.TemplateProcessor):
         else:
             translated = context.i18n.gettext(msgid.singular)
 
-        text = etree.fromstring("<root>"+translated+"</root>")
-        if text.text:
-            yield text.text.format(**attrs)
-        tail = None
+        if "<" not in translated and "&" not in translated:
+            # no markup, nothing to parse
+            if translated:
+                yield translated.format(**attrs)
+            if childfun is not None:
+                buffer_element = context.makeelement("buffer")
+                append_children(buffer_element, childfun())
+                for child in buffer_element:
+                    yield child
+            return
+
+        text, placeholders = _parse_translation(translated)
+        if text:
+            yield text.format(**attrs)
         buffer_element = context.makeelement("buffer")
-        append_children(buffer_element, childfun())
-        for child in text.xpath("//xml"):
-            id = child.get("id")
-            try:
-                dest = buffer_element.xpath(
-                    "descendant-or-self::*[@i18n:id={!r}]".format(id),
-                    namespaces=nsmap)[0]
-            except IndexError:
-                dest = None
-            else:
-                dest.text = child.text.format(**attrs)
+        if childfun is not None:
+            append_children(buffer_element, childfun())
 
-            if not child.tail:
-                continue
+        # map each i18n:id to the first element carrying it
+        destinations = {}
+        if placeholders:
+            for elem in buffer_element.iter():
+                destinations.setdefault(elem.get(xmlns.id), elem)
 
-            # find out to which parent this belongs
-            if child.getparent() == text:
-                dest.tail = child.tail.format(**attrs)
-                continue
+        for id, child_text, child_tail, parent_id in placeholders:
+            dest = destinations.get(id)
+            if dest is not None and child_text is not None:
+                dest.text = child_text.format(**attrs)
 
-            if dest is None:
+            if not child_tail or dest is None:
                 # we cannot do something sensible here
                 continue
 
+            # find out to which parent this belongs
+            if parent_id is None:
+                dest.tail = child_tail.format(**attrs)
+                continue
+
             # to find the matching parent, we walk up the dest tree until we
             # find the id of the parent of child. when we found it, we set the
             # tail of the child which has the matching parent to the value of
             # this child
-            target_parent_id = child.getparent().get("id")
             curr = dest
             parent = curr.getparent()
             while parent != buffer_element:
-                if parent.get(xmlns.id) == target_parent_id:
-                    curr.tail = child.tail.format(**attrs)
+                if parent.get(xmlns.id) == parent_id:
+                    curr.tail = child_tail.format(**attrs)
                     break
 
                 curr = parent
@@ -1114,9 +1333,9 @@ class I18NProcessor(xsltea.processor.TemplateProcessor):
             if isinstance(nexpr_source, int):
                 nexpr = ast.Num(nexpr_source)
             else:
-                nexpr = compile(nexpr_source, context.filename, "eval",
-                                ast.PyCF_ONLY_AST).body
-                self._safety_level.check_safety(nexpr)
+                nexpr = self._safety_level.compile_expression(
+                    nexpr_source,
+                    context.filename)
         else:
             nexpr = ast.Name("None", ast.Load(),
                              lineno=sourceline, col_offset=0)
@@ -1125,11 +1344,9 @@ class I18NProcessor(xsltea.processor.TemplateProcessor):
         for key, value in original_attrs.items():
             ns, name = xsltea.template.split_tag(key)
             if ns == str(xsltea.exec.ExecProcessor.xmlns):
-                expr = compile(value,
-                               context.filename,
-                               "eval",
-                               ast.PyCF_ONLY_AST).body
-                self._safety_level.check_safety(expr)
+                expr = self._safety_level.compile_expression(
+                    value,
+                    context.filename)
                 attrs[name] = expr
             elif ns is None:
                 attrs[name] = ast.Str(
@@ -1144,13 +1361,22 @@ class I18NProcessor(xsltea.processor.TemplateProcessor):
                     context,
                     sourceline)
 
+        elemcode = []
+
+        msgid = node_to_msgid(elem)
+        if (self.fold_translations and not len(elem) and not attrs and
+                not elem.tag.endswith("}n")):
+            elemcode.append(template.ast_yield(
+                self._lookup_folded(template, msgid.singular, True,
+                                    sourceline),
+                sourceline))
+            elemcode.extend(template.preserve_tail_code(elem, context))
+            return [], elemcode, []
+
         childfun_name = "children{}".format(offset)
         precode = template.compose_childrenfun(
             elem, context, childfun_name)
 
-        elemcode = []
-
-        msgid = node_to_msgid(elem)
         elemcode.append(
             ast.Expr(
                 ast.YieldFrom(
@@ -1163,7 +1389,7 @@ class I18NProcessor(xsltea.processor.TemplateProcessor):
                                 lineno=sourceline,
                                 col_offset=0),
                             template.ast_get_util(
-                                "append_children",
+                                "materialize_children",
                                 sourceline),
                             childfun_name if precode else "None",
                             template.ast_get_stored(
@@ -1186,12 +1412,9 @@ class I18NProcessor(xsltea.processor.TemplateProcessor):
     def handle_elem_type(self, type_, template, elem, context, offset):
         sourceline = elem.sourceline or 0
 
-        key_code = compile(
+        key_code = self._safety_level.compile_expression(
             elem.text,
-            context.filename,
-            "eval",
-            ast.PyCF_ONLY_AST).body
-        self._safety_level.check_safety(key_code)
+            context.filename)
 
         elemcode = template.preserve_tail_code(elem, context)
         elemcode.insert(
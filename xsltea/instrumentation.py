@@ -0,0 +1,201 @@
+"""
+``xsltea.instrumentation`` – Measuring where rendering time is spent
+####################################################################
+
+To find out why a page renders slowly, a :class:`Sink` can be set as the
+*instrumentation* of a :class:`~xsltea.pipeline.Pipeline`. For each request
+handled by the pipeline, a :class:`RenderStats` object is filled with the
+time spent in the different phases of rendering and passed to the sink::
+
+    sink = xsltea.instrumentation.CollectingSink(maxlen=100)
+    pipeline.instrumentation = sink
+
+Templates can also be instrumented directly by passing a :class:`RenderStats`
+object to :meth:`~xsltea.template.Template.process`.
+
+If a :class:`~xsltea.template.TemplateLoader` is created with
+*instrument_sections* set, code is generated around ``tea:for-each``,
+``tea:include`` and ``tea:call`` elements which records the time spent in them
+as *sections*. Templates compiled without that option do not contain any
+instrumentation code, and pipelines without a sink only pay for checking that
+none is set.
+
+.. autoclass:: RenderStats
+   :members:
+
+.. autoclass:: Sink
+   :members:
+
+.. autoclass:: CollectingSink
+
+.. autoclass:: LoggingSink
+
+.. autofunction:: recording
+
+.. autofunction:: get_current_stats
+
+"""
+
+import abc
+import collections
+import contextlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_state = threading.local()
+
+class RenderStats:
+    """
+    Measurements taken while rendering the template called *template_name*.
+
+    .. attribute:: phases
+
+       An ordered dictionary mapping the names of the rendering phases to the
+       time in seconds spent in them. Pipelines record the phases
+       ``"arguments"`` (running the decorated callable), ``"process"``
+       (evaluating the template), ``"transforms"`` (applying the transforms)
+       and ``"serialise"`` (converting the tree into the response body). If
+       the template is evaluated by the output format itself (see the
+       *streaming* option of :class:`~xsltea.pipeline.XMLPipeline`), the
+       evaluation and serialisation is recorded as ``"render"`` instead.
+
+    .. attribute:: elements
+
+       The number of elements in the evaluated tree, or :data:`None` if the
+       tree was not built as a whole.
+
+    .. attribute:: bytes
+
+       The length of the response body in bytes, or :data:`None` if it is not
+       known.
+
+    .. attribute:: sections
+
+       A list of ``(kind, label, duration)`` tuples, one for each evaluation of
+       an instrumented section (see *instrument_sections* of
+       :class:`~xsltea.template.TemplateLoader`). Durations include the
+       sections nested within.
+    """
+
+    def __init__(self, template_name):
+        self.template_name = template_name
+        self.phases = collections.OrderedDict()
+        self.elements = None
+        self.bytes = None
+        self.sections = []
+
+    def add_phase(self, name, duration):
+        """
+        Add *duration* seconds to the time spent in the phase called *name*.
+        """
+        self.phases[name] = self.phases.get(name, 0) + duration
+
+    def add_section(self, kind, label, duration):
+        """
+        Record that the evaluation of a section of the given *kind* (e.g.
+        ``"for-each"``) identified by *label* took *duration* seconds.
+        """
+        self.sections.append((kind, label, duration))
+
+    def get_section_totals(self):
+        """
+        Return a dictionary mapping ``(kind, label)`` tuples to the total time
+        spent in all evaluations of the respective section.
+        """
+        totals = {}
+        for kind, label, duration in self.sections:
+            key = kind, label
+            totals[key] = totals.get(key, 0) + duration
+        return totals
+
+    @property
+    def total(self):
+        """
+        The sum of the durations of all phases.
+        """
+        return sum(self.phases.values())
+
+    def __repr__(self):
+        return "<RenderStats {!r} {}>".format(
+            self.template_name,
+            " ".join("{}={:.1f}ms".format(name, duration * 1000)
+                     for name, duration in self.phases.items()))
+
+class Sink(metaclass=abc.ABCMeta):
+    """
+    Base class for receivers of :class:`RenderStats`. Sinks may be called from
+    several threads at once.
+    """
+
+    @abc.abstractmethod
+    def record(self, stats):
+        """
+        Process the :class:`RenderStats` *stats* of a finished render.
+        """
+
+class CollectingSink(Sink):
+    """
+    Keep the :class:`RenderStats` passed to the sink in the :attr:`records`
+    :class:`~collections.deque`. If *maxlen* is not :data:`None`, only that
+    many of the most recent records are kept.
+    """
+
+    def __init__(self, maxlen=None, **kwargs):
+        super().__init__(**kwargs)
+        self.records = collections.deque(maxlen=maxlen)
+
+    def record(self, stats):
+        self.records.append(stats)
+
+class LoggingSink(Sink):
+    """
+    Write a line summarising each render to the given *logger* (defaulting to
+    the logger of this module) at the given *level*.
+    """
+
+    def __init__(self, logger=logger, level=logging.DEBUG, **kwargs):
+        super().__init__(**kwargs)
+        self._logger = logger
+        self._level = level
+
+    def record(self, stats):
+        self._logger.log(
+            self._level,
+            "%s: %.1f ms (%s), %s elements, %s bytes",
+            stats.template_name,
+            stats.total * 1000,
+            ", ".join("{} {:.1f} ms".format(name, duration * 1000)
+                      for name, duration in stats.phases.items()),
+            stats.elements,
+            stats.bytes)
+
+def get_current_stats():
+    """
+    Return the :class:`RenderStats` which sections evaluated in this thread are
+    recorded to, or :data:`None`.
+    """
+    return getattr(_state, "stats", None)
+
+@contextlib.contextmanager
+def recording(stats):
+    """
+    Record the sections evaluated in this thread while the context manager is
+    held into the :class:`RenderStats` *stats*.
+    """
+    prev = getattr(_state, "stats", None)
+    _state.stats = stats
+    try:
+        yield
+    finally:
+        _state.stats = prev
+
+def section_start():
+    return time.perf_counter()
+
+def section_end(kind, label, start):
+    stats = getattr(_state, "stats", None)
+    if stats is not None:
+        stats.add_section(kind, label, time.perf_counter() - start)
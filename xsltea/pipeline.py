@@ -16,8 +16,12 @@ More specialized pipelines for XML and HTML output formats are also available:
 """
 
 import abc
+import contextlib
 import functools
+import hashlib
 import logging
+import threading
+import time
 
 import lxml.etree as etree
 
@@ -27,8 +31,15 @@ import teapot.request
 import teapot.routing
 import teapot.routing.selectors
 
+from .instrumentation import RenderStats, recording
+from .stream import Serialiser, TemplateStream, xhtml_namespace
+from .utils import PerThread
+
 logger = logging.getLogger(__name__)
 
+def _xslt_from_string(source):
+    return etree.XSLT(etree.fromstring(source))
+
 class Pipeline:
     """
     A pipeline is a composite of a list of transforms. In addition, it can chain
@@ -51,10 +62,20 @@ class Pipeline:
        forwarding it to the next template in the chain (or passing it to the
        output handler).
 
+    .. attribute:: instrumentation
+
+       If set to a :class:`~xsltea.instrumentation.Sink`, the time spent in the
+       phases of each render of a template, together with the number of
+       elements and bytes produced, is recorded and passed to the sink as
+       :class:`~xsltea.instrumentation.RenderStats`. Defaults to the
+       *instrumentation* argument, which defaults to :data:`None`.
+
     """
 
-    def __init__(self, *, chain_from=None, chain_to=None, **kwargs):
+    def __init__(self, *, chain_from=None, chain_to=None, instrumentation=None,
+                 **kwargs):
         super().__init__(**kwargs)
+        self.instrumentation = instrumentation
         self.local_transforms = []
         self._chain_from = None
         self._chain_to = None
@@ -142,20 +163,42 @@ class Pipeline:
             except KeyError:
                 return self._default_handler
 
-    def apply_transforms(self, request):
+    def apply_transforms(self, request, stats=None):
         """
         Apply the whole pipeline, including output formatting, to the given
         *tree*, using the information from the original *request*.
+
+        If :class:`~xsltea.instrumentation.RenderStats` are given as *stats*,
+        the time spent in the transforms and the output formatting is recorded.
         """
 
         handler = iter(self._find_handler_for_content_type(
             request.accepted_content_type)(request))
 
         tree, arguments = yield handler.send(None)
-        for transform in self.iter_transforms():
-            tree = transform.transform(tree, arguments)
-
-        yield handler.send(tree)
+        if stats is None:
+            for transform in self.iter_transforms():
+                tree = transform.transform(tree, arguments)
+            yield handler.send(tree)
+            return
+
+        if isinstance(tree, TemplateStream):
+            # the output handler evaluates the template
+            phase = "render"
+        else:
+            start = time.perf_counter()
+            for transform in self.iter_transforms():
+                tree = transform.transform(tree, arguments)
+            stats.add_phase("transforms", time.perf_counter() - start)
+            phase = "serialise"
+
+        start = time.perf_counter()
+        with recording(stats):
+            result = handler.send(tree)
+        stats.add_phase(phase, time.perf_counter() - start)
+        if isinstance(result, bytes):
+            stats.bytes = len(result)
+        yield result
 
     def _decorated_process(self,
                            arguments,
@@ -163,18 +206,91 @@ class Pipeline:
                            request,
                            decorated_iter):
         template_args = dict(arguments)
+        stats = None
+        if self.instrumentation is not None:
+            stats = RenderStats(template.filename)
+            start = time.perf_counter()
         response = next(decorated_iter)
+        if stats is not None:
+            stats.add_phase("arguments", time.perf_counter() - start)
 
-        transform_iter = iter(self.apply_transforms(request))
+        transform_iter = iter(self.apply_transforms(request, stats=stats))
         content_type = next(transform_iter)
         response.content_type = content_type
         yield response
 
+        if request.method == teapot.request.Method.HEAD:
+            # no need to evaluate the template if nobody is going to see the
+            # result
+            if hasattr(decorated_iter, "close"):
+                decorated_iter.close()
+            transform_iter.close()
+            return
+
+        if stats is not None:
+            start = time.perf_counter()
         user_template_args, user_transform_args = next(decorated_iter)
+        if stats is not None:
+            stats.add_phase("arguments", time.perf_counter() - start)
         template_args.update(user_template_args)
-        tree = template.process(template_args, request=request)
+        if self._defer_rendering():
+            # let the output handler choose how to evaluate the template
+            result = transform_iter.send((
+                TemplateStream(template, template_args, request=request),
+                user_transform_args))
+            if self._use_streaming():
+                if stats is not None:
+                    result = self._instrument_stream(result, stats)
+                yield from result
+            else:
+                if stats is not None:
+                    self.instrumentation.record(stats)
+                yield result
+            return
+
+        if stats is None:
+            tree = template.process(template_args, request=request)
+            yield transform_iter.send((tree, user_transform_args))
+            return
+
+        tree = template.process(template_args, request=request, stats=stats)
+        result = transform_iter.send((tree, user_transform_args))
+        self.instrumentation.record(stats)
+        yield result
+
+    def _instrument_stream(self, chunks, stats):
+        chunks = iter(chunks)
+        stats.bytes = 0
+        while True:
+            start = time.perf_counter()
+            with recording(stats):
+                chunk = next(chunks, None)
+            stats.add_phase("render", time.perf_counter() - start)
+            if chunk is None:
+                break
+            stats.bytes += len(chunk)
+            yield chunk
+        self.instrumentation.record(stats)
+
+    def _output_pipeline(self):
+        return self._chain_to if self._chain_to is not None else self
+
+    def _defer_rendering(self):
+        if not self._output_pipeline()._supports_deferred_rendering():
+            return False
+        for transform in self.iter_transforms():
+            return False
+        return True
+
+    def _use_streaming(self):
+        return (self._output_pipeline()._supports_streaming() and
+                self._defer_rendering())
 
-        yield transform_iter.send((tree, user_transform_args))
+    def _supports_deferred_rendering(self):
+        return False
+
+    def _supports_streaming(self):
+        return False
 
     def _decorated(self, __arguments, __callable, __template_name, __request,
                    *args, **kwargs):
@@ -256,6 +372,13 @@ class XMLPipeline(Pipeline):
     If *strict* is :data:`False`, pipelines using this pipeline as end pipeline
     will act as a catchall with regards to content negotiation!
 
+    .. attribute:: streaming
+
+       If set to true and no transforms are configured in the pipeline chain,
+       templates are serialised while they are evaluated and the response body
+       is passed on in chunks (see :mod:`xsltea.stream`). Streaming is not
+       used if :attr:`pretty_print` is set.
+
     .. attribute:: pretty_print
 
        If set to true, the output will be pretty-printed.
@@ -276,10 +399,12 @@ class XMLPipeline(Pipeline):
         teapot.accept.MIMEPreference("text", "xml", q=0.9),
     ]
 
-    def __init__(self, *, strict=False, pretty_print=False, **kwargs):
+    def __init__(self, *, strict=False, pretty_print=False, streaming=False,
+                 **kwargs):
         super().__init__(**kwargs)
         self._strict = strict
         self.pretty_print = pretty_print
+        self.streaming = streaming
 
         self._output_types = {
             teapot.mime.Type.application_xml: self._negotiate,
@@ -315,8 +440,19 @@ class XMLPipeline(Pipeline):
                         teapot.mime.Type.application_xml)
         charset = self._negotiate_charset(request)
         tree = yield content_type.with_charset(charset)
+        if isinstance(tree, TemplateStream):
+            if self._supports_streaming():
+                yield tree.serialise(Serialiser(encoding=charset))
+                return
+            tree = tree.process()
         yield self._tostring(tree, charset)
 
+    def _supports_deferred_rendering(self):
+        return True
+
+    def _supports_streaming(self):
+        return self.streaming and not self.pretty_print
+
 class XHTMLPipeline(XMLPipeline):
     """
     A :class:`Pipeline` subclass which offers all html-ish output formats and
@@ -342,7 +478,8 @@ class XHTMLPipeline(XMLPipeline):
         teapot.accept.MIMEPreference("text", "xhtml", q=0.85),
     ]
 
-    _remove_prefixes_transform = etree.XSLT(etree.fromstring(
+    _remove_prefixes_transform = PerThread(functools.partial(
+        _xslt_from_string,
 """<xsl:stylesheet version="1.0"
         xmlns="http://www.w3.org/1999/xhtml"
         xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
@@ -382,6 +519,15 @@ class XHTMLPipeline(XMLPipeline):
 
 </xsl:stylesheet>"""))
 
+    _prefixless_namespaces = (xhtml_namespace, "http://www.w3.org/2000/svg")
+
+    # finds the nodes which _remove_prefixes_transform would change
+    _find_prefixed = PerThread(functools.partial(
+        etree.XPath,
+        "(//*[(namespace-uri() = '{0}' or namespace-uri() = '{1}') and "
+        "name() != local-name()] | //@*[namespace-uri() = '{0}'])[1]".format(
+            *_prefixless_namespaces)))
+
     def __init__(self, *, strict=True, html_version=5, **kwargs):
         super().__init__(strict=strict, **kwargs)
 
@@ -426,9 +572,14 @@ class XHTMLPipeline(XMLPipeline):
             charset,
             **kwargs)
 
+    def _remove_prefixes(self, tree):
+        if self._find_prefixed.get()(tree):
+            return self._remove_prefixes_transform.get().apply(tree)
+        return tree
+
     def _as_prefixless_xhtml(self, tree, charset, **kwargs):
         return self._as_full_xhtml(
-            self._remove_prefixes_transform.apply(tree),
+            self._remove_prefixes(tree),
             charset,
             **kwargs)
 
@@ -437,10 +588,15 @@ class XHTMLPipeline(XMLPipeline):
         # TODO: do we want to raise if non-xhtml elements are encountered, as a
         # safeguard?
         return self._tostring(
-            self._remove_prefixes_transform.apply(tree),
+            self._remove_prefixes(tree),
             charset,
             **kwargs)
 
+    def _get_default_namespaces(self, transform):
+        if transform == self._as_full_xhtml:
+            return ()
+        return self._prefixless_namespaces
+
     def _negotiate(self, request):
         features = request.user_agent_info.features
         if teapot.request.UserAgentFeatures.no_xhtml in features:
@@ -464,15 +620,52 @@ class XHTMLPipeline(XMLPipeline):
 
         tree = yield content_type.with_charset(charset)
 
+        if isinstance(tree, TemplateStream):
+            if self._supports_streaming():
+                yield tree.serialise(self._get_serialiser(transform, charset))
+                return
+            # render the unprefixed variant right away, so that the prefixes
+            # need not be removed afterwards
+            tree = tree.process(
+                default_namespaces=self._get_default_namespaces(transform))
+
         yield transform(tree, charset)
 
+    def _get_serialiser(self, transform, charset):
+        if transform == self._as_full_xhtml:
+            return Serialiser(
+                encoding=charset,
+                doctype=self._xhtml_version_args["doctype"])
+
+        default_namespaces = self._get_default_namespaces(transform)
+        if transform == self._as_prefixless_xhtml:
+            return Serialiser(
+                encoding=charset,
+                doctype=self._xhtml_version_args["doctype"],
+                default_namespaces=default_namespaces)
+
+        return Serialiser(
+            method="html",
+            encoding=charset,
+            doctype=self._html_version_args["doctype"],
+            default_namespaces=default_namespaces)
+
 class PathResolver(etree.Resolver):
     def __init__(self, *sources, prefix="xsltea:"):
         super().__init__()
         self._sources = sources
         self._prefix = prefix
-        self._parser = etree.XMLParser()
-        self._parser.resolvers.add(self)
+        self._parsers = PerThread(self._make_parser)
+        self._tracking = threading.local()
+
+    def _make_parser(self):
+        parser = etree.XMLParser()
+        parser.resolvers.add(self)
+        return parser
+
+    @property
+    def _parser(self):
+        return self._parsers.get()
 
     def get_filelike(self, filename, binary=True):
         for source in self._sources:
@@ -487,11 +680,46 @@ class PathResolver(etree.Resolver):
         else:
             raise FileNotFoundError(filename)
 
+    def get_mtime(self, filename):
+        for source in self._sources:
+            try:
+                return source.get_mtime(filename)
+            except FileNotFoundError:
+                continue
+            except OSError as err:
+                logger.warning("while searching for xslt dependency %s: %s",
+                               filename, err)
+                continue
+        else:
+            raise FileNotFoundError(filename)
+
+    @contextlib.contextmanager
+    def track_resolved(self):
+        """
+        Collect the names of all files resolved by the current thread while the
+        context is active in the set returned by the context manager.
+        """
+        try:
+            stack = self._tracking.stack
+        except AttributeError:
+            stack = []
+            self._tracking.stack = stack
+
+        resolved = set()
+        stack.append(resolved)
+        try:
+            yield resolved
+        finally:
+            stack.pop()
+
     def resolve(self, url, pubid, context):
         if url.startswith(self._prefix):
             logger.debug("resolving %s", url)
             filename = url[len(self._prefix):]
-            return self.resolve_file(self.get_filelike(filename, binary=True))
+            for resolved in getattr(self._tracking, "stack", ()):
+                resolved.add(filename)
+            return self.resolve_file(self.get_filelike(filename, binary=True),
+                                     context)
 
 class Transform(metaclass=abc.ABCMeta):
     @abc.abstractmethod
@@ -499,17 +727,108 @@ class Transform(metaclass=abc.ABCMeta):
         return tree
 
 class XSLTransform(Transform):
+    """
+    Apply the XSL stylesheet read from *filelike* using *parser*. The stylesheet
+    is compiled separately for each thread using the transform, as XSLT
+    objects must not be shared between threads.
+    """
+
     def __init__(self, parser, filelike):
-        self._xslt = etree.XSLT(etree.parse(filelike, parser=parser))
+        self._stylesheet = etree.parse(filelike, parser=parser)
+        self._xslt = PerThread(functools.partial(etree.XSLT, self._stylesheet))
+        # compile right away to report errors in the stylesheet early
+        self._xslt.get()
 
     def transform(self, tree, arguments):
-        return self._xslt.apply(tree, **arguments)
+        return self._xslt.get().apply(tree, **arguments)
 
 class TransformLoader:
-    def __init__(self, *sources, **kwargs):
+    """
+    Load XSL transforms from the given *sources*. Stylesheets can import other
+    stylesheets from the sources by prefixing their name with ``xsltea:``.
+
+    Loaded transforms are cached. If *check_interval* is not :data:`None`, the
+    sources of a cached transform and of all stylesheets it imports are
+    checked for modifications whenever the transform is requested, but at most
+    once every *check_interval* seconds. Modified transforms are loaded again.
+    Sources which cannot provide modification timestamps are compared by
+    content.
+    """
+
+    def __init__(self, *sources, check_interval=None, **kwargs):
         super().__init__(**kwargs)
         self._resolver = PathResolver(*sources)
+        self._check_interval = check_interval
+        self._cache = {}
+        self._lock = threading.RLock()
+
+    def _get_stamp(self, name):
+        mtime = self._resolver.get_mtime(name)
+        if mtime is not None:
+            return mtime
+        with self._resolver.get_filelike(name) as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def _changed(self, stamps):
+        for name, stamp in stamps.items():
+            try:
+                if self._get_stamp(name) != stamp:
+                    return True
+            except FileNotFoundError:
+                return True
+        return False
 
     def load_transform(self, name, cls=XSLTransform):
-        return cls(self._resolver._parser,
-                   self._resolver.get_filelike(name))
+        """
+        Return the transform of class *cls* for the stylesheet called *name*,
+        from the cache if possible.
+        """
+        key = (name, cls)
+        with self._lock:
+            try:
+                transform, stamps, checked = self._cache[key]
+            except KeyError:
+                transform = None
+            else:
+                now = time.monotonic()
+                if (self._check_interval is not None and
+                        now - checked >= self._check_interval):
+                    if self._changed(stamps):
+                        transform = None
+                    else:
+                        self._cache[key][2] = now
+
+            if transform is None:
+                stamps = {name: self._get_stamp(name)}
+                with self._resolver.track_resolved() as resolved:
+                    with self._resolver.get_filelike(name) as f:
+                        transform = cls(self._resolver._parser, f)
+                for dependency in resolved:
+                    stamps[dependency] = self._get_stamp(dependency)
+                self._cache[key] = [transform, stamps, time.monotonic()]
+
+            return transform
+
+    def get_dependencies(self, name):
+        """
+        Return the set of names of the stylesheets imported by the cached
+        transforms for the stylesheet called *name*.
+        """
+        with self._lock:
+            return {
+                dependency
+                for (other_name, _), (_, stamps, _) in self._cache.items()
+                if other_name == name
+                for dependency in stamps
+                if dependency != name
+            }
+
+    def invalidate(self, name):
+        """
+        Drop all cached transforms for the stylesheet called *name* and for all
+        stylesheets importing it.
+        """
+        with self._lock:
+            for key, (_, stamps, _) in list(self._cache.items()):
+                if name in stamps:
+                    del self._cache[key]
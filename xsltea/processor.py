@@ -181,3 +181,47 @@ class TemplateProcessor:
         bootstrap and before any element code in the document code.
         """
         return []
+
+    def get_fingerprint(self):
+        """
+        Return a string which identifies the configuration of this processor.
+        It is used as part of the key under which compiled templates are
+        persisted (see :mod:`xsltea.bytecode`); whenever the processor would
+        generate different code for the same template, the fingerprint must
+        change.
+
+        The default implementation combines the class name with the values of
+        all instance attributes of primitive types. For all other attributes,
+        only the type name is used.
+        """
+        attrs = []
+        for name, value in sorted(vars(self).items()):
+            if not isinstance(value, (str, int, float, bool, type(None))):
+                value = type(value).__qualname__
+            attrs.append("{}={!r}".format(name, value))
+        return "{}.{}({})".format(
+            type(self).__module__,
+            type(self).__qualname__,
+            ", ".join(attrs))
+
+    def get_persistent_objects(self):
+        """
+        Return a dictionary of objects which may end up in the storage of a
+        template, but which must not be serialised when the template is
+        persisted. Instead, the objects are looked up by their key in this
+        dictionary when the template is restored.
+        """
+        return {}
+
+    def get_template_state(self, template):
+        """
+        Return the per-template state the processor keeps for *template*, which
+        must be restored along with a persisted template, or :data:`None`.
+        """
+        return None
+
+    def set_template_state(self, template, state):
+        """
+        Restore the *state* obtained from :meth:`get_template_state` for the
+        restored *template*.
+        """
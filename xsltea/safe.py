@@ -10,6 +10,11 @@ called.
 
 .. autoclass:: IncludeProcessor
 
+.. autoclass:: CacheProcessor
+
+.. autoclass:: FragmentCache
+   :members:
+
 To specify the safety level used for template evaluation of the different
 available processors, the values of the :class:`SafetyLevel` enum can be used:
 
@@ -19,14 +24,19 @@ available processors, the values of the :class:`SafetyLevel` enum can be used:
 import abc
 import ast
 import collections
+import copy
 import functools
 import logging
+import marshal
+import threading
+import time
 import weakref
 
 import lxml.etree as etree
 
 import xsltea.errors
 import xsltea.exec
+import xsltea.stream
 import xsltea.template
 from .processor import TemplateProcessor
 from .namespaces import shared_ns
@@ -49,6 +59,9 @@ class SafetyLevel:
 
     safety = None
 
+    def __init__(self):
+        self._verified = set()
+
     def __lt__(self, other):
         return self.safety < other.safety
 
@@ -85,12 +98,29 @@ class SafetyLevel:
                              " safety restrictions ({!s})".format(self))
 
     def check_code_safety(self, src, mode="exec"):
-        nodes = compile(src, "", mode, ast.PyCF_ONLY_AST).body
+        self.compile_expression(src, "", mode)
+
+    def compile_expression(self, src, filename, mode="eval"):
+        """
+        Parse *src* in the given *mode* (as with :func:`compile`), check the
+        result for safety and return the body of the resulting AST. Raises
+        :class:`ValueError` if it is not considered safe.
+
+        Sources which have passed the check are remembered, so that expressions
+        occuring many times throughout the templates are only checked once. The
+        AST is still created anew on each call, as callers may modify it.
+        """
+        nodes = compile(src, filename, mode, ast.PyCF_ONLY_AST).body
+        key = (src, mode)
+        if key in self._verified:
+            return nodes
         if mode == "exec":
             for item in nodes:
                 self.check_safety(item)
         else:
             self.check_safety(nodes)
+        self._verified.add(key)
+        return nodes
 
     def compile_ast(self, ast, filename, mode):
         """
@@ -500,6 +530,12 @@ class ForeachProcessor(TemplateProcessor):
     The elements are returned and inserted at the place where the
     ``tea:for-each`` element was.
 
+    If *bulk_rows* is true, loops whose body only contains plain elements, text
+    produced by ``exec:text`` and attributes produced by ``exec:*`` attributes
+    are compiled into a :class:`~xsltea.stream.RowTemplate` (see
+    :meth:`create_bulk_foreach`). This is considerably cheaper for loops over
+    many items, like the rows of large tables.
+
     The :class:`ForeachProcessor` requires the
     :class:`~xsltea.exec.ScopeProcessor` and is executed after the
     :class:`~xsltea.exec.ExecProcessor` (if it is loaded).
@@ -511,9 +547,12 @@ class ForeachProcessor(TemplateProcessor):
     xmlns = shared_ns
     namespaces = {"tea": str(xmlns)}
 
-    def __init__(self, safety_level=SafetyLevel.conservative, **kwargs):
+    def __init__(self, safety_level=SafetyLevel.conservative,
+                 bulk_rows=True,
+                 **kwargs):
         super().__init__(**kwargs)
         self._safety_level = safety_level
+        self.bulk_rows = bulk_rows
         self.attrhooks = {}
         self.elemhooks = {
             (str(self.xmlns), "for-each"): [self.handle_foreach]}
@@ -576,6 +615,177 @@ def _():
 
         return precode, elemcode, []
 
+    @staticmethod
+    def _is_hook(hooks, func):
+        return (len(hooks) == 1 and
+                getattr(hooks[0], "__func__", None) is func)
+
+    @staticmethod
+    def _lookup_row_hooks(lookup, *args):
+        try:
+            return lookup(*args)
+        except KeyError:
+            return []
+
+    @classmethod
+    def _is_exec_text(cls, template, elem, context):
+        return isinstance(elem.tag, str) and cls._is_hook(
+            cls._lookup_row_hooks(template.lookup_hook,
+                                  context.elemhooks, elem.tag),
+            xsltea.exec.ExecProcessor.handle_exec_text)
+
+    @staticmethod
+    def _compose_row_text(parts, context):
+        value = compile('"".join(())',
+                        context.filename,
+                        "eval",
+                        ast.PyCF_ONLY_AST).body
+        for part in parts:
+            if isinstance(part, ast.AST):
+                str_call = compile("str(_)",
+                                   context.filename,
+                                   "eval",
+                                   ast.PyCF_ONLY_AST).body
+                str_call.args[0] = part
+                value.args[0].elts.append(str_call)
+            elif part:
+                value.args[0].elts.append(
+                    ast.Str(part, lineno=1, col_offset=0))
+        return value
+
+    @classmethod
+    def _compile_row_text(cls, target, kind, path, parts, slots, context):
+        if not any(isinstance(part, ast.AST) for part in parts):
+            return
+        setattr(target, kind, None)
+        slots.append(((path, kind, None),
+                      cls._compose_row_text(parts, context)))
+
+    @classmethod
+    def _compile_row_elem(cls, template, elem, path, slots, context):
+        if not isinstance(elem.tag, str):
+            return True
+
+        if cls._lookup_row_hooks(template.lookup_hook,
+                                 context.elemhooks, elem.tag):
+            return False
+
+        for key, value in list(elem.attrib.items()):
+            hooks = cls._lookup_row_hooks(template.lookup_attrhook,
+                                          context.attrhooks, elem.tag, key)
+            if not hooks:
+                continue
+            if not cls._is_hook(
+                    hooks,
+                    xsltea.exec.ExecProcessor.handle_exec_any_attribute):
+                return False
+            value_ast = compile(value,
+                                context.filename,
+                                "eval",
+                                ast.PyCF_ONLY_AST).body
+            if isinstance(value_ast, ast.Tuple):
+                return False
+            del elem.attrib[key]
+            slots.append(((path, "attr", key.split("}", 1)[1]), value_ast))
+
+        target, kind, target_path = elem, "text", path
+        parts = [elem.text]
+        index = 0
+        for child in list(elem):
+            if cls._is_exec_text(template, child, context):
+                if len(child) or len(child.attrib) or not child.text:
+                    return False
+                parts.append(compile(child.text,
+                                     context.filename,
+                                     "eval",
+                                     ast.PyCF_ONLY_AST).body)
+                parts.append(child.tail)
+                elem.remove(child)
+                continue
+
+            cls._compile_row_text(target, kind, target_path, parts, slots,
+                                  context)
+            child_path = path + (index,)
+            if not cls._compile_row_elem(template, child, child_path, slots,
+                                         context):
+                return False
+            target, kind, target_path = child, "tail", child_path
+            parts = [child.tail]
+            index += 1
+
+        cls._compile_row_text(target, kind, target_path, parts, slots,
+                              context)
+        return True
+
+    @classmethod
+    def create_bulk_foreach(cls, template, elem, context, offset,
+                            bind_ast, iter_ast):
+        """
+        Like :meth:`create_foreach`, but compile the loop body into a
+        :class:`~xsltea.stream.RowTemplate`, which is filled for each item
+        instead of creating the elements one by one.
+
+        This is only possible if the body consists of elements whose only
+        dynamic parts are ``exec:text`` elements and ``exec:*`` attributes. If
+        the body contains anything else, or does not contain anything dynamic
+        at all, :data:`None` is returned.
+        """
+        prototypes = []
+        slots = []
+        for i, child in enumerate(elem):
+            if cls._is_exec_text(template, child, context):
+                return None
+            prototype = copy.deepcopy(child)
+            if not cls._compile_row_elem(template, prototype, (i,), slots,
+                                         context):
+                return None
+            etree.cleanup_namespaces(prototype)
+            prototypes.append(prototype)
+
+        if not slots:
+            return None
+
+        sourceline = elem.sourceline or 0
+        rows = xsltea.stream.RowTemplate(
+            prototypes,
+            [slot for slot, _ in slots])
+
+        elemcode = compile("""\
+def _():
+    for _ in _:
+        yield ''
+        yield from _rows.fill(context.nsmaps, _values)""",
+                           context.filename,
+                           "exec",
+                           ast.PyCF_ONLY_AST).body[0].body
+
+        loop = elemcode[0]
+        loop.iter = iter_ast
+        loop.target = bind_ast
+        loop.body = [
+            xsltea.template.replace_ast_names(stmt, {
+                "_rows": template.ast_get_stored(
+                    template.store(rows), sourceline),
+                "_values": ast.Tuple(
+                    [value for _, value in slots],
+                    ast.Load(),
+                    lineno=sourceline,
+                    col_offset=0),
+            })
+            for stmt in loop.body
+        ]
+
+        if elem.text:
+            loop.body[0].value.value = ast.Str(elem.text,
+                                               lineno=sourceline,
+                                               col_offset=0)
+        else:
+            del loop.body[0]
+
+        elemcode.extend(template.preserve_tail_code(elem, context))
+
+        return [], elemcode, []
+
     def handle_foreach(self, template, elem, context, offset):
         try:
             from_ = elem.attrib["from"]
@@ -590,12 +800,15 @@ def _():
                            ast.PyCF_ONLY_AST).body
         self._prepare_bind_tree(bind_ast)
 
-        iter_ast = compile(from_,
-                           context.filename,
-                           "eval",
-                           ast.PyCF_ONLY_AST).body
+        iter_ast = self._safety_level.compile_expression(from_,
+                                                         context.filename)
 
-        self._safety_level.check_safety(iter_ast)
+        if self.bulk_rows:
+            code = self.create_bulk_foreach(
+                template, elem, context, offset,
+                bind_ast, iter_ast)
+            if code is not None:
+                return code
 
         return self.create_foreach(
             template, elem, context, offset,
@@ -637,7 +850,7 @@ class IncludeProcessor(TemplateProcessor):
 
     def __init__(self, override_loader=None, **kwargs):
         super().__init__(**kwargs)
-        self._override_loader = None
+        self._override_loader = override_loader
 
         self.attrhooks = {}
         self.elemhooks = {
@@ -661,9 +874,27 @@ class IncludeProcessor(TemplateProcessor):
                                  " present")
             loader = template.loader
 
+        namespaces = ast.literal_eval(nsmap)
+        partial = loader.get_partial(source, xpath, namespaces)
+        if partial is not None:
+            sourceline = elem.sourceline or 0
+            elemcode = compile("""\
+def _():
+    yield from _partial(context, arguments)""",
+                               context.filename,
+                               "exec",
+                               ast.PyCF_ONLY_AST).body[0].body
+            elemcode = [
+                xsltea.template.replace_ast_names(stmt, {
+                    "_partial": template.ast_get_stored(
+                        template.store(partial), sourceline)
+                })
+                for stmt in elemcode
+            ]
+            return [], elemcode, []
+
         tree = loader.get_template(source).tree
-        elements = tree.xpath(xpath,
-                              namespaces=ast.literal_eval(nsmap))
+        elements = tree.xpath(xpath, namespaces=namespaces)
 
         offset = (offset+1) * 1000000
 
@@ -729,6 +960,15 @@ class FunctionProcessor(TemplateProcessor):
     the elements text, which is evaluated with the *safety_level* of the
     processsor.
 
+    Functions defined in another template can be called by passing the name of
+    that template in the ``@src`` attribute of ``tea:call``. In addition, the
+    names of templates acting as macro library can be passed as *libraries*.
+    A ``tea:call`` without ``@src`` which refers to a function not defined in
+    the calling template looks the function up in these templates, in the
+    given order. Library templates are loaded through the loader of the
+    calling template and are thus compiled only once; the call itself is
+    resolved when the calling template is compiled.
+
     For more usage examples see the tests.
     """
 
@@ -764,12 +1004,9 @@ class FunctionProcessor(TemplateProcessor):
                     default = ast.literal_eval(default)
                     static_defaults[argname] = default
                 else:
-                    default = compile(
+                    default = safety_level.compile_expression(
                         default,
-                        context.filename,
-                        "eval",
-                        ast.PyCF_ONLY_AST).body
-                    safety_level.check_safety(default)
+                        context.filename)
                     lazy_defaults[argname] = default
 
             self.name = name
@@ -794,10 +1031,30 @@ def func(utils, context, {}):
 
             def_code = compile(def_ast, context.filename, "exec")
             exec(def_code, globals_dict, locals_dict)
+            self._code = def_code
             self._func = functools.partial(
                 locals_dict["func"],
                 template.utils)
 
+        def __getstate__(self):
+            state = self.__dict__.copy()
+            state["_prototype"] = None
+            func = state.pop("_func", None)
+            if func is not None:
+                state["_code"] = marshal.dumps(self._code)
+                state["_utils"] = func.args[0]
+            return state
+
+        def __setstate__(self, state):
+            utils = state.pop("_utils", None)
+            self.__dict__.update(state)
+            if utils is not None:
+                self._code = marshal.loads(self._code)
+                locals_dict = {}
+                exec(self._code, dict(globals()), locals_dict)
+                self._func = functools.partial(
+                    locals_dict["func"],
+                    utils)
 
         def compose_call(self, template, argumentmap, context, sourceline):
             arguments = {}
@@ -857,10 +1114,12 @@ def func(utils, context, {}):
     def __init__(self,
                  safety_level=SafetyLevel.conservative,
                  override_loader=None,
+                 libraries=(),
                  **kwargs):
         super().__init__(**kwargs)
         self._safety_level = safety_level
         self._override_loader = override_loader
+        self.libraries = list(libraries)
         self.attrhooks = {}
         self.elemhooks = {
             (str(self.xmlns), "def"): [self.handle_def],
@@ -877,6 +1136,40 @@ def func(utils, context, {}):
             ],
         }
 
+    def get_fingerprint(self):
+        return "{}[{}]".format(
+            super().get_fingerprint(),
+            ", ".join(self.libraries))
+
+    def get_template_state(self, template):
+        return self.template_libraries.get(template)
+
+    def set_template_state(self, template, state):
+        if state is not None:
+            self.template_libraries[template] = state
+
+    def _get_loader(self, template):
+        loader = self._override_loader
+        if loader is None:
+            if getattr(template, "loader", None) is None:
+                raise ValueError("Cannot call function from other template:"
+                                 " no loader specified for current template"
+                                 " and no override present")
+            loader = template.loader
+        return loader
+
+    def _lookup_library_function(self, template, name):
+        for library_name in self.libraries:
+            if library_name == template.filename:
+                continue
+            library_template = self._get_loader(template).get_template(
+                library_name)
+            try:
+                return self.template_libraries[library_template][name]
+            except KeyError:
+                pass
+        return None
+
     def handle_use_outside_def_or_call(self, legitimate,
                                        template, elem, context, offset):
         raise ValueError("tea:{} was used outside {}".format(
@@ -975,14 +1268,7 @@ def func(utils, context, {}):
                              " @tea:{}".format(str(err).split("}")[1]))
 
         if source is not None:
-            loader = self._override_loader
-            if loader is None:
-                if not hasattr(template, "loader"):
-                    raise ValueError("Cannot call function from other template:"
-                                     " no loader specified for current template"
-                                     " and no override present")
-                loader = template.loader
-            source_template = loader.get_template(source)
+            source_template = self._get_loader(template).get_template(source)
         else:
             source_template = template
 
@@ -994,7 +1280,8 @@ def func(utils, context, {}):
             if source is not None:
                 raise ValueError("Function {} is not defined in {}".format(
                     str(err), source))
-            else:
+            func = self._lookup_library_function(template, name)
+            if func is None:
                 raise ValueError("Function {} is not defined in this"
                                  " template".format(str(err)))
 
@@ -1021,11 +1308,9 @@ def func(utils, context, {}):
                 raise ValueError("Text of tea:pass must be non-empty and a valid"
                                  " expression")
 
-            value_ast = compile(child.text,
-                                context.filename,
-                                "eval",
-                                ast.PyCF_ONLY_AST).body
-            self._safety_level.check_safety(value_ast)
+            value_ast = self._safety_level.compile_expression(
+                child.text,
+                context.filename)
             arguments[name] = value_ast
 
         elemcode = func.compose_call(template,
@@ -1049,6 +1334,14 @@ class GlobalsProcessor(TemplateProcessor):
         self.elemhooks = {}
         self.names = {}
 
+    def get_fingerprint(self):
+        return "{}[{}]".format(
+            super().get_fingerprint(),
+            ", ".join(sorted(self.names)))
+
+    def get_persistent_objects(self):
+        return self.names
+
     def global_precode(self, template):
         for name, value in self.names.items():
             key = template.store(value)
@@ -1063,3 +1356,216 @@ class GlobalsProcessor(TemplateProcessor):
                 template.ast_get_stored(key, 0),
                 lineno=0,
                 col_offset=0)
+
+class FragmentCache:
+    """
+    A bounded, thread-safe cache for rendered template fragments, as used by
+    the :class:`CacheProcessor`. At most *max_size* fragments are kept; if the
+    cache is full, the least recently used fragment is dropped.
+
+    .. attribute:: hits
+
+       The number of lookups which were answered from the cache.
+
+    .. attribute:: misses
+
+       The number of lookups which required the fragment to be rendered.
+    """
+
+    def __init__(self, max_size=1024, clock=time.monotonic):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Return the fragment stored under *key*, or :data:`None` if there is
+        none or it has expired. Updates the :attr:`hits` and :attr:`misses`
+        counters.
+        """
+        with self._lock:
+            try:
+                expires, fragment = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires is not None and expires <= self._clock():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return fragment
+
+    def put(self, key, fragment, ttl=None):
+        """
+        Store *fragment* under *key*. If *ttl* is not :data:`None`, the
+        fragment expires after *ttl* seconds.
+        """
+        expires = None if ttl is None else self._clock() + ttl
+        with self._lock:
+            self._entries[key] = expires, fragment
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Drop all fragments and reset the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def fetch(self, key, ttl, text, childfun, utils):
+        """
+        Yield copies of the nodes of the fragment stored under *key*. If the
+        fragment is not cached, it is rendered from the leading *text* and the
+        children function *childfun* and stored for *ttl* seconds.
+
+        This is called from the code generated by :class:`CacheProcessor`.
+        """
+        fragment = self.get(key)
+        if fragment is None:
+            fragment = etree.Element("fragment")
+            fragment.text = text or None
+            utils.materialize_children(fragment, childfun())
+            self.put(key, fragment, ttl)
+
+        if fragment.text:
+            yield fragment.text
+        for child in fragment:
+            yield copy.deepcopy(child)
+
+    def __getstate__(self):
+        return self.max_size, self._clock
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+def _localizer_key(localizer):
+    # localizers compare equal regardless of their timezone
+    if localizer is None:
+        return None
+    return localizer, localizer.timezone
+
+class CacheProcessor(TemplateProcessor):
+    """
+    The processor for the ``tea:cache`` xml element keeps the rendered content
+    of the element in a :class:`FragmentCache`, so that expensive fragments are
+    evaluated only once::
+
+        <tea:cache key="arguments['category']" ttl="300">
+          <!-- sidebar -->
+        </tea:cache>
+
+    The optional ``@key`` attribute is a python expression, which is evaluated
+    using the given *safety_level* in the scope of the ``tea:cache`` element.
+    Its value must be hashable; the content is cached separately for each
+    value. The cached content is reused for *ttl* seconds, or until it is
+    dropped from the cache, if ``@ttl`` is not given and *default_ttl* is
+    :data:`None`.
+
+    The content is also cached separately for each localizer provided by the
+    :class:`~xsltea.i18n.I18NProcessor` (the name of the variable in the
+    ``context`` object can be customized with *localizer_varname*) and its
+    timezone, so that translated content is never reused for a different
+    locale or timezone.
+
+    The *cache* defaults to a new :class:`FragmentCache` holding up to
+    *max_size* fragments; it is available as :attr:`cache`.
+    """
+
+    xmlns = shared_ns
+    namespaces = {"tea": str(xmlns)}
+
+    def __init__(self,
+                 safety_level=SafetyLevel.conservative,
+                 cache=None,
+                 max_size=1024,
+                 default_ttl=None,
+                 localizer_varname="i18n",
+                 **kwargs):
+        super().__init__(**kwargs)
+        self._safety_level = safety_level
+        self.cache = cache if cache is not None else FragmentCache(max_size)
+        self.default_ttl = default_ttl
+        self.localizer_varname = localizer_varname
+        self.attrhooks = {}
+        self.elemhooks = {
+            (str(self.xmlns), "cache"): [self.handle_cache]}
+
+    def get_persistent_objects(self):
+        return {"cache": self.cache}
+
+    def handle_cache(self, template, elem, context, offset):
+        sourceline = elem.sourceline or 0
+
+        try:
+            ttl = float(elem.attrib["ttl"])
+        except KeyError:
+            ttl = self.default_ttl
+        except ValueError as err:
+            raise template.compilation_error(
+                "invalid value for tea:cache/@ttl: {}".format(err),
+                context,
+                sourceline)
+
+        try:
+            key = elem.attrib["key"]
+        except KeyError:
+            key_ast = ast.NameConstant(None, lineno=sourceline, col_offset=0)
+        else:
+            key_ast = self._safety_level.compile_expression(key,
+                                                            context.filename)
+
+        childfun_name = "children{}".format(offset)
+        precode = template.compose_childrenfun(elem, context, childfun_name)
+        if not precode:
+            # nothing to be gained from caching plain text
+            elemcode = []
+            if elem.text:
+                elemcode.append(template.ast_yield(
+                    ast.Str(elem.text, lineno=sourceline, col_offset=0),
+                    sourceline))
+            elemcode.extend(template.preserve_tail_code(elem, context))
+            return [], elemcode, []
+
+        # the token distinguishes this element from all other cached elements
+        token_key = template.store(object())
+
+        elemcode = compile("""\
+def _():
+    yield from _cache.fetch(
+        (_token, _key, frozenset(context.nsmaps),
+         _localizer_key(getattr(context, _varname, None))),
+        _ttl, _text, {}, utils)""".format(childfun_name),
+                           context.filename,
+                           "exec",
+                           ast.PyCF_ONLY_AST).body[0].body
+        elemcode = [
+            xsltea.template.replace_ast_names(stmt, {
+                "_cache": template.ast_get_stored(
+                    template.store(self.cache), sourceline),
+                "_token": template.ast_get_stored(token_key, sourceline),
+                "_localizer_key": template.ast_get_stored(
+                    template.store(_localizer_key), sourceline),
+                "_key": key_ast,
+                "_varname": self.localizer_varname,
+                "_text": elem.text or "",
+                "_ttl": ast.NameConstant(ttl, lineno=sourceline, col_offset=0)
+                        if ttl is None
+                        else ast.Num(ttl, lineno=sourceline, col_offset=0),
+            })
+            for stmt in elemcode
+        ]
+        elemcode.extend(template.preserve_tail_code(elem, context))
+
+        return precode, elemcode, []
@@ -245,26 +245,20 @@ yield elem""",
 
         my_context = Context()
         my_context.named_columns = named_columns
-        my_context.pageobj_ast = compile(pageobj,
-                                         context.filename,
-                                         "eval",
-                                         ast.PyCF_ONLY_AST).body
-        self._safety_level.check_safety(my_context.pageobj_ast)
-        my_context.viewobj_ast = compile(viewobj,
-                                         context.filename,
-                                         "eval",
-                                         ast.PyCF_ONLY_AST).body
-        self._safety_level.check_safety(my_context.viewobj_ast)
+        my_context.pageobj_ast = self._safety_level.compile_expression(
+            pageobj,
+            context.filename)
+        my_context.viewobj_ast = self._safety_level.compile_expression(
+            viewobj,
+            context.filename)
 
         if href_generator is not None:
             if self._safety_level != xsltea.safe.SafetyLevel.unsafe:
                 raise ValueError("tea:href is not allowed in non-unsafe mode.")
 
-            href_eval = compile(href_generator,
-                                context.filename,
-                                "eval",
-                                ast.PyCF_ONLY_AST).body
-            self._safety_level.check_safety(href_eval)
+            href_eval = self._safety_level.compile_expression(
+                href_generator,
+                context.filename)
         else:
             href_eval = template.ast_get_href(sourceline)
 
@@ -0,0 +1,478 @@
+"""
+``xsltea.stream`` – Incremental serialisation of templates
+###########################################################
+
+By default, a template is evaluated into a complete element tree, which is then
+serialised as a whole. For large documents, this keeps the whole document in
+memory (twice) and delays the first byte until the complete document has been
+built.
+
+:meth:`xsltea.template.Template.stream` offers an alternative: the children of
+elements are not appended to their parents, but evaluated lazily while the
+document is written. Each element is serialised as soon as it has been created
+and dropped afterwards, so that the encoded document is produced in chunks.
+
+Code which needs to inspect the children of an element it creates (e.g. the
+:class:`~xsltea.i18n.I18NProcessor`) must use the ``materialize_children``
+template utility instead of ``append_children``, which always builds the
+complete subtree.
+
+Streaming cannot be combined with XSL transformations, which require the
+complete tree. See the *streaming* option of
+:class:`~xsltea.pipeline.XMLPipeline` for use in pipelines.
+
+.. autoclass:: Serialiser
+
+.. autoclass:: TemplateStream
+
+.. autoclass:: StaticFragment
+
+.. autoclass:: RowTemplate
+
+"""
+
+import contextlib
+import copy
+import itertools
+import threading
+
+import lxml.etree as etree
+
+from .errors import TemplateEvaluationError
+
+xhtml_namespace = "http://www.w3.org/1999/xhtml"
+xml_namespace = "http://www.w3.org/XML/1998/namespace"
+
+_state = threading.local()
+
+def get_deferred():
+    """
+    Return the dictionary of deferred children for the render currently active
+    in this thread, or :data:`None` if children are to be appended immediately.
+    """
+    return getattr(_state, "deferred", None)
+
+@contextlib.contextmanager
+def render_mode(deferred):
+    """
+    Activate the given dictionary of *deferred* children for the current
+    thread. Passing :data:`None` enforces that children are appended
+    immediately.
+
+    This must only be held while template code is being executed and never
+    across a ``yield`` which returns control to code outside the render.
+    """
+    prev = getattr(_state, "deferred", None)
+    _state.deferred = deferred
+    try:
+        yield
+    finally:
+        _state.deferred = prev
+
+class StaticFragment:
+    """
+    A subtree of a template which contains no dynamic content and is thus built
+    only once, at compile time (see
+    :meth:`xsltea.template.Template.static_subtree`).
+
+    :meth:`clone` returns a copy of the *prototype* element. During a streaming
+    render, the :class:`Serialiser` writes the clone from a cache of
+    pre-serialised fragments instead of walking it.
+    """
+
+    def __init__(self, prototype):
+        self.prototype = prototype
+        self.fragments = {}
+        self.variants = {}
+
+    @classmethod
+    def _rebuild(cls, elem, nsmaps, parent_ns):
+        if not isinstance(elem.tag, str):
+            return copy.deepcopy(elem)
+
+        ns, _ = _split_tag(elem.tag)
+        nsmap = nsmaps.get(ns) if ns != parent_ns else None
+        result = etree.Element(elem.tag, elem.attrib, nsmap)
+        result.text = elem.text
+        result.tail = elem.tail
+        for child in elem:
+            result.append(cls._rebuild(child, nsmaps, ns))
+        return result
+
+    def get_prototype(self, nsmaps):
+        """
+        Return the prototype with each subtree in one of the namespaces in
+        *nsmaps* declaring the respective namespace map (see
+        :meth:`xsltea.template.Template.process`). The variants are built once
+        and kept.
+        """
+        if not nsmaps:
+            return self.prototype
+
+        key = frozenset(nsmaps)
+        try:
+            return self.variants[key]
+        except KeyError:
+            pass
+        prototype = self._rebuild(self.prototype, nsmaps, None)
+        self.variants[key] = prototype
+        return prototype
+
+    def clone(self, nsmaps=None):
+        elem = copy.deepcopy(self.get_prototype(nsmaps))
+        deferred = get_deferred()
+        if deferred is not None:
+            deferred[elem] = self
+        return elem
+
+    def __getstate__(self):
+        return (etree.tostring(self.prototype, with_tail=False),
+                self.prototype.tail)
+
+    def __setstate__(self, state):
+        data, tail = state
+        self.prototype = etree.fromstring(data)
+        self.prototype.tail = tail
+        self.fragments = {}
+        self.variants = {}
+
+class RowTemplate:
+    """
+    The body of a loop whose only dynamic parts are texts and attribute values
+    (see :meth:`xsltea.safe.ForeachProcessor.create_bulk_foreach`). The
+    elements of the body are built once as *prototypes*; :meth:`fill` copies
+    them and puts the values of a single iteration into the *slots*.
+
+    Each slot is a tuple ``(path, kind, key)``. *path* is the tuple of indices
+    leading to the element, starting with the index of the prototype. *kind*
+    is one of ``"text"``, ``"tail"`` or ``"attr"``; *key* is the name of the
+    attribute for the latter and :data:`None` otherwise.
+    """
+
+    def __init__(self, prototypes, slots):
+        self.fragments = [StaticFragment(prototype)
+                          for prototype in prototypes]
+        self.slots = slots
+
+    def fill(self, nsmaps, values):
+        """
+        Return a list of copies of the prototypes (see
+        :meth:`StaticFragment.get_prototype` for *nsmaps*), with the *values*
+        assigned to the slots. Attribute slots whose value is :data:`None` are
+        left unset.
+        """
+        row = [copy.deepcopy(fragment.get_prototype(nsmaps))
+               for fragment in self.fragments]
+        for (path, kind, key), value in zip(self.slots, values):
+            elem = row[path[0]]
+            for index in path[1:]:
+                elem = elem[index]
+            if kind == "text":
+                elem.text = value
+            elif kind == "tail":
+                elem.tail = value
+            elif value is not None:
+                elem.set(key, str(value))
+        return row
+
+def escape_text(s):
+    return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def escape_attr(s):
+    return escape_text(s).replace('"', "&quot;").replace(
+        "\n", "&#10;").replace("\r", "&#13;").replace("\t", "&#9;")
+
+def _split_tag(tag):
+    if tag[0] == "{":
+        ns, name = tag[1:].split("}", 1)
+        return ns, name
+    return None, tag
+
+class _Output:
+    def __init__(self):
+        self.pieces = []
+        self.size = 0
+
+    def write(self, s):
+        self.pieces.append(s)
+        self.size += len(s)
+
+    def take(self):
+        data = "".join(self.pieces)
+        self.pieces.clear()
+        self.size = 0
+        return data
+
+class Serialiser:
+    """
+    Serialise an element tree whose children may be deferred (see
+    :meth:`xsltea.template.Template.stream`) into chunks of encoded bytes.
+
+    *method* must be either ``"xml"`` or ``"html"``. With the html method, void
+    elements are written without end tag, the contents of ``script`` and
+    ``style`` elements are not escaped and no XML declaration is written by
+    default.
+
+    The document is encoded using *encoding*; characters which cannot be
+    represented are written as character references. If *xml_declaration* is
+    true, an XML declaration is written; the default depends on the *method*.
+    A *doctype* string is written before the root element, if given.
+
+    Elements in one of the namespaces in *default_namespaces* are written
+    without a prefix, by declaring their namespace as default namespace.
+    Otherwise, the prefixes chosen by lxml are used.
+
+    Data is passed on in chunks of at least *chunk_size* characters.
+    """
+
+    html_void_elements = frozenset([
+        "area", "base", "br", "col", "embed", "hr", "img", "input", "link",
+        "meta", "param", "source", "track", "wbr",
+    ])
+
+    html_raw_text_elements = frozenset([
+        "script", "style",
+    ])
+
+    def __init__(self, method="xml", encoding="utf-8",
+                 xml_declaration=None,
+                 doctype=None,
+                 default_namespaces=(),
+                 chunk_size=8192):
+        if method not in ("xml", "html"):
+            raise ValueError("unsupported method: {}".format(method))
+        self.method = method
+        self.encoding = encoding
+        if xml_declaration is None:
+            xml_declaration = method == "xml"
+        self.xml_declaration = xml_declaration
+        self.doctype = doctype
+        self.default_namespaces = frozenset(default_namespaces)
+        self.chunk_size = chunk_size
+
+    def _lookup_prefix(self, scope, uri, allow_default):
+        for prefix, prefix_uri in scope.items():
+            if prefix_uri != uri:
+                continue
+            if prefix is None and not allow_default:
+                continue
+            return prefix, True
+        return None, False
+
+    def _qualify(self, scope, decls, uri, name, hint, is_attr):
+        if uri is None:
+            if not is_attr and scope.get(None) is not None:
+                scope[None] = None
+                decls.append((None, ""))
+            return name
+
+        prefix, found = self._lookup_prefix(scope, uri, not is_attr)
+        if not found:
+            if not is_attr and uri in self.default_namespaces:
+                prefix = None
+            elif not is_attr and hint is None and scope.get(None) is None:
+                prefix = None
+            elif hint is not None and hint not in scope:
+                prefix = hint
+            else:
+                i = 0
+                while "ns{}".format(i) in scope:
+                    i += 1
+                prefix = "ns{}".format(i)
+            scope[prefix] = uri
+            decls.append((prefix, uri))
+
+        if prefix is None:
+            return name
+        return "{}:{}".format(prefix, name)
+
+    def _write_special(self, elem, out):
+        out.write(etree.tostring(elem,
+                                 method=self.method,
+                                 encoding=str,
+                                 with_tail=False))
+        if elem.tail:
+            out.write(escape_text(elem.tail))
+
+    def _write_element(self, elem, deferred, out, scope, raw=False):
+        tag = elem.tag
+        if not isinstance(tag, str):
+            self._write_special(elem, out)
+            yield
+            return
+
+        pending = deferred.pop(elem, None)
+        if isinstance(pending, StaticFragment):
+            key = (self.method, self.default_namespaces, raw,
+                   frozenset(scope.items()))
+            try:
+                fragment = pending.fragments[key]
+            except KeyError:
+                fragment_out = _Output()
+                for _ in self._write_element(elem, {}, fragment_out, scope,
+                                             raw):
+                    pass
+                fragment = fragment_out.take()
+                pending.fragments[key] = fragment
+            out.write(fragment)
+            yield
+            return
+
+        scope = dict(scope)
+        decls = []
+        uri, localname = _split_tag(tag)
+        name = self._qualify(scope, decls, uri, localname, elem.prefix, False)
+
+        attrs = []
+        if len(elem.attrib):
+            nsmap = None
+            for key, value in elem.attrib.items():
+                attr_uri, attr_name = _split_tag(key)
+                hint = None
+                if attr_uri is not None:
+                    if nsmap is None:
+                        nsmap = {
+                            ns: prefix
+                            for prefix, ns in elem.nsmap.items()
+                            if prefix is not None
+                        }
+                    hint = nsmap.get(attr_uri)
+                attrs.append((
+                    self._qualify(scope, decls, attr_uri, attr_name, hint,
+                                  True),
+                    value))
+
+        parts = ["<", name]
+        for prefix, decl_uri in decls:
+            if prefix is None:
+                parts.append(' xmlns="{}"'.format(escape_attr(decl_uri)))
+            else:
+                parts.append(' xmlns:{}="{}"'.format(
+                    prefix, escape_attr(decl_uri)))
+        for key, value in attrs:
+            parts.append(' {}="{}"'.format(key, escape_attr(value)))
+        start = "".join(parts)
+
+        is_html = self.method == "html"
+        if not elem.text and not len(elem) and pending is not None:
+            first = next(pending, None)
+            if first is None:
+                pending = None
+            else:
+                pending = itertools.chain((first,), pending)
+
+        if not elem.text and not len(elem) and pending is None:
+            if not is_html:
+                out.write(start + "/>")
+            elif (localname in self.html_void_elements and
+                    uri in (None, xhtml_namespace)):
+                out.write(start + ">")
+            else:
+                out.write("{}></{}>".format(start, name))
+        else:
+            out.write(start + ">")
+            raw_children = (is_html and
+                            localname in self.html_raw_text_elements)
+            if elem.text:
+                out.write(elem.text if raw_children
+                          else escape_text(elem.text))
+            yield
+
+            for child in elem:
+                yield from self._write_element(child, deferred, out, scope,
+                                               raw_children)
+
+            if pending is not None:
+                for child in pending:
+                    if isinstance(child, str):
+                        out.write(child if raw_children
+                                  else escape_text(child))
+                        continue
+                    yield from self._write_element(child, deferred, out, scope,
+                                                   raw_children)
+
+            out.write("</{}>".format(name))
+
+        if elem.tail:
+            out.write(elem.tail if raw else escape_text(elem.tail))
+        yield
+
+    def iter_document(self, root, deferred, out):
+        """
+        Write the document with the given *root* element to *out*, evaluating
+        the *deferred* children on the way. This is a generator which yields
+        whenever data may be passed on.
+        """
+        if self.xml_declaration:
+            out.write("<?xml version='1.0' encoding='{}'?>\n".format(
+                self.encoding))
+        if self.doctype:
+            out.write(self.doctype + "\n")
+
+        yield from self._write_element(
+            root, deferred, out,
+            {"xml": xml_namespace})
+
+    def serialise(self, render, deferred):
+        """
+        Evaluate the template code in the callable *render*, which must return
+        the root element of the document, and serialise the result. Return a
+        generator yielding chunks of encoded bytes.
+
+        While the template code is running, the *deferred* dictionary is active
+        (see :func:`render_mode`). Exceptions raised by the template code are
+        converted to :class:`~xsltea.errors.TemplateEvaluationError`.
+        """
+        out = _Output()
+
+        def steps():
+            yield from self.iter_document(render(), deferred, out)
+
+        steps_iter = steps()
+        done = False
+        while not done:
+            with render_mode(deferred):
+                try:
+                    while out.size < self.chunk_size:
+                        next(steps_iter)
+                except StopIteration:
+                    done = True
+                except Exception as err:
+                    raise TemplateEvaluationError(
+                        "template evaluation failed") from err
+
+            if out.size:
+                yield out.take().encode(self.encoding, "xmlcharrefreplace")
+
+class TemplateStream:
+    """
+    Describe a pending evaluation of *template* using the given *arguments* and
+    *request*. Pipelines pass an instance of this class to output handlers
+    which support it instead of an element tree, so that the output format is
+    known before the template is evaluated. The handler calls either
+    :meth:`serialise` with a :class:`Serialiser` suitable for the negotiated
+    output format, or :meth:`process` to obtain the tree.
+    """
+
+    def __init__(self, template, arguments, request=None):
+        self.template = template
+        self.arguments = arguments
+        self.request = request
+
+    def serialise(self, serialiser):
+        """
+        Return an iterable of chunks of the document serialised by
+        *serialiser*.
+        """
+        return self.template.stream(self.arguments,
+                                    request=self.request,
+                                    serialiser=serialiser)
+
+    def process(self, default_namespaces=()):
+        """
+        Evaluate the template into an element tree, passing
+        *default_namespaces* on to :meth:`xsltea.template.Template.process`.
+        """
+        return self.template.process(self.arguments,
+                                     request=self.request,
+                                     default_namespaces=default_namespaces)
@@ -4,20 +4,45 @@
 
 .. autoclass:: Template
 
+.. autoclass:: Partial
+
+.. autoclass:: HookTable
+
 .. autoclass:: TemplateLoader
+   :members: precompile, iter_template_names
+
+.. autoclass:: PrecompileResult
 
 .. autoclass:: XMLTemplateLoader
 
+.. autofunction:: get_xml_parser
+
+.. autofunction:: minify_whitespace
+
 """
 
 import abc
 import ast
 import binascii
+import collections
+import contextlib
 import copy
+import dis
+import fnmatch
 import functools
+import hashlib
+import importlib.util
+import io
 import itertools
 import logging
+import marshal
+import multiprocessing
+import os
+import pickle
 import random
+import re
+import threading
+import time
 import types
 
 import teapot
@@ -28,14 +53,32 @@ import lxml.etree as etree
 from .errors import TemplateEvaluationError
 from .namespaces import \
     internal_noncopyable_ns, \
-    internal_copyable_ns
+    internal_copyable_ns, \
+    shared_ns
+from . import instrumentation
 from .pipeline import PathResolver
-from .utils import sortedlist
+from .stream import Serialiser, StaticFragment, get_deferred, render_mode, \
+    xhtml_namespace, xml_namespace
+from .utils import PerThread, sortedlist
 from . import astwrap
 
-xml_parser = etree.XMLParser(ns_clean=True,
-                             remove_blank_text=True,
-                             remove_comments=True)
+def _make_xml_parser():
+    return etree.XMLParser(ns_clean=True,
+                           remove_blank_text=True,
+                           remove_comments=True)
+
+_xml_parsers = PerThread(_make_xml_parser)
+
+def get_xml_parser():
+    """
+    Return the parser used for templates. Each thread obtains its own parser,
+    as lxml parsers must not be shared between threads.
+    """
+    return _xml_parsers.get()
+
+# the parser of the thread which imported this module, kept for compatibility;
+# use get_xml_parser() instead
+xml_parser = get_xml_parser()
 
 logger = logging.getLogger(__name__)
 
@@ -73,6 +116,210 @@ def split_tag(tag):
 
     return ns, name
 
+# whitespace as defined by XML; other characters such as no-break spaces are
+# significant
+_whitespace_re = re.compile("[ \t\r\n]+")
+
+_xml_space = "{{{}}}space".format(xml_namespace)
+
+_preformatted_elements = frozenset(
+    (ns, name)
+    for ns in (xhtml_namespace, None)
+    for name in ("pre", "textarea", "script", "style"))
+
+def _remove_keeping_tail(node):
+    parent = node.getparent()
+    if node.tail:
+        prev = node.getprevious()
+        if prev is None:
+            parent.text = (parent.text or "") + node.tail
+        else:
+            prev.tail = (prev.tail or "") + node.tail
+    parent.remove(node)
+
+def _minify_element(elem, preserve, keep_text):
+    space = elem.get(_xml_space)
+    if space == "preserve":
+        preserve = True
+    elif space == "default":
+        preserve = False
+    if split_tag(elem.tag) in _preformatted_elements:
+        preserve = True
+
+    for child in list(elem):
+        if child.tag is etree.Comment:
+            _remove_keeping_tail(child)
+        elif isinstance(child.tag, str):
+            _minify_element(child, preserve, keep_text)
+
+    if preserve:
+        return
+
+    if elem.text and not keep_text(elem):
+        elem.text = _whitespace_re.sub(" ", elem.text)
+    for child in elem:
+        if child.tail:
+            child.tail = _whitespace_re.sub(" ", child.tail)
+
+def minify_whitespace(tree, keep_text=lambda elem: False):
+    """
+    Collapse each run of whitespace in the text and tail content of the
+    elements of the element tree *tree* into a single space and remove all
+    comments, in place.
+
+    The content of elements with ``xml:space="preserve"`` and of the
+    ``pre``, ``textarea``, ``script`` and ``style`` elements (in the XHTML or
+    no namespace) is left untouched. The text of elements for which
+    *keep_text* returns true is not modified either; template loaders use this
+    for elements handled by processors, whose text may be code.
+    """
+    _minify_element(tree.getroot(), False, keep_text)
+
+def _attrhook_selectors(elemtag, attrtag):
+    attrns, attrname = split_tag(attrtag)
+    elemns, elemname = split_tag(elemtag)
+    return [
+        (elemns, elemname, attrns, attrname),
+        (elemns, elemname, attrns, None),
+        (elemns, None, attrns, attrname),
+        (elemns, None, attrns, None),
+        (None, None, attrns, attrname),
+        (None, None, attrns, None),
+        (attrns, attrname),
+        (attrns, None),
+    ]
+
+class HookTable(dict):
+    """
+    A dictionary mapping hook selectors to lists of hooks, as described in
+    :class:`~xsltea.processor.TemplateProcessor`. The resolution of element and
+    attribute tags to hook lists (see :meth:`Template.lookup_hook` and
+    :meth:`Template.lookup_attrhook`) is memoised, including the fallbacks to
+    the less specific selectors.
+
+    The loader builds one table for all its templates. Each template is
+    compiled using a table obtained from :meth:`derive`, which shares the
+    memoised resolutions until hooks are modified during compilation (e.g.
+    by :class:`~xsltea.safe.FunctionProcessor`). Such modifications never
+    affect the original table.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._elem_cache = {}
+        self._attr_cache = {}
+        self._owned = None
+
+    def derive(self):
+        """
+        Return a copy-on-write copy of the table. The hook lists are copied
+        when they are first handed out, be it by key or through
+        :meth:`values` and :meth:`items`.
+        """
+        table = type(self)(self)
+        table._elem_cache = self._elem_cache
+        table._attr_cache = self._attr_cache
+        table._owned = set()
+        return table
+
+    def _invalidate(self):
+        self._elem_cache = {}
+        self._attr_cache = {}
+
+    def _own(self, key):
+        if self._owned is None or key in self._owned:
+            return
+        self._owned.add(key)
+        hooks = super().get(key)
+        if hooks is not None:
+            super().__setitem__(key, list(hooks))
+            self._invalidate()
+
+    def lookup_elem(self, tag):
+        """
+        Return the list of hooks for elements with the given *tag*, or
+        :data:`None` if no hooks are registered.
+        """
+        try:
+            return self._elem_cache[tag]
+        except KeyError:
+            pass
+        ns, name = split_tag(tag)
+        hooks = super().get((ns, name))
+        if hooks is None:
+            hooks = super().get((ns, None))
+        self._elem_cache[tag] = hooks
+        return hooks
+
+    def lookup_attr(self, elemtag, attrtag):
+        """
+        Return the list of hooks for attributes with the tag *attrtag* on
+        elements with the tag *elemtag*, or :data:`None` if no hooks are
+        registered.
+        """
+        key = (elemtag, attrtag)
+        try:
+            return self._attr_cache[key]
+        except KeyError:
+            pass
+        for selector in _attrhook_selectors(elemtag, attrtag):
+            hooks = super().get(selector)
+            if hooks is not None:
+                break
+        self._attr_cache[key] = hooks
+        return hooks
+
+    def __getitem__(self, key):
+        self._own(key)
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        self._own(key)
+        super().__setitem__(key, value)
+        self._invalidate()
+
+    def __delitem__(self, key):
+        self._own(key)
+        super().__delitem__(key)
+        self._invalidate()
+
+    def get(self, key, default=None):
+        self._own(key)
+        return super().get(key, default)
+
+    def setdefault(self, key, default=None):
+        self._own(key)
+        if key not in self:
+            self[key] = default
+        return super().__getitem__(key)
+
+    def pop(self, key, *args):
+        self._own(key)
+        self._invalidate()
+        return super().pop(key, *args)
+
+    def popitem(self):
+        self._invalidate()
+        return super().popitem()
+
+    def values(self):
+        for key in self:
+            self._own(key)
+        return super().values()
+
+    def items(self):
+        for key in self:
+            self._own(key)
+        return super().items()
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        super().clear()
+        self._invalidate()
+
 class _TreeFormatter:
     """
     Private helper class to lazily format a *tree* for passing to logging
@@ -123,10 +370,13 @@ class Template:
     perform the desired action. For a description of the hook dictionaries and
     their structure, please see :class:`~xsltea.processor.TemplateProcessor`.
 
-    The user interface basically only consists of the process method:
+    The user interface basically only consists of the process method and its
+    streaming variant:
 
     .. automethod:: process
 
+    .. automethod:: stream
+
     In addition to the public user interface, the template provides several
     utility functions for template processors. Throughout the documentation of
     these the terms *precode*, *elemcode* and *postcode* are used. For more
@@ -139,11 +389,76 @@ class Template:
 
     .. automethod:: default_subtree
 
+    .. automethod:: static_subtree
+
     .. automethod:: preserve_tail_code
+
+    Subtrees which are not touched by any hook are compiled using
+    :meth:`static_subtree`. The number of elements compiled and the number of
+    elements folded that way are available in the :attr:`compiled_elements`
+    and :attr:`folded_elements` attributes.
+
+    If *instrument_sections* is true, code recording the evaluation time of
+    the elements listed in :attr:`instrumented_sections` is generated (see
+    :mod:`xsltea.instrumentation`).
+
+    .. attribute:: instrumented_sections
+
+       Maps the ``(namespace, name)`` tuples of elements to instrument to a
+       tuple ``(kind, attrname)``, where *kind* names the kind of section and
+       the value of the attribute *attrname* is used as its label.
     """
 
+    instrumented_sections = {
+        (str(shared_ns), "for-each"): ("for-each", "from"),
+        (str(shared_ns), "include"): ("include", "src"),
+        (str(shared_ns), "call"): ("call", "name"),
+    }
+
     @staticmethod
     def append_children(to_element, children_iterator):
+        deferred = get_deferred()
+        if deferred is not None:
+            # streaming render: children are evaluated while serialising
+            try:
+                prev = deferred[to_element]
+            except KeyError:
+                deferred[to_element] = iter(children_iterator)
+            else:
+                deferred[to_element] = itertools.chain(prev,
+                                                       children_iterator)
+            return
+
+        Template._append_children_now(to_element, children_iterator)
+
+    @staticmethod
+    def materialize_children(to_element, children_iterator):
+        deferred = get_deferred()
+        if deferred is not None:
+            children_iterator = Template._materializing(children_iterator,
+                                                        deferred)
+        Template._append_children_now(to_element, children_iterator)
+
+    @staticmethod
+    def _materializing(children_iterator, deferred):
+        # the pending children must be evaluated before the iterator which
+        # produced their parent is advanced, as they may refer to its state
+        for child in children_iterator:
+            if not isinstance(child, str):
+                for elem in list(child.iter()):
+                    try:
+                        pending = deferred.pop(elem)
+                    except KeyError:
+                        continue
+                    if isinstance(pending, StaticFragment):
+                        continue
+                    Template._append_children_now(
+                        elem,
+                        Template._materializing(pending, deferred))
+            yield child
+
+    @staticmethod
+    def _append_children_now(to_element, children_iterator):
         def text_append(s):
             if to_element.text is None:
                 to_element.text = s
@@ -183,6 +498,12 @@ class Template:
 
     @staticmethod
     def lookup_hook(hookmap, tag):
+        if isinstance(hookmap, HookTable):
+            hooks = hookmap.lookup_elem(tag)
+            if hooks is None:
+                raise KeyError(tag)
+            return hooks
+
         ns, name = split_tag(tag)
 
         try:
@@ -192,51 +513,25 @@ class Template:
 
     @staticmethod
     def lookup_attrhook(hookmap, elemtag, attrtag):
-        attrns, attrname = split_tag(attrtag)
-        elemns, elemname = split_tag(elemtag)
-
-        try:
-            return hookmap[(elemns, elemname, attrns, attrname)]
-        except KeyError:
-            pass
-
-        try:
-            return hookmap[(elemns, elemname, attrns, None)]
-        except KeyError:
-            pass
-
-        try:
-            return hookmap[(elemns, None, attrns, attrname)]
-        except KeyError:
-            pass
+        if isinstance(hookmap, HookTable):
+            hooks = hookmap.lookup_attr(elemtag, attrtag)
+            if hooks is None:
+                raise KeyError(attrtag)
+            return hooks
 
-        try:
-            return hookmap[(elemns, None, attrns, None)]
-        except KeyError:
-            pass
-
-        try:
-            return hookmap[(None, None, attrns, attrname)]
-        except KeyError:
-            pass
-
-        try:
-            return hookmap[(None, None, attrns, None)]
-        except KeyError:
-            pass
-
-        try:
-            return hookmap[(attrns, attrname)]
-        except KeyError:
-            pass
+        for selector in _attrhook_selectors(elemtag, attrtag):
+            try:
+                return hookmap[selector]
+            except KeyError:
+                pass
 
-        return hookmap[(attrns, None)]
+        raise KeyError(attrtag)
 
     @classmethod
     def from_string(cls, buf, filename, attrhooks={}, elemhooks={}):
         return cls(
             etree.fromstring(buf,
-                             parser=xml_parser).getroottree(),
+                             parser=get_xml_parser()).getroottree(),
             filename,
             attrhooks,
             elemhooks)
@@ -247,16 +542,29 @@ class Template:
                  globalhooks=[],
                  loader=None,
                  global_precode=[],
-                 global_postcode=[]):
+                 global_postcode=[],
+                 instrument_sections=False):
         super().__init__()
 
         self.storage = {}
         self._reverse_storage = {}
         self.loader = loader
+        self.filename = filename
+        self.source_hash = None
+        self.dependencies = {}
+        self.compiled_elements = 0
+        self.folded_elements = 0
+        self.instrument_sections = instrument_sections
+        self._static_cache = {}
+        self._section_counter = itertools.count()
         context = Context()
         context.filename = filename
-        context.attrhooks = copy.deepcopy(attrhooks)
-        context.elemhooks = copy.deepcopy(elemhooks)
+        if not isinstance(attrhooks, HookTable):
+            attrhooks = HookTable(attrhooks)
+        if not isinstance(elemhooks, HookTable):
+            elemhooks = HookTable(elemhooks)
+        context.attrhooks = attrhooks.derive()
+        context.elemhooks = elemhooks.derive()
         context.globalhooks = copy.copy(globalhooks)
         self._process = self.parse_tree(
             tree, context,
@@ -264,6 +572,35 @@ class Template:
             global_postcode)
         self.tree = tree
         del self._reverse_storage
+        del self._static_cache
+        del self._section_counter
+        logger.debug("%s: folded %d of %d elements into static subtrees",
+                     filename, self.folded_elements, self.compiled_elements)
+
+    @classmethod
+    def from_code(cls, tree, filename, code, loader=None):
+        """
+        Create a template from the *tree* and the compiled *code* of a template
+        which has been compiled before, without running any processors. The
+        objects referenced by the code must be put into :attr:`storage` by the
+        caller before the template is processed.
+
+        This is used to restore templates from a
+        :class:`~xsltea.bytecode.BytecodeCache`.
+        """
+        template = cls.__new__(cls)
+        template.storage = {}
+        template.loader = loader
+        template.filename = filename
+        template.source_hash = None
+        template.dependencies = {}
+        template.compiled_elements = 0
+        template.folded_elements = 0
+        template.instrument_sections = False
+        template.tree = tree
+        template._init_utils()
+        template._process = template._link(code)
+        return template
 
     def default_attrhandler(self, key, value, context, sourceline):
         precode = []
@@ -333,10 +670,13 @@ class Template:
         Create and return a list of ast nodes which resemble the body of the
         children function (see :meth:`compose_childrenfun`) for the given *elem*.
         """
+        return self._build_elements_body(elem, context, elem.sourceline or 0)
+
+    def _build_elements_body(self, elements, context, sourceline):
         precode = []
         midcode = []
         postcode = []
-        for i, child in enumerate(elem):
+        for i, child in enumerate(elements):
             child_precode, child_elemcode, child_postcode = \
                 self.parse_subtree(child, context, i)
             precode.extend(child_precode)
@@ -351,9 +691,9 @@ class Template:
             ast.List(
                 [],
                 ast.Load(),
-                lineno=elem.sourceline or 0,
+                lineno=sourceline,
                 col_offset=0),
-            lineno=elem.sourceline or 0,
+            lineno=sourceline,
             col_offset=0))
 
         return body
@@ -403,6 +743,7 @@ def {}():
             elem.tag,
             elem.sourceline or 0,
             attrdict=attrdict,
+            nsdict=self.ast_get_boundary_nsmap(elem),
             text=elem.text,
             tail=elem.tail,
             elemcode=attr_elemcode,
@@ -429,14 +770,145 @@ def {}():
         for handler in handlers:
             result = handler(self, elem, context, offset)
             if result:
+                self.compiled_elements += 1
+                if self.instrument_sections:
+                    result = self.instrument_section(elem, context, result)
                 return result
 
+        if self.is_static(elem, context):
+            return self.static_subtree(elem, context, offset)
+
+        self.compiled_elements += 1
         return self.default_subtree(elem, context, offset)
 
-    def parse_tree(self, tree, context, global_precode, global_postcode):
+    def instrument_section(self, elem, context, code):
+        """
+        Wrap the *elemcode* of the ``(precode, elemcode, postcode)`` tuple
+        *code* generated for *elem* in code which records its evaluation time,
+        if *elem* is listed in :attr:`instrumented_sections`. Return the
+        resulting tuple.
+        """
+        try:
+            kind, attrname = self.instrumented_sections[split_tag(elem.tag)]
+        except KeyError:
+            return code
+
+        precode, elemcode, postcode = code
+        varname = "_section_start_{}".format(next(self._section_counter))
+        start, end = compile(
+            "{} = utils.section_start()\n"
+            "utils.section_end({!r}, {!r}, {})".format(
+                varname,
+                kind,
+                elem.get(attrname),
+                varname),
+            context.filename,
+            "exec",
+            ast.PyCF_ONLY_AST).body
+        for node in ast.walk(start):
+            node.lineno = elem.sourceline or 0
+        for node in ast.walk(end):
+            node.lineno = elem.sourceline or 0
+        return precode, [start] + elemcode + [end], postcode
+
+    def is_static(self, elem, context):
+        """
+        Return whether neither the element *elem*, nor any of its attributes or
+        descendants are subject to any hook in the given *context*.
+        """
+        try:
+            return self._static_cache[elem]
+        except KeyError:
+            pass
+
+        result = isinstance(elem.tag, str)
+        if result:
+            try:
+                result = not self.lookup_hook(context.elemhooks, elem.tag)
+            except KeyError:
+                pass
+        if result:
+            for key in elem.attrib:
+                try:
+                    if self.lookup_attrhook(context.attrhooks, elem.tag, key):
+                        result = False
+                        break
+                except KeyError:
+                    pass
+        if result:
+            result = all(self.is_static(child, context) for child in elem)
+
+        self._static_cache[elem] = result
+        return result
+
+    def static_subtree(self, elem, context, offset=0):
+        """
+        Create code for a subtree without dynamic content, which has been
+        identified by :meth:`is_static`. The subtree is built once and copied
+        whenever the template is evaluated.
+
+        Returns a tuple containing *precode*, *elemcode* and *postcode*.
+        """
+
+        sourceline = elem.sourceline or 0
+        size = sum(1 for _ in elem.iter())
+        self.compiled_elements += size
+        self.folded_elements += size
+
+        fragment = StaticFragment(copy.deepcopy(elem))
+        elemcode = [
+            ast.Assign(
+                [
+                    ast.Name(
+                        "elem",
+                        ast.Store(),
+                        lineno=sourceline,
+                        col_offset=0),
+                ],
+                astwrap.Call(
+                    self.ast_get_from_object(
+                        "clone",
+                        self.ast_get_stored(self.store(fragment), sourceline),
+                        sourceline),
+                    [
+                        self.ast_get_from_object("nsmaps", "context",
+                                                 sourceline),
+                    ],
+                    [],
+                    None, None,
+                    lineno=sourceline,
+                    col_offset=0),
+                lineno=sourceline,
+                col_offset=0),
+            self.ast_yield("elem", sourceline)
+        ]
+
+        return [], elemcode, []
+
+    def _init_utils(self):
         self.utils = types.SimpleNamespace()
+        self.utils.filename = self.filename
+        self.utils.section_start = instrumentation.section_start
+        self.utils.section_end = instrumentation.section_end
+
+    def _link(self, code):
+        globals_dict = dict(globals())
+        locals_dict = {}
+        exec(code, globals_dict, locals_dict)
+
+        self._code = code
+        self.utils.append_children = self.append_children
+        self.utils.materialize_children = self.materialize_children
+        self.utils.storage = self.storage
+
+        return functools.partial(locals_dict["root"],
+                                 self.utils)
+
+    def parse_tree(self, tree, context, global_precode, global_postcode):
+        self._init_utils()
 
         root = tree.getroot()
+        self.compiled_elements += 1
 
         global_precode = list(itertools.chain(
             *(precode_func(self) for precode_func in global_precode)))
@@ -454,6 +926,7 @@ def {}():
             self.compose_attrdict(root, context)
 
         rootfun_body = []
+        root_nsdict = self.ast_get_boundary_nsmap(root)
 
         import sys
         arguments_args = dict(
@@ -511,7 +984,7 @@ def {}():
                             lineno=0,
                             col_offset=0),
                         attrdict
-                    ],
+                    ] + ([root_nsdict] if root_nsdict is not None else []),
                     [],
                     None,
                     None,
@@ -583,15 +1056,7 @@ def {}():
         # print(ast.dump(rootmod))
 
         code = compile(rootmod, context.filename, "exec")
-        globals_dict = dict(globals())
-        locals_dict = {}
-        exec(code, globals_dict, locals_dict)
-
-        self.utils.append_children = self.append_children
-        self.utils.storage = self.storage
-
-        return functools.partial(locals_dict["root"],
-                                 self.utils)
+        return self._link(code)
 
     def preserve_tail_code(self, elem, context):
         """
@@ -613,13 +1078,15 @@ def {}():
                                       col_offset=0)
         return body
 
-    def compose_context(self, arguments, request=None):
+    def compose_context(self, arguments, request=None, default_namespaces=()):
         context = types.SimpleNamespace()
         context.request = request
         context.href = functools.partial(self.href, request)
+        context.nsmaps = {ns: {None: ns} for ns in default_namespaces}
         return context
 
-    def process(self, arguments, request=None):
+    def process(self, arguments, request=None, default_namespaces=(),
+                stats=None):
         """
         Evaluate the template using the given *arguments*. The contents of
         *arguments* is made available under the name *arguments* inside the
@@ -628,17 +1095,62 @@ def {}():
         *request* is supposed to be a teapot request object. Some processors
         might require this, but it is in general optional.
 
+        Elements of the template in one of the namespaces given in
+        *default_namespaces* are created with that namespace declared as default
+        namespace, so that they are serialised without prefix. This only
+        applies to elements which are copied from the template source; elements
+        created by processors keep the prefix chosen by lxml, unless they are
+        placed below an element of the same namespace.
+
+        If a :class:`~xsltea.instrumentation.RenderStats` object is given as
+        *stats*, the evaluation time is added to its ``"process"`` phase, the
+        number of elements produced is stored and instrumented sections are
+        recorded into it.
+
         Any exceptions thrown during template evaluation are caught and
         converted into :class:`~xsltea.errors.TemplateEvaluationError`, with the
         original exception being attached as context.
         """
         try:
-            context = self.compose_context(arguments, request=request)
-            return self._process(context, arguments)
+            context = self.compose_context(
+                arguments,
+                request=request,
+                default_namespaces=default_namespaces)
+            if stats is None:
+                with render_mode(None):
+                    return self._process(context, arguments)
+
+            start = time.perf_counter()
+            with render_mode(None), instrumentation.recording(stats):
+                tree = self._process(context, arguments)
+            stats.add_phase("process", time.perf_counter() - start)
+            stats.elements = sum(1 for _ in tree.iter(etree.Element))
+            return tree
         except Exception as err:
             raise TemplateEvaluationError(
                 "template evaluation failed") from err
 
+    def stream(self, arguments, request=None, serialiser=None):
+        """
+        Evaluate the template like :meth:`process`, but serialise the document
+        while it is being built, instead of building the complete tree first.
+
+        Return an iterator over chunks of :class:`bytes` as produced by the
+        given *serialiser*, which defaults to a
+        :class:`~xsltea.stream.Serialiser` writing UTF-8 encoded XML. The
+        template is evaluated while the iterator is consumed; errors are
+        raised from the iterator as
+        :class:`~xsltea.errors.TemplateEvaluationError`.
+        """
+        if serialiser is None:
+            serialiser = Serialiser()
+
+        def render():
+            context = self.compose_context(arguments, request=request)
+            return self._process(context, arguments).getroot()
+
+        return serialiser.serialise(render, {})
+
     def store(self, obj):
         try:
             hash(obj)
@@ -842,6 +1354,42 @@ def {}():
             lineno=sourceline,
             col_offset=0)
 
+    def ast_get_boundary_nsmap(self, elem):
+        """
+        Return an AST expression which evaluates to the namespace map to create
+        *elem* with, if *elem* starts a subtree in a namespace different from
+        the one of its parent. The namespace map declares the namespace of
+        *elem* as default namespace if it has been requested from
+        :meth:`process`, and is :data:`None` otherwise.
+
+        Return :data:`None` if *elem* has the same namespace as its parent or
+        no namespace at all; descendants in the same namespace reuse the
+        declaration of their ancestor.
+        """
+
+        ns, _ = split_tag(elem.tag)
+        if ns is None:
+            return None
+
+        parent = elem.getparent()
+        if parent is not None and split_tag(parent.tag)[0] == ns:
+            return None
+
+        sourceline = elem.sourceline or 0
+        return astwrap.Call(
+            ast.Attribute(
+                self.ast_get_from_object("nsmaps", "context", sourceline),
+                "get",
+                ast.Load(),
+                lineno=sourceline,
+                col_offset=0),
+            [ast.Str(ns, lineno=sourceline, col_offset=0)],
+            [],
+            None,
+            None,
+            lineno=sourceline,
+            col_offset=0)
+
     def ast_get_href(self, sourceline):
         """
         Return an AST expression which evaluates to the :meth:`href` method,
@@ -1171,11 +1719,199 @@ def {}():
             col_offset=0)
 
 
+class Partial(Template):
+    """
+    A partial is a list of *elements* taken from a template, compiled on its own
+    so that it can be shared by all templates which include it (see
+    :meth:`TemplateLoader.get_partial`). The elements are compiled as if they
+    were the children of an element. Calling the partial with the context and
+    the arguments of a template evaluation returns an iterable over the nodes
+    to insert.
+
+    .. attribute:: free_names
+
+       The set of names read by the compiled code which are not defined by
+       the partial itself. Such names may be provided by the scope of the
+       including code, even if they would otherwise refer to a builtin; a
+       partial with free names can thus not be shared.
+    """
+
+    def __init__(self, elements, filename, attrhooks, elemhooks,
+                 loader=None,
+                 global_precode=[],
+                 instrument_sections=False):
+        self.free_names = frozenset()
+        super().__init__(elements, filename, attrhooks, elemhooks,
+                         loader=loader,
+                         global_precode=global_precode,
+                         instrument_sections=instrument_sections)
+
+    # the names used by the code generated by the processors are bound
+    # locally, so that they are not mistaken for free names
+    _prelude_source = """\
+from builtins import str, type
+from lxml import etree"""
+
+    def __call__(self, context, arguments):
+        return self._process(context, arguments)
+
+    @classmethod
+    def _iter_global_names(cls, code):
+        for instruction in dis.get_instructions(code):
+            if instruction.opname in ("LOAD_GLOBAL", "LOAD_NAME"):
+                yield instruction.argval
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                yield from cls._iter_global_names(const)
+
+    def parse_tree(self, elements, context, global_precode, global_postcode):
+        self._init_utils()
+
+        rootmod = compile("""\
+def root(utils, context, arguments):
+    def children():
+        pass
+    return children()""",
+                          context.filename,
+                          "exec",
+                          ast.PyCF_ONLY_AST)
+        rootfun = rootmod.body[0]
+        rootfun.body[0].body[:] = self._build_elements_body(
+            elements, context, 0)
+        rootfun.body[:0] = itertools.chain(
+            compile(self._prelude_source,
+                    context.filename,
+                    "exec",
+                    ast.PyCF_ONLY_AST).body,
+            *(precode_func(self) for precode_func in global_precode))
+
+        code = compile(rootmod, context.filename, "exec")
+        # any global name might be bound by the scope of an includer, even if
+        # it refers to a builtin or a global of this module otherwise
+        self.free_names = frozenset(self._iter_global_names(code))
+        return self._link(code)
+
+class _TemplatePickler(pickle.Pickler):
+    """
+    Private pickler used to persist the storage of a template. References to
+    the loader, its processors, objects provided by
+    :meth:`~xsltea.processor.TemplateProcessor.get_persistent_objects` and the
+    utilities of templates are replaced by symbolic references, which are
+    resolved by :class:`_TemplateUnpickler`.
+    """
+
+    def __init__(self, file, template, loader):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self._template = template
+        self._loader = loader
+        self._persistent = {}
+        for i, processor in enumerate(loader.processors):
+            self._persistent[id(processor)] = ("processor", i)
+            for key, obj in processor.get_persistent_objects().items():
+                self._persistent.setdefault(id(obj), ("object", i, key))
+
+    def persistent_id(self, obj):
+        if obj is self._loader:
+            return ("loader",)
+        if obj is self._template.utils:
+            return ("utils", None)
+        if isinstance(obj, Partial) and obj.loader is self._loader:
+            return ("partial",) + obj.key
+        if isinstance(obj, types.SimpleNamespace):
+            filename = getattr(obj, "filename", None)
+            other = self._loader._cache.get(filename)
+            if other is not None and other.utils is obj:
+                return ("utils", filename)
+        return self._persistent.get(id(obj))
+
+class _TemplateUnpickler(pickle.Unpickler):
+    def __init__(self, file, template, loader):
+        super().__init__(file)
+        self._template = template
+        self._loader = loader
+
+    def persistent_load(self, pid):
+        kind, *args = pid
+        if kind == "loader":
+            return self._loader
+        elif kind == "utils":
+            name, = args
+            if name is None:
+                return self._template.utils
+            return self._loader.get_template(name).utils
+        elif kind == "processor":
+            index, = args
+            return self._loader.processors[index]
+        elif kind == "object":
+            index, key = args
+            processor = self._loader.processors[index]
+            return processor.get_persistent_objects()[key]
+        elif kind == "partial":
+            name, xpath, namespaces = args
+            partial = self._loader.get_partial(name, xpath, dict(namespaces))
+            if partial is not None:
+                return partial
+        raise pickle.UnpicklingError(
+            "unsupported persistent id: {!r}".format(pid))
+
+PrecompileResult = collections.namedtuple(
+    "PrecompileResult",
+    ["name", "duration", "error"])
+
+_precompile_loader = None
+
+def _init_precompile_worker(loader):
+    global _precompile_loader
+    # another thread may have held the lock when the worker was forked
+    loader._lock = threading.RLock()
+    _precompile_loader = loader
+
+def _precompile_worker(name):
+    start = time.perf_counter()
+    try:
+        _precompile_loader.get_template(name)
+    except Exception:
+        # the error is reported when the template is loaded by the parent
+        pass
+    return name, time.perf_counter() - start
+
 class TemplateLoader(metaclass=abc.ABCMeta):
     """
     This is a base class to implement custom template loaders whose result is a
     tree format compatible to the default XML format.
 
+    Templates loaded through :meth:`get_template` are cached. If *cache_size*
+    is not :data:`None`, at most that many templates are kept, dropping the
+    least recently used ones first.
+
+    If *check_interval* is not :data:`None`, the sources of a cached template
+    and of all templates it depends on (via ``tea:include`` or ``tea:call``)
+    are checked for modifications whenever the template is requested, but at
+    most once every *check_interval* seconds per source. A modified template
+    is dropped from the cache, along with all templates depending on it (see
+    :meth:`invalidate`). Sources which cannot provide modification timestamps
+    (see :meth:`teapot.templating.Source.get_mtime`) are re-read and compared
+    by content.
+
+    If a *bytecode_cache* (see :mod:`xsltea.bytecode`) is given, compiled
+    templates are persisted in that cache and restored from there instead of
+    being compiled again, as long as neither the template source, the source of
+    any template it depends on nor the configuration of the processors has
+    changed.
+
+    The loader may be used from several threads at once. Templates are
+    compiled one at a time; compiled templates can be evaluated concurrently.
+    To avoid compiling templates while serving the first requests, use
+    :meth:`precompile` at startup.
+
+    If *instrument_sections* is true, templates are compiled with code which
+    records the time spent in ``tea:for-each``, ``tea:include`` and
+    ``tea:call`` elements (see :mod:`xsltea.instrumentation`).
+
+    If *minify_whitespace* is true, insignificant whitespace is collapsed
+    before templates are compiled (see :func:`minify_whitespace`). The text of
+    elements which are subject to an element hook is left as it is.
+
     To subclass, several entry points are offered:
 
     .. automethod:: _load_template_etree
@@ -1183,12 +1919,29 @@ class TemplateLoader(metaclass=abc.ABCMeta):
     .. automethod:: load_template
     """
 
-    def __init__(self, *sources, **kwargs):
+    #: Name pattern used by :meth:`precompile` if no names are given.
+    precompile_pattern = "*.xml"
+
+    def __init__(self, *sources,
+                 bytecode_cache=None,
+                 cache_size=None,
+                 check_interval=None,
+                 instrument_sections=False,
+                 minify_whitespace=False,
+                 **kwargs):
         super().__init__(**kwargs)
         self._sources = list(sources)
-        self._cache = {}
+        self._cache = collections.OrderedDict()
+        self._cache_size = cache_size
+        self._check_interval = check_interval
+        self._instrument_sections = instrument_sections
+        self._minify_whitespace = minify_whitespace
+        self._source_state = {}
+        self._partials = {}
+        self._bytecode_cache = bytecode_cache
+        self._tracking = threading.local()
         self._resolver = PathResolver(*sources)
-        self._parser = self._resolver._parser
+        self._lock = threading.RLock()
         self._attrhooks = None
         self._elemhooks = None
         self._global_postcode = None
@@ -1204,29 +1957,30 @@ class TemplateLoader(metaclass=abc.ABCMeta):
         """
 
     def _update_hooks(self):
-        if self._attrhooks is not None and self._elemhooks is not None:
-            return
-        attrhooks = {}
-        elemhooks = {}
-        globalhooks = []
-        global_precode = []
-        global_postcode = []
-        for processor in self._processors:
-            for selector, hooks in processor.attrhooks.items():
-                attrhooks.setdefault(selector, []).extend(hooks)
-            for selector, hooks in processor.elemhooks.items():
-                elemhooks.setdefault(selector, []).extend(hooks)
-            globalhooks.extend(processor.globalhooks)
-            global_precode.append(processor.global_precode)
-            global_postcode.append(processor.global_postcode)
-
-        global_postcode.reverse()
-
-        self._attrhooks = attrhooks
-        self._elemhooks = elemhooks
-        self._globalhooks = globalhooks
-        self._global_precode = global_precode
-        self._global_postcode = global_postcode
+        with self._lock:
+            if self._attrhooks is not None and self._elemhooks is not None:
+                return
+            attrhooks = {}
+            elemhooks = {}
+            globalhooks = []
+            global_precode = []
+            global_postcode = []
+            for processor in self._processors:
+                for selector, hooks in processor.attrhooks.items():
+                    attrhooks.setdefault(selector, []).extend(hooks)
+                for selector, hooks in processor.elemhooks.items():
+                    elemhooks.setdefault(selector, []).extend(hooks)
+                globalhooks.extend(processor.globalhooks)
+                global_precode.append(processor.global_precode)
+                global_postcode.append(processor.global_postcode)
+
+            global_postcode.reverse()
+
+            self._attrhooks = HookTable(attrhooks)
+            self._elemhooks = HookTable(elemhooks)
+            self._globalhooks = globalhooks
+            self._global_precode = global_precode
+            self._global_postcode = global_postcode
 
     def load_template(self, buf, name):
         """
@@ -1240,16 +1994,28 @@ class TemplateLoader(metaclass=abc.ABCMeta):
         """
         self._update_hooks()
         tree = self._load_template_etree(buf, name)
-        template = Template(tree,
-                            name,
-                            self._attrhooks,
-                            self._elemhooks,
-                            globalhooks=self._globalhooks,
-                            loader=self,
-                            global_precode=self._global_precode,
-                            global_postcode=self._global_postcode)
+        if self._minify_whitespace:
+            minify_whitespace(tree, keep_text=self._has_elemhook)
+        with self._track_dependencies() as dependencies:
+            template = Template(tree,
+                                name,
+                                self._attrhooks,
+                                self._elemhooks,
+                                globalhooks=self._globalhooks,
+                                loader=self,
+                                global_precode=self._global_precode,
+                                global_postcode=self._global_postcode,
+                                instrument_sections=self._instrument_sections)
+        template.source_hash = self._hash_source(buf)
+        template.dependencies = dependencies
         return template
 
+    def _has_elemhook(self, elem):
+        try:
+            return bool(Template.lookup_hook(self._elemhooks, elem.tag))
+        except KeyError:
+            return False
+
     def add_processor(self, processor):
         """
         Add a template processor class to the list of template processors which
@@ -1257,20 +2023,38 @@ class TemplateLoader(metaclass=abc.ABCMeta):
 
         Drops the template cache.
         """
-        # backwards compatibility
-        if isinstance(processor, type) and hasattr(processor, "__call__"):
-            processor = processor()
-        self._processors.append(processor)
-
-        # drop cache
-        self._cache.clear()
-        self._attrhooks = None
-        self._elemhooks = None
+        with self._lock:
+            # backwards compatibility
+            if isinstance(processor, type) and hasattr(processor, "__call__"):
+                processor = processor()
+            self._processors.append(processor)
+
+            # drop cache
+            self._cache.clear()
+            self._source_state.clear()
+            self._partials.clear()
+            self._attrhooks = None
+            self._elemhooks = None
 
     @property
     def processors(self):
         return self._processors
 
+    def get_folding_report(self):
+        """
+        Return a list of tuples ``(name, folded, compiled)`` for all cached
+        templates, where *compiled* is the number of elements compiled and
+        *folded* the number of those which were part of a static subtree (see
+        :meth:`Template.static_subtree`). The list is sorted by the folded
+        fraction, starting with the template with the least folded elements.
+        """
+        report = [
+            (name, template.folded_elements, template.compiled_elements)
+            for name, template in self._cache.items()
+        ]
+        report.sort(key=lambda item: (item[1] / max(item[2], 1), item[0]))
+        return report
+
     def get_template(self, name):
         """
         Return the template identified by the given *name*. If the template has
@@ -1281,11 +2065,246 @@ class TemplateLoader(metaclass=abc.ABCMeta):
         The template is loaded and initialized with all currently registered
         template processors.
         """
+        with self._lock:
+            try:
+                template = self._cache[name]
+            except KeyError:
+                template = None
+            else:
+                if self._check_interval is not None:
+                    for changed in self._find_changed_sources(name, template):
+                        self.invalidate(changed)
+                    if name not in self._cache:
+                        template = None
+
+            if template is None:
+                try:
+                    mtime = self._get_source_mtime(name)
+                except FileNotFoundError:
+                    mtime = None
+                buf = self._read_source(name)
+                if self._bytecode_cache is not None:
+                    template = self._load_template_cached(buf, name)
+                else:
+                    template = self.load_template(buf, name)
+                self._cache[name] = template
+                self._source_state[name] = [mtime, time.monotonic()]
+                self._evict()
+            else:
+                self._cache.move_to_end(name)
+
+            self._record_dependency(name, template)
+            return template
+
+    def get_partial(self, name, xpath="/*", namespaces={}):
+        """
+        Return a :class:`Partial` compiling the elements selected by the
+        *xpath* expression (evaluated with the given *namespaces*) from the
+        template identified by *name*. The partial is compiled only once and
+        shared by all callers, until the template or any of its dependencies
+        is invalidated.
+
+        If the selected elements cannot be compiled on their own, for example
+        because they refer to names defined by the including template, ``None``
+        is returned.
+        """
+        with self._lock:
+            self._update_hooks()
+            template = self.get_template(name)
+            key = (name, xpath, tuple(sorted(namespaces.items())))
+            try:
+                source, partial = self._partials[key]
+            except KeyError:
+                source = None
+
+            if source is not template:
+                elements = template.tree.xpath(xpath, namespaces=namespaces)
+                try:
+                    with self._track_dependencies() as dependencies:
+                        partial = Partial(elements,
+                                          name,
+                                          self._attrhooks,
+                                          self._elemhooks,
+                                          loader=self,
+                                          global_precode=self._global_precode,
+                                          instrument_sections=(
+                                              self._instrument_sections))
+                except ValueError as err:
+                    logger.debug("cannot share %s of %s: %s", xpath, name, err)
+                    partial = None
+                else:
+                    if partial.free_names:
+                        logger.debug("cannot share %s of %s: depends on %s",
+                                     xpath, name,
+                                     ", ".join(sorted(partial.free_names)))
+                        partial = None
+                    else:
+                        partial.key = key
+                        partial.dependencies = dependencies
+                self._partials[key] = template, partial
+
+            if partial is not None:
+                self._record_dependencies(partial.dependencies)
+            return partial
+
+    def get_dependents(self, name):
+        """
+        Return the set of names of all cached templates which depend on the
+        template identified by *name*, for example by including it.
+        """
+        return {
+            other_name
+            for other_name, template in self._cache.items()
+            if name in template.dependencies
+        }
+
+    def invalidate(self, name):
+        """
+        Drop the template with the given *name* from the cache, together with
+        all cached templates and partials which depend on it.
+        """
+        with self._lock:
+            self._cache.pop(name, None)
+            self._source_state.pop(name, None)
+            for other_name in self.get_dependents(name):
+                del self._cache[other_name]
+                self._source_state.pop(other_name, None)
+            for key, (_, partial) in list(self._partials.items()):
+                if key[0] == name or (partial is not None and
+                                      name in partial.dependencies):
+                    del self._partials[key]
+
+    def iter_template_names(self, pattern="*"):
+        """
+        Iterate over the names of all templates provided by the sources of this
+        loader (see :meth:`teapot.templating.Source.iter_names`) which match
+        the shell-style *pattern* (see :mod:`fnmatch`). Sources which cannot
+        enumerate their templates are skipped.
+        """
+        seen = set()
+        for source in self._sources:
+            for name in source.iter_names():
+                if name in seen or not fnmatch.fnmatchcase(name, pattern):
+                    continue
+                seen.add(name)
+                yield name
+
+    def precompile(self, names=None, workers=None):
+        """
+        Load and compile the templates given by *names* into the cache, so that
+        they are ready when they are first requested. *names* may either be an
+        iterable of template names or a shell-style pattern which is matched
+        against all templates the sources can enumerate (see
+        :meth:`iter_template_names`). It defaults to
+        :attr:`precompile_pattern`.
+
+        If a bytecode cache is configured, the templates are compiled by
+        *workers* forked processes (defaulting to the number of CPUs), which
+        persist them in the bytecode cache, from where they are then restored
+        into this loader. Otherwise, they are compiled in this process, one at
+        a time, as compilation is bound by the interpreter.
+
+        Templates which fail to compile do not stop the process. Return a list
+        of :class:`PrecompileResult` tuples ``(name, duration, error)``, where
+        *duration* is the time in seconds it took to compile the template and
+        *error* is the exception raised while loading it, or :data:`None`.
+        """
+        if names is None:
+            names = self.precompile_pattern
+        if isinstance(names, str):
+            names = sorted(self.iter_template_names(names))
+        else:
+            names = list(names)
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        durations = {}
+        with self._lock:
+            pending = [name for name in names if name not in self._cache]
+        if (self._bytecode_cache is not None and
+                workers > 1 and
+                len(pending) > 1 and
+                "fork" in multiprocessing.get_all_start_methods()):
+            durations = self._precompile_forked(pending, workers)
+
+        results = []
+        for name in names:
+            start = time.perf_counter()
+            try:
+                self.get_template(name)
+            except Exception as err:
+                logger.warning("failed to precompile template %s: %s",
+                               name, err)
+                error = err
+            else:
+                error = None
+            duration = durations.get(name, time.perf_counter() - start)
+            logger.debug("precompiled template %s in %.1f ms",
+                         name, duration * 1000)
+            results.append(PrecompileResult(name, duration, error))
+        return results
+
+    def _precompile_forked(self, names, workers):
+        context = multiprocessing.get_context("fork")
+        with context.Pool(min(workers, len(names)),
+                          initializer=_init_precompile_worker,
+                          initargs=(self,)) as pool:
+            return dict(pool.imap_unordered(_precompile_worker, names))
+
+    def _evict(self):
+        if self._cache_size is None:
+            return
+        while len(self._cache) > self._cache_size:
+            name, _ = self._cache.popitem(last=False)
+            self._source_state.pop(name, None)
+
+    def _get_source_mtime(self, name):
+        for source in self._sources:
+            try:
+                return source.get_mtime(name)
+            except FileNotFoundError:
+                pass
+            except OSError as err:
+                logger.warning(
+                    "while searching for template %s: %s",
+                    name, err)
+        raise FileNotFoundError(name)
+
+    def _source_changed(self, name, source_hash, now):
+        state = self._source_state.get(name)
+        if state is not None and now - state[1] < self._check_interval:
+            return False
+
         try:
-            return self._cache[name]
-        except KeyError:
-            pass
+            mtime = self._get_source_mtime(name)
+        except FileNotFoundError:
+            return True
 
+        if state is not None and mtime is not None and state[0] is not None:
+            changed = mtime != state[0]
+        else:
+            try:
+                changed = self._hash_source(
+                    self._read_source(name)) != source_hash
+            except FileNotFoundError:
+                return True
+
+        if not changed:
+            self._source_state[name] = [mtime, now]
+        return changed
+
+    def _find_changed_sources(self, name, template):
+        now = time.monotonic()
+        sources = [(name, template.source_hash)]
+        sources.extend(template.dependencies.items())
+        return [
+            source_name
+            for source_name, source_hash in sources
+            if self._source_changed(source_name, source_hash, now)
+        ]
+
+    def _read_source(self, name):
         for source in self._sources:
             try:
                 f = source.open(name)
@@ -1293,18 +2312,146 @@ class TemplateLoader(metaclass=abc.ABCMeta):
             except FileNotFoundError:
                 pass
             except OSError as err:
-                logging.warn(
+                logger.warning(
                     "while searching for template %s: %s",
-                    ame, err)
+                    name, err)
         else:
             raise FileNotFoundError(name)
 
         try:
-            template = self.load_template(f.read(), name)
+            return f.read()
         finally:
             f.close()
 
-        self._cache[name] = template
+    @staticmethod
+    def _hash_source(buf):
+        if isinstance(buf, str):
+            buf = buf.encode("utf-8")
+        return hashlib.sha256(buf).hexdigest()
+
+    @contextlib.contextmanager
+    def _track_dependencies(self):
+        try:
+            stack = self._tracking.stack
+        except AttributeError:
+            stack = []
+            self._tracking.stack = stack
+
+        dependencies = {}
+        stack.append(dependencies)
+        try:
+            yield dependencies
+        finally:
+            stack.pop()
+
+    def _record_dependency(self, name, template):
+        self._record_dependencies({name: template.source_hash})
+        self._record_dependencies(template.dependencies)
+
+    def _record_dependencies(self, dependencies):
+        stack = getattr(self._tracking, "stack", None)
+        if not stack:
+            return
+        stack[-1].update(dependencies)
+
+    def _get_bytecode_key(self, name, source_hash):
+        fingerprint = [
+            importlib.util.MAGIC_NUMBER.hex(),
+            type(self).__qualname__,
+            name,
+            source_hash,
+        ]
+        if self._instrument_sections:
+            fingerprint.append("instrument_sections")
+        if self._minify_whitespace:
+            fingerprint.append("minify_whitespace")
+        fingerprint.extend(
+            processor.get_fingerprint()
+            for processor in self._processors)
+        return hashlib.sha256(
+            "\0".join(fingerprint).encode("utf-8")).hexdigest()
+
+    def _dependencies_current(self, dependencies):
+        for name, source_hash in dependencies.items():
+            try:
+                current_hash = self._cache[name].source_hash
+            except KeyError:
+                try:
+                    current_hash = self._hash_source(self._read_source(name))
+                except FileNotFoundError:
+                    return False
+            if current_hash != source_hash:
+                return False
+        return True
+
+    def _dump_template(self, template):
+        f = io.BytesIO()
+        pickler = _TemplatePickler(f, template, self)
+        pickler.dump((
+            template.storage,
+            [processor.get_template_state(template)
+             for processor in self._processors]
+        ))
+
+        return pickle.dumps(
+            {
+                "tree": etree.tostring(template.tree),
+                "code": marshal.dumps(template._code),
+                "dependencies": template.dependencies,
+                "folding": (template.compiled_elements,
+                            template.folded_elements),
+                "state": f.getvalue(),
+            },
+            pickle.HIGHEST_PROTOCOL)
+
+    def _restore_template(self, data, name, source_hash):
+        data = pickle.loads(data)
+        if not self._dependencies_current(data["dependencies"]):
+            return None
+
+        template = Template.from_code(
+            etree.fromstring(data["tree"]).getroottree(),
+            name,
+            marshal.loads(data["code"]),
+            loader=self)
+        template.source_hash = source_hash
+        template.dependencies = data["dependencies"]
+        template.compiled_elements, template.folded_elements = \
+            data["folding"]
+
+        storage, states = _TemplateUnpickler(
+            io.BytesIO(data["state"]),
+            template,
+            self).load()
+        template.storage.update(storage)
+        for processor, state in zip(self._processors, states):
+            processor.set_template_state(template, state)
+
+        return template
+
+    def _load_template_cached(self, buf, name):
+        source_hash = self._hash_source(buf)
+        key = self._get_bytecode_key(name, source_hash)
+
+        data = self._bytecode_cache.load(key)
+        if data is not None:
+            try:
+                template = self._restore_template(data, name, source_hash)
+            except Exception as err:
+                logger.warning("failed to restore template %s from bytecode"
+                               " cache: %s", name, err)
+                template = None
+            if template is not None:
+                return template
+
+        template = self.load_template(buf, name)
+        try:
+            data = self._dump_template(template)
+        except Exception as err:
+            logger.debug("not persisting template %s: %s", name, err)
+        else:
+            self._bytecode_cache.dump(key, data)
+
         return template
 
 class XMLTemplateLoader(TemplateLoader):
@@ -1317,5 +2464,5 @@ class XMLTemplateLoader(TemplateLoader):
     def _load_template_etree(self, buf, name):
         tree = etree.fromstring(
             buf,
-            parser=xml_parser).getroottree()
+            parser=get_xml_parser()).getroottree()
         return tree
@@ -0,0 +1,113 @@
+import concurrent.futures
+import threading
+import unittest
+
+import teapot.mime
+import teapot.request
+import teapot.response
+
+import xsltea.exec
+import xsltea.pipeline
+import xsltea.safe
+import xsltea.test_template
+import xsltea.utils
+
+class TestPerThread(unittest.TestCase):
+    def test_separate_instances(self):
+        per_thread = xsltea.utils.PerThread(object)
+        local = per_thread.get()
+        self.assertIs(per_thread.get(), local)
+
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            per_thread.get()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(results[0], local)
+
+class TestConcurrentRendering(xsltea.test_template.SourceDirTest,
+                              unittest.TestCase):
+    xmlsrc_layout = """\
+<layout xmlns:h="http://www.w3.org/1999/xhtml"
+        xmlns:exec="https://xmlns.zombofant.net/xsltea/exec">
+  <h:h1><exec:text>arguments["title"]</exec:text></h:h1>
+</layout>"""
+
+    xmlsrc_page = """\
+<h:html xmlns:h="http://www.w3.org/1999/xhtml"
+        xmlns:tea="https://xmlns.zombofant.net/xsltea/processors"
+        xmlns:exec="https://xmlns.zombofant.net/xsltea/exec">
+  <h:body>
+    <tea:include src="layout.xml" xpath="/layout/*" />
+    <h:ul>
+      <tea:for-each bind="item" from="arguments['items']">
+        <h:li exec:class="'page{}'"><exec:text>item</exec:text></h:li>
+      </tea:for-each>
+    </h:ul>
+  </h:body>
+</h:html>"""
+
+    xsl = """\
+<xsl:stylesheet version="1.0"
+    xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+  <xsl:import href="xsltea:identity.xsl" />
+</xsl:stylesheet>"""
+
+    xsl_identity = """\
+<xsl:stylesheet version="1.0"
+    xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+  <xsl:template match="@*|node()">
+    <xsl:copy><xsl:apply-templates select="@*|node()" /></xsl:copy>
+  </xsl:template>
+</xsl:stylesheet>"""
+
+    pages = 20
+    renders = 400
+
+    def setUp(self):
+        super().setUp()
+        self._write("layout.xml", self.xmlsrc_layout)
+        for i in range(self.pages):
+            self._write("page{}.xml".format(i),
+                        self.xmlsrc_page.replace("{}", str(i)))
+        self._write("transform.xsl", self.xsl)
+        self._write("identity.xsl", self.xsl_identity)
+
+        self._loader = self._make_loader(
+            xsltea.exec.ExecProcessor,
+            xsltea.safe.IncludeProcessor,
+            xsltea.safe.ForeachProcessor(
+                safety_level=xsltea.safe.SafetyLevel.experimental))
+
+        self._pipeline = xsltea.pipeline.XHTMLPipeline()
+        self._pipeline.loader = self._loader
+        self._pipeline.local_transforms.append(
+            xsltea.pipeline.TransformLoader(
+                self._make_source()).load_transform("transform.xsl"))
+
+    def _render(self, i):
+        page = i % self.pages
+        arguments = {"title": "page {}".format(page),
+                     "items": list(range(i % 7))}
+
+        def routable():
+            yield teapot.response.Response(None)
+            yield arguments, {}
+
+        request = teapot.request.Request(user_agent="Firefox/6.0")
+        request.accepted_content_type = teapot.mime.Type.text_html
+        template = self._loader.get_template("page{}.xml".format(page))
+        _, body = self._pipeline._decorated_process(
+            {}, template, request, routable())
+        return body
+
+    def test_thread_pool(self):
+        expected = [self._render(i) for i in range(self.renders)]
+        self.assertIn(b"<h1>page 3</h1>", expected[3])
+        self.assertIn(b'<li class="page3">2</li>', expected[3])
+
+        self._loader.invalidate("layout.xml")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(self._render, range(self.renders)))
+
+        self.assertEqual(expected, results)
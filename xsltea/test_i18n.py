@@ -1,7 +1,12 @@
+import gc
 import unittest
 
 from datetime import date, time, datetime, timedelta
 
+import lxml.etree as etree
+
+import pytz
+
 import teapot.accept
 
 from . import i18n
@@ -59,6 +64,34 @@ class TestLocalizer(unittest.TestCase):
         with self.assertRaises(AttributeError):
             l.text_sources = l.text_sources
 
+    def test_lazy_binding(self):
+        l = i18n.Localizer(("de", "de"), [None])
+        self.assertNotIn("format_date", vars(l))
+        self.assertEqual(
+            l.format_date(date(2014, 7, 6), "d. MMMM y"),
+            "6. Juli 2014")
+        self.assertIn("format_date", vars(l))
+        self.assertEqual(
+            l.format_decimal(1234.5, format="#,##0.00"),
+            "1.234,50")
+        with self.assertRaises(AttributeError):
+            l.format_nonexistent
+
+    def test_with_timezone(self):
+        l = i18n.Localizer(("de", "de"), [None])
+        tz = pytz.timezone("Europe/Berlin")
+        l_tz = l.with_timezone(tz)
+        self.assertIs(l_tz.timezone, tz)
+        self.assertIs(l.with_timezone(tz), l_tz)
+        self.assertIs(l_tz.with_timezone(None), l)
+        self.assertEqual(l_tz, l)
+        self.assertEqual(
+            l_tz.format_time(datetime(2014, 7, 6, 12, 34, 56), "HH:mm"),
+            "14:34")
+        self.assertEqual(
+            l.format_time(datetime(2014, 7, 6, 12, 34, 56), "HH:mm"),
+            "12:34")
+
 class TextDatabaseTest:
     def setUp(self):
         super().setUp()
@@ -242,6 +275,38 @@ class TestTextDatabase(TextDatabaseTest, unittest.TestCase):
             ).locale,
             ("en", None))
 
+    def test_negotiation_cache(self):
+        textdb = self.textdb
+        info = textdb._cached_negotiate_locale.cache_info
+        for i in range(2):
+            self.assertEqual(
+                textdb.get_localizer_by_client_preference(
+                    simple_preflist("de-at;q=1.0,en;q=0.9")
+                ).locale,
+                ("en", None))
+        self.assertEqual(info().hits, 1)
+
+        textdb["de", "at"] = i18n.DictLookup({})
+        self.assertEqual(info().currsize, 0)
+        self.assertEqual(
+            textdb.get_localizer_by_client_preference(
+                simple_preflist("de-at;q=1.0,en;q=0.9")
+            ).locale,
+            ("de", "at"))
+
+    def test_cache_shared_across_timezones(self):
+        textdb = self.textdb
+        tz = pytz.timezone("Europe/Berlin")
+        localizer_base = textdb.get_localizer("de-de")
+        localizer_tz = textdb.get_localizer("de-de", timezone=tz)
+        self.assertIs(localizer_tz.timezone, tz)
+        self.assertIs(textdb.get_localizer("de-de", timezone=tz),
+                      localizer_tz)
+        self.assertIs(localizer_tz.text_sources[0],
+                      localizer_base.text_sources[0])
+        self.assertEqual(
+            textdb._cached_get_localizer.cache_info().currsize, 1)
+
 class TestI18NProcessor(TextDatabaseTest, unittest.TestCase):
     xmlsrc_gettext = """<?xml version="1.0" ?>
 <test xmlns:exec="https://xmlns.zombofant.net/xsltea/exec"
@@ -275,20 +340,23 @@ class TestI18NProcessor(TextDatabaseTest, unittest.TestCase):
         template = self._loader.load_template(xmlstr, "<string>")
         return template
 
+    def _make_request(self, accept_language):
+        accept_language_list = teapot.accept.LanguagePreferenceList()
+        accept_language_list.append_header(accept_language)
+        return teapot.request.Request(
+            accept_info=(
+                teapot.accept.all_content_types(),
+                accept_language_list,
+                teapot.accept.all_charsets()
+            ))
+
     def _process_xml(self, xmlstr,
                      accept_language="en-gb;q=1.0",
                      **arguments):
-        accept_language_list = teapot.accept.LanguagePreferenceList()
-        accept_language_list.append_header(accept_language)
         template = self._load_xml(xmlstr)
         return template.process(
             arguments,
-            request=teapot.request.Request(
-                accept_info=(
-                    teapot.accept.all_content_types(),
-                    accept_language_list,
-                    teapot.accept.all_charsets()
-                )))
+            request=self._make_request(accept_language))
 
     def test_gettext(self):
         tree = self._process_xml(self.xmlsrc_gettext)
@@ -316,6 +384,31 @@ class TestI18NProcessor(TextDatabaseTest, unittest.TestCase):
             tree.getroot()[0].tail,
             " BAZ")
 
+    def test_gettext_with_markup_streamed(self):
+        template = self._load_xml(self.xmlsrc_with_markup)
+        request = self._make_request("en-gb;q=1.0")
+        self.assertEqual(
+            etree.tostring(etree.fromstring(
+                b"".join(template.stream({}, request=request)))),
+            etree.tostring(template.process({}, request=request)))
+
+    def test_parsed_translation_cache(self):
+        template = self._load_xml(self.xmlsrc_with_markup)
+        request = self._make_request("en-gb;q=1.0")
+        i18n._parse_translation.cache_clear()
+        for i in range(3):
+            tree = template.process({}, request=request)
+            self.assertEqual(tree.getroot()[0].tail, " BAZ")
+        info = i18n._parse_translation.cache_info()
+        self.assertEqual(info.misses, 1)
+        self.assertEqual(info.hits, 2)
+
+    def test_plain_translation_not_parsed(self):
+        i18n._parse_translation.cache_clear()
+        tree = self._process_xml(self.xmlsrc_gettext)
+        self.assertEqual(tree.getroot().text, "british english")
+        self.assertEqual(i18n._parse_translation.cache_info().misses, 0)
+
     def test_magic_key(self):
         tree = self._process_xml(
             self.xmlsrc_magic,
@@ -372,3 +465,83 @@ class TestI18NProcessor(TextDatabaseTest, unittest.TestCase):
         self.assertEqual(
             tree.getroot().text,
             "deutsch (deutschland)")
+
+    def test_cache_per_locale(self):
+        cache_processor = safe.CacheProcessor()
+        self._loader.add_processor(cache_processor)
+        template = self._load_xml("""<?xml version="1.0" ?>
+<test xmlns:tea="https://xmlns.zombofant.net/xsltea/processors"
+      xmlns:i18n="https://xmlns.zombofant.net/xsltea/i18n"
+    ><tea:cache><i18n:_>key</i18n:_></tea:cache></test>""")
+
+        results = [
+            template.process(
+                {},
+                request=self._make_request(accept_language)).getroot().text
+            for accept_language in ["en-gb;q=1.0", "de-de;q=1.0",
+                                    "en-gb;q=1.0"]
+        ]
+
+        self.assertEqual(results[0], results[2])
+        self.assertNotEqual(results[0], results[1])
+        self.assertEqual(cache_processor.cache.hits, 1)
+        self.assertEqual(cache_processor.cache.misses, 2)
+
+        # localizers of the same locale compare equal, but must not share
+        # fragments if their timezones differ
+        for timezone in ["Europe/Berlin", "Europe/Berlin"]:
+            request = self._make_request("en-gb;q=1.0")
+            request.timezone = pytz.timezone(timezone)
+            template.process({}, request=request)
+        self.assertEqual(cache_processor.cache.hits, 2)
+        self.assertEqual(cache_processor.cache.misses, 3)
+
+    def test_folded_translation_releases_localizers(self):
+        folded = i18n._FoldedTranslation("key", False)
+        localizer = i18n.Localizer(("en", "gb"),
+                                   [i18n.DictLookup({"key": "value"})])
+        self.assertEqual(folded.lookup(localizer), "value")
+        self.assertEqual(len(folded.translations), 1)
+        del localizer
+        gc.collect()
+        self.assertEqual(len(folded.translations), 0)
+
+    def test_fold_translations(self):
+        xmlsrc = """<?xml version="1.0" ?>
+<test xmlns:i18n="https://xmlns.zombofant.net/xsltea/i18n"
+      i18n:title="key"
+    ><a><i18n:_>key</i18n:_></a><i18n:_>foo <strong i18n:id="strong">bar</strong> baz</i18n:_></test>"""
+
+        expected = {
+            accept_language: etree.tostring(self._process_xml(
+                xmlsrc, accept_language=accept_language))
+            for accept_language in ["en-gb;q=1.0", "de-de;q=1.0"]
+        }
+
+        lookups = []
+        source = self.textdb["de", "de"]
+        original_gettext = source.gettext
+        def gettext(key, ctxt=None):
+            lookups.append(key)
+            return original_gettext(key, ctxt=ctxt)
+        source.gettext = gettext
+
+        self._loader = template.XMLTemplateLoader()
+        self._loader.add_processor(i18n.I18NProcessor(
+            self.textdb,
+            fold_translations=True))
+
+        folded = self._load_xml(xmlsrc)
+        for i in range(2):
+            for accept_language, result in expected.items():
+                self.assertEqual(
+                    etree.tostring(folded.process(
+                        {},
+                        request=self._make_request(accept_language))),
+                    result)
+
+        # the attribute and the constant element are looked up only once, the
+        # element with children on each render
+        markup_msgid = "foo <xml id='strong'>bar</xml> baz"
+        self.assertEqual(sorted(lookups),
+                         sorted(["key", "key", markup_msgid, markup_msgid]))
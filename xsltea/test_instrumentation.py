@@ -0,0 +1,169 @@
+import logging
+import unittest
+import unittest.mock
+
+import lxml.etree as etree
+
+import teapot.mime
+import teapot.request
+import teapot.response
+
+import xsltea.exec
+import xsltea.instrumentation
+import xsltea.pipeline
+import xsltea.safe
+import xsltea.test_template
+
+class IdentityTransform(xsltea.pipeline.Transform):
+    def transform(self, tree, arguments):
+        return tree
+
+class TestInstrumentation(xsltea.test_template.SourceDirTest,
+                          unittest.TestCase):
+    xmlsrc_row = """\
+<row xmlns:exec="https://xmlns.zombofant.net/xsltea/exec"
+  ><exec:text>arguments["title"]</exec:text></row>"""
+
+    xmlsrc_lib = """\
+<lib xmlns:tea="https://xmlns.zombofant.net/xsltea/processors"
+     xmlns:exec="https://xmlns.zombofant.net/xsltea/exec">
+  <tea:def name="item">
+    <tea:arg name="value" />
+    <h:li xmlns:h="http://www.w3.org/1999/xhtml"
+      ><exec:text>value</exec:text></h:li>
+  </tea:def>
+</lib>"""
+
+    xmlsrc_page = """\
+<h:html xmlns:h="http://www.w3.org/1999/xhtml"
+        xmlns:tea="https://xmlns.zombofant.net/xsltea/processors"
+        xmlns:exec="https://xmlns.zombofant.net/xsltea/exec">
+  <h:body>
+    <tea:include src="row.xml" xpath="/row/node()" />
+    <h:ul>
+      <tea:for-each bind="i" from="arguments['items']">
+        <tea:call src="lib.xml" name="item">
+          <tea:pass name="value">i</tea:pass>
+        </tea:call>
+      </tea:for-each>
+    </h:ul>
+  </h:body>
+</h:html>"""
+
+    def setUp(self):
+        super().setUp()
+        self._write("row.xml", self.xmlsrc_row)
+        self._write("lib.xml", self.xmlsrc_lib)
+        self._write("page.xml", self.xmlsrc_page)
+        self.arguments = {"title": "foo", "items": [1, 2, 3]}
+
+    def _make_loader(self, **kwargs):
+        safety_level = xsltea.safe.SafetyLevel.experimental
+        return super()._make_loader(
+            xsltea.exec.ExecProcessor,
+            xsltea.safe.IncludeProcessor,
+            xsltea.safe.ForeachProcessor(safety_level=safety_level),
+            xsltea.safe.FunctionProcessor(safety_level=safety_level),
+            **kwargs)
+
+    def _render(self, pipeline, template):
+        arguments = self.arguments
+
+        def routable():
+            yield teapot.response.Response(None)
+            yield arguments, {}
+
+        request = teapot.request.Request(user_agent="Firefox/6.0")
+        request.accepted_content_type = teapot.mime.Type.text_html
+        _, *chunks = pipeline._decorated_process(
+            {}, template, request, routable())
+        return b"".join(chunks)
+
+    def test_process(self):
+        template = self._make_loader().get_template("page.xml")
+        stats = xsltea.instrumentation.RenderStats("page.xml")
+        tree = template.process(self.arguments, stats=stats)
+        self.assertEqual(list(stats.phases), ["process"])
+        self.assertEqual(stats.elements,
+                         sum(1 for _ in tree.iter(etree.Element)))
+        # sections are only recorded if instrumentation code is generated
+        self.assertEqual(stats.sections, [])
+
+    def test_sections(self):
+        loader = self._make_loader(instrument_sections=True)
+        template = loader.get_template("page.xml")
+        stats = xsltea.instrumentation.RenderStats("page.xml")
+        tree = template.process(self.arguments, stats=stats)
+        self.assertEqual(
+            [item.text for item in tree.iter("{*}li")],
+            ["1", "2", "3"])
+
+        self.assertEqual(
+            sorted(set(stats.get_section_totals())),
+            [("call", "item"),
+             ("for-each", "arguments['items']"),
+             ("include", "row.xml")])
+        self.assertEqual(
+            [kind for kind, _, _ in stats.sections].count("call"), 3)
+
+        # evaluating without stats must not fail
+        template.process(self.arguments)
+
+    def test_sections_change_bytecode_key(self):
+        self.assertNotEqual(
+            self._make_loader()._get_bytecode_key("page.xml", ""),
+            self._make_loader(instrument_sections=True)._get_bytecode_key(
+                "page.xml", ""))
+
+    def test_pipeline(self):
+        sink = xsltea.instrumentation.CollectingSink()
+        pipeline = xsltea.pipeline.XHTMLPipeline(instrumentation=sink)
+        pipeline.local_transforms.append(IdentityTransform())
+        template = self._make_loader().get_template("page.xml")
+
+        body = self._render(pipeline, template)
+
+        stats, = sink.records
+        self.assertEqual(stats.template_name, "page.xml")
+        self.assertEqual(
+            list(stats.phases),
+            ["arguments", "process", "transforms", "serialise"])
+        self.assertEqual(stats.bytes, len(body))
+        self.assertGreater(stats.elements, 0)
+
+    def test_streaming_pipeline(self):
+        sink = xsltea.instrumentation.CollectingSink()
+        pipeline = xsltea.pipeline.XHTMLPipeline(streaming=True,
+                                                 instrumentation=sink)
+        loader = self._make_loader(instrument_sections=True)
+        template = loader.get_template("page.xml")
+
+        body = self._render(pipeline, template)
+        self.assertEqual(
+            body,
+            self._render(xsltea.pipeline.XHTMLPipeline(), template))
+
+        stats, = sink.records
+        self.assertEqual(list(stats.phases), ["arguments", "render"])
+        self.assertEqual(stats.bytes, len(body))
+        self.assertIsNone(stats.elements)
+        self.assertIn(("for-each", "arguments['items']"),
+                      stats.get_section_totals())
+
+    def test_disabled(self):
+        pipeline = xsltea.pipeline.XHTMLPipeline()
+        template = self._make_loader().get_template("page.xml")
+        with unittest.mock.patch.object(
+                xsltea.instrumentation.RenderStats, "__init__") as init:
+            self._render(pipeline, template)
+        self.assertEqual(init.call_count, 0)
+
+    def test_logging_sink(self):
+        logger = logging.getLogger("xsltea.test_instrumentation")
+        sink = xsltea.instrumentation.LoggingSink(logger=logger,
+                                                  level=logging.INFO)
+        pipeline = xsltea.pipeline.XHTMLPipeline(instrumentation=sink)
+        template = self._make_loader().get_template("page.xml")
+        with self.assertLogs(logger, logging.INFO) as logs:
+            self._render(pipeline, template)
+        self.assertIn("page.xml", logs.output[0])
@@ -5,8 +5,12 @@ import lxml.etree as etree
 
 import teapot.mime
 import teapot.request
+import teapot.response
 
+import xsltea.exec
 import xsltea.pipeline
+import xsltea.template
+import xsltea.test_template
 
 class TestPipeline(unittest.TestCase):
     def test_chaining(self):
@@ -48,6 +52,23 @@ class TestPipeline(unittest.TestCase):
             pipe1.loader,
             pipe3.loader)
 
+    def test_head_skips_template(self):
+        class Template:
+            def process(self, arguments, request=None):
+                raise AssertionError("template processed for HEAD request")
+
+        def routable():
+            yield teapot.response.Response(None)
+            yield {}, {}
+
+        pipeline = xsltea.pipeline.XMLPipeline()
+        request = teapot.request.Request(method=teapot.request.Method.HEAD)
+        result = list(pipeline._decorated_process(
+            {}, Template(), request, routable()))
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0].content_type,
+                         teapot.mime.Type.application_xml.with_charset("utf-8"))
+
 class TestXMLPipeline(unittest.TestCase):
     def setUp(self):
         self.tree = etree.fromstring("""<?xml version="1.0"?>
@@ -161,6 +182,41 @@ class TestXHTMLPipeline(unittest.TestCase):
 </html>""".encode("utf-8"),
             result)
 
+    def test_templates_rendered_without_prefixes(self):
+        loader = xsltea.template.XMLTemplateLoader()
+        loader.add_processor(xsltea.exec.ExecProcessor)
+        template = loader.load_template("""\
+<h:html xmlns:h="http://www.w3.org/1999/xhtml"
+        xmlns:s="http://www.w3.org/2000/svg"
+        xmlns:exec="https://xmlns.zombofant.net/xsltea/exec">
+  <h:body>
+    <h:p><exec:text>arguments["text"]</exec:text></h:p>
+    <s:svg><s:text><exec:text>arguments["text"]</exec:text></s:text></s:svg>
+    <h:div><s:svg><s:g /></s:svg></h:div>
+  </h:body>
+</h:html>""", "<string>")
+
+        def routable():
+            yield teapot.response.Response(None)
+            yield {"text": "foo"}, {}
+
+        for user_agent in ["Firefox/6.0", "Firefox/8.0"]:
+            pipeline = xsltea.pipeline.XHTMLPipeline()
+            request = teapot.request.Request(user_agent=user_agent)
+            request.accepted_content_type = \
+                teapot.mime.Type.application_xhtml
+
+            expected = self._apply_transforms(
+                pipeline, request,
+                template.process({"text": "foo"}), {})
+
+            # the tree must not need to be transformed
+            pipeline._remove_prefixes_transform = None
+            _, result = pipeline._decorated_process(
+                {}, template, request, routable())
+            self.assertEqual(expected, result)
+            self.assertNotIn(b"s:", result)
+
 
 class TestTransform(unittest.TestCase):
     def test_xsl_transform(self):
@@ -189,3 +245,51 @@ class TestTransform(unittest.TestCase):
             {"something": "'bar'"})
         self.assertEqual("bar", tree.getroot().tag)
         self.assertEqual("bar", tree.getroot().attrib["attr"])
+
+class TestTransformLoader(xsltea.test_template.SourceDirTest,
+                          unittest.TestCase):
+    xsl = """<xsl:stylesheet version="1.0"
+        xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+  <xsl:import href="xsltea:base.xsl" />
+</xsl:stylesheet>"""
+
+    xsl_base = """<xsl:stylesheet version="1.0"
+        xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+  <xsl:template match="foo"><{} /></xsl:template>
+</xsl:stylesheet>"""
+
+    def setUp(self):
+        super().setUp()
+        self._write("main.xsl", self.xsl)
+        self._write("base.xsl", self.xsl_base.format("bar"))
+
+    def _make_loader(self, **kwargs):
+        return xsltea.pipeline.TransformLoader(self._make_source(), **kwargs)
+
+    def _apply(self, transform):
+        return transform.transform(etree.fromstring("<foo />"), {}).getroot()
+
+    def test_cache(self):
+        loader = self._make_loader()
+        transform = loader.load_transform("main.xsl")
+        self.assertEqual(self._apply(transform).tag, "bar")
+        self.assertIs(loader.load_transform("main.xsl"), transform)
+        self.assertEqual(loader.get_dependencies("main.xsl"), {"base.xsl"})
+
+        loader.invalidate("base.xsl")
+        self.assertIsNot(loader.load_transform("main.xsl"), transform)
+
+    def test_reload_on_dependency_change(self):
+        loader = self._make_loader(check_interval=0)
+        transform = loader.load_transform("main.xsl")
+        self.assertIs(loader.load_transform("main.xsl"), transform)
+
+        self._write("base.xsl", self.xsl_base.format("baz"), mtime=1)
+        transform = loader.load_transform("main.xsl")
+        self.assertEqual(self._apply(transform).tag, "baz")
+
+    def test_check_interval(self):
+        loader = self._make_loader(check_interval=3600)
+        transform = loader.load_transform("main.xsl")
+        self._write("base.xsl", self.xsl_base.format("baz"), mtime=1)
+        self.assertIs(loader.load_transform("main.xsl"), transform)
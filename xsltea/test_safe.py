@@ -1,11 +1,19 @@
+import ast
 import copy
+import os
+import tempfile
 import unittest
+import unittest.mock
 
 import lxml.etree as etree
 
+import teapot.templating
+
 import xsltea
 import xsltea.exec
 import xsltea.safe
+import xsltea.stream
+import xsltea.template
 import xsltea.namespaces
 
 class TestSafetyLevel_conservative(unittest.TestCase):
@@ -66,6 +74,28 @@ class TestSafetyLevel_experimental(unittest.TestCase):
     def test_dict(self):
         self.sl.check_code_safety("{name: value, '1': 2}")
 
+class TestSafetyLevel_compile_expression(unittest.TestCase):
+    def setUp(self):
+        self.sl = xsltea.safe.SafetyLevel.experimental.__class__()
+
+    def test_memoised(self):
+        with unittest.mock.patch.object(
+                self.sl, "check_safety",
+                wraps=self.sl.check_safety) as check_safety:
+            first = self.sl.compile_expression("a + b", "<test>")
+            second = self.sl.compile_expression("a + b", "<test>")
+            self.assertEqual(check_safety.call_count, 1)
+            self.sl.compile_expression("a + b", "<test>", mode="exec")
+            self.assertEqual(check_safety.call_count, 2)
+
+        self.assertIsNot(first, second)
+        self.assertEqual(ast.dump(first), ast.dump(second))
+
+    def test_unsafe_not_memoised(self):
+        for i in range(2):
+            with self.assertRaises(ValueError):
+                self.sl.compile_expression("_name", "<test>")
+
 class TestForeachProcessor(unittest.TestCase):
     xmlsrc_simple = """<?xml version="1.0" ?>
 <test xmlns:exec="https://xmlns.zombofant.net/xsltea/exec"
@@ -195,6 +225,46 @@ class TestForeachProcessor(unittest.TestCase):
             foo_attrs,
             [str(i+j) for i, j in zip(range(3), range(4, 8))])
 
+    def test_bulk_rows(self):
+        xmlsrc = """<?xml version="1.0" ?>
+<test xmlns:exec="https://xmlns.zombofant.net/xsltea/exec"
+      xmlns:tea="https://xmlns.zombofant.net/xsltea/processors">
+<tea:for-each bind="i, name" from="arguments['rows']">x<tr id="r"
+    exec:class="'odd' if i % 2 else None"><td>#<exec:text>i</exec:text>
+    <b>b</b><exec:text>name</exec:text>t</td><td /></tr>tail</tea:for-each>
+</test>"""
+        arguments = {"rows": [(i, "n{}".format(i)) for i in range(4)]}
+
+        results = []
+        for bulk_rows in [False, True]:
+            loader = xsltea.template.XMLTemplateLoader()
+            loader.add_processor(xsltea.exec.ExecProcessor)
+            loader.add_processor(xsltea.safe.ForeachProcessor(
+                safety_level=xsltea.safe.SafetyLevel.experimental,
+                bulk_rows=bulk_rows))
+            template = loader.load_template(xmlsrc, "<string>")
+            self.assertEqual(
+                bulk_rows,
+                any(isinstance(obj, xsltea.stream.RowTemplate)
+                    for obj in template.storage.values()))
+            results.append((
+                etree.tostring(template.process(arguments)),
+                b"".join(template.stream(arguments))))
+
+        self.assertEqual(results[0], results[1])
+        tree = etree.fromstring(results[1][0])
+        self.assertEqual(
+            [tr.get("class") for tr in tree.findall("tr")],
+            [None, "odd", None, "odd"])
+        self.assertEqual(tree.find("tr/td").text, "#0\n    ")
+        self.assertEqual(tree.find("tr/td/b").tail, "n0t")
+
+    def test_bulk_rows_fallback(self):
+        template = self._load_xml(self.xmlsrc_with_exec_local)
+        self.assertFalse(any(
+            isinstance(obj, xsltea.stream.RowTemplate)
+            for obj in template.storage.values()))
+
 class TestFunctionProcessor(unittest.TestCase):
     xmlsrc_def_and_call = """\
 <test xmlns:tea="https://xmlns.zombofant.net/xsltea/processors"
@@ -275,6 +345,55 @@ class TestFunctionProcessor(unittest.TestCase):
         self.assertEqual("foo", evalelem3.find("a").text)
         self.assertEqual("1", evalelem3.find("b").text)
 
+    def test_library(self):
+        macros = """\
+<macros xmlns:tea="https://xmlns.zombofant.net/xsltea/processors"
+        xmlns:exec="https://xmlns.zombofant.net/xsltea/exec">
+  <tea:def name="test">
+    <tea:arg name="a" />
+    <library><exec:text>a</exec:text></library>
+  </tea:def>
+  <tea:def name="other"><library /></tea:def>
+</macros>"""
+        page = """\
+<test xmlns:tea="https://xmlns.zombofant.net/xsltea/processors"
+      xmlns:exec="https://xmlns.zombofant.net/xsltea/exec">
+  <tea:def name="other"><local /></tea:def>
+  <a><tea:call name="test"><tea:pass name="a">1</tea:pass></tea:call></a>
+  <b><tea:call name="other" /></b>
+</test>"""
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name, source in [("macros.xml", macros),
+                                 ("page1.xml", page),
+                                 ("page2.xml", page)]:
+                with open(os.path.join(tmpdir, name), "w") as f:
+                    f.write(source)
+
+            loader = xsltea.template.XMLTemplateLoader(
+                teapot.templating.FileSystemSource(tmpdir))
+            loader.add_processor(xsltea.exec.ExecProcessor)
+            loader.add_processor(xsltea.safe.FunctionProcessor(
+                safety_level=xsltea.safe.SafetyLevel.experimental,
+                libraries=["macros.xml"]))
+
+            page1 = loader.get_template("page1.xml")
+            page2 = loader.get_template("page2.xml")
+
+        library = xsltea.safe.FunctionProcessor.template_libraries[
+            loader.get_template("macros.xml")]
+        self.assertIn(library["test"], page1.storage.values())
+        self.assertIn(library["test"], page2.storage.values())
+        self.assertIn("macros.xml", page1.dependencies)
+
+        tree = page1.process({})
+        self.assertEqual("1", tree.getroot().find("a/library").text)
+        # local definitions take precedence
+        self.assertIsNotNone(tree.getroot().find("b/local"))
+
+        with self.assertRaises(ValueError):
+            self._load_xml(page)
+
 class TestGlobalsProcessor(unittest.TestCase):
     xmlsrc_simple = """<?xml version="1.0"?>
 <test xmlns:exec="https://xmlns.zombofant.net/xsltea/exec">
@@ -301,3 +420,68 @@ class TestGlobalsProcessor(unittest.TestCase):
         self.assertEqual(
             "foobar",
             tree.getroot().text)
+
+class TestCacheProcessor(unittest.TestCase):
+    xmlsrc = """<?xml version="1.0" ?>
+<test xmlns:exec="https://xmlns.zombofant.net/xsltea/exec"
+      xmlns:tea="https://xmlns.zombofant.net/xsltea/processors"
+    ><tea:cache key="arguments['key']" ttl="10">a<b><exec:text>arguments['calls'].append(1) or len(arguments['calls'])</exec:text></b>c</tea:cache>d</test>"""
+
+    def setUp(self):
+        self._now = 0
+        self._cache = xsltea.safe.FragmentCache(
+            max_size=2,
+            clock=lambda: self._now)
+        self._loader = xsltea.template.XMLTemplateLoader()
+        self._loader.add_processor(xsltea.exec.ExecProcessor)
+        self._loader.add_processor(xsltea.safe.CacheProcessor(
+            safety_level=xsltea.safe.SafetyLevel.experimental,
+            cache=self._cache))
+        self._template = self._loader.load_template(self.xmlsrc, "<string>")
+        self._calls = []
+
+    def _process(self, key):
+        tree = self._template.process({"key": key, "calls": self._calls})
+        return etree.tostring(tree)
+
+    def test_reuse(self):
+        first = self._process("x")
+        self.assertEqual(first, b"<test>a<b>1</b>cd</test>")
+        self.assertEqual(self._process("x"), first)
+        self.assertEqual(len(self._calls), 1)
+        self.assertEqual(self._cache.hits, 1)
+        self.assertEqual(self._cache.misses, 1)
+
+    def test_key(self):
+        self._process("x")
+        self.assertEqual(self._process("y"), b"<test>a<b>2</b>cd</test>")
+        self.assertEqual(self._process("x"), b"<test>a<b>1</b>cd</test>")
+
+    def test_ttl(self):
+        self._process("x")
+        self._now = 9
+        self._process("x")
+        self.assertEqual(len(self._calls), 1)
+        self._now = 10
+        self.assertEqual(self._process("x"), b"<test>a<b>2</b>cd</test>")
+
+    def test_bounded(self):
+        for key in ["x", "y", "z"]:
+            self._process(key)
+        self.assertEqual(len(self._cache), 2)
+        self._process("x")
+        self.assertEqual(len(self._calls), 4)
+
+    def test_stream(self):
+        self._process("x")
+        self.assertEqual(
+            b"".join(self._template.stream(
+                {"key": "x", "calls": self._calls},
+                serialiser=xsltea.stream.Serialiser(xml_declaration=False))),
+            b"<test>a<b>1</b>cd</test>")
+
+    def test_key_safety(self):
+        with self.assertRaises(ValueError):
+            self._loader.load_template("""<?xml version="1.0" ?>
+<test xmlns:tea="https://xmlns.zombofant.net/xsltea/processors"
+    ><tea:cache key="open('foo')" /></test>""", "<string>")
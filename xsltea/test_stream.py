@@ -0,0 +1,185 @@
+import unittest
+
+import lxml.etree as etree
+
+import teapot.mime
+import teapot.request
+import teapot.response
+
+import xsltea.exec
+import xsltea.pipeline
+import xsltea.safe
+import xsltea.stream
+import xsltea.template
+
+class TestTemplateStream(unittest.TestCase):
+    xmlsrc = """\
+<test xmlns:tea="https://xmlns.zombofant.net/xsltea/processors"
+      xmlns:exec="https://xmlns.zombofant.net/xsltea/exec"
+      xmlns:foo="uri:foo">
+  <tea:def name="cell">
+    <tea:arg name="value" />
+    <td><exec:text>value</exec:text></td>
+  </tea:def>
+  <table foo:attr="1">
+    <tea:for-each bind="row" from="arguments['rows']">
+      <tr><tea:for-each bind="col" from="row">
+        <tea:call name="cell"><tea:pass name="value">col</tea:pass></tea:call>
+      </tea:for-each></tr>
+    </tea:for-each>
+  </table>
+  <foo:bar>a &lt; b<!-- comment -->tail</foo:bar>
+  <empty />
+</test>"""
+
+    def setUp(self):
+        self._loader = xsltea.template.XMLTemplateLoader()
+        self._loader.add_processor(xsltea.exec.ExecProcessor)
+        self._loader.add_processor(xsltea.safe.ForeachProcessor(
+            safety_level=xsltea.safe.SafetyLevel.experimental))
+        self._loader.add_processor(xsltea.safe.FunctionProcessor(
+            safety_level=xsltea.safe.SafetyLevel.experimental))
+        self._template = self._loader.load_template(self.xmlsrc, "<string>")
+
+    def test_equivalent_to_process(self):
+        arguments = {"rows": [[1, 2], [3, 4], [5, 6]]}
+        expected = self._template.process(arguments)
+        streamed = etree.fromstring(
+            b"".join(self._template.stream(arguments)))
+
+        self.assertEqual(
+            etree.tostring(expected, method="c14n"),
+            etree.tostring(streamed.getroottree(), method="c14n"))
+
+    def test_incremental(self):
+        evaluated = []
+        def rows():
+            for i in range(100):
+                evaluated.append(i)
+                yield [i]
+
+        chunks = self._template.stream(
+            {"rows": rows()},
+            serialiser=xsltea.stream.Serialiser(chunk_size=64))
+        first = next(chunks)
+        self.assertTrue(first.startswith(b"<?xml"))
+        self.assertLess(len(evaluated), 100)
+
+        rest = b"".join(chunks)
+        self.assertEqual(len(evaluated), 100)
+        self.assertEqual(
+            len(etree.fromstring(first + rest).findall("table/tr")),
+            100)
+
+    def test_errors_are_wrapped(self):
+        with self.assertRaises(xsltea.errors.TemplateEvaluationError):
+            list(self._template.stream({"rows": None}))
+
+    def test_nested_process(self):
+        arguments = {"rows": [[1]]}
+        # the template may be evaluated as a tree while it is being streamed
+        chunks = self._template.stream(
+            arguments,
+            serialiser=xsltea.stream.Serialiser(chunk_size=1))
+        first = next(chunks)
+        tree = self._template.process(arguments)
+        self.assertEqual(tree.find("table/tr/td").text, "1")
+        self.assertIn(b"<td>1</td>", first + b"".join(chunks))
+
+class TestSerialiser(unittest.TestCase):
+    xhtml = "http://www.w3.org/1999/xhtml"
+    svg = "http://www.w3.org/2000/svg"
+
+    def _serialise(self, root, **kwargs):
+        serialiser = xsltea.stream.Serialiser(**kwargs)
+        return b"".join(serialiser.serialise(lambda: root, {}))
+
+    def _tree(self):
+        root = etree.Element("{{{}}}html".format(self.xhtml))
+        body = etree.SubElement(root, "{{{}}}body".format(self.xhtml))
+        etree.SubElement(body, "{{{}}}br".format(self.xhtml)).tail = "x"
+        script = etree.SubElement(body, "{{{}}}script".format(self.xhtml))
+        script.text = "a < b"
+        etree.SubElement(
+            etree.SubElement(body, "{{{}}}svg".format(self.svg)),
+            "{{{}}}g".format(self.svg))
+        return root
+
+    def test_html(self):
+        self.assertEqual(
+            self._serialise(
+                self._tree(),
+                method="html",
+                doctype="<!DOCTYPE html>",
+                default_namespaces=(self.xhtml, self.svg)),
+            b'<!DOCTYPE html>\n'
+            b'<html xmlns="http://www.w3.org/1999/xhtml"><body><br>x'
+            b'<script>a < b</script>'
+            b'<svg xmlns="http://www.w3.org/2000/svg"><g></g></svg>'
+            b'</body></html>')
+
+    def test_xml(self):
+        self.assertEqual(
+            self._serialise(self._tree(), xml_declaration=False),
+            b'<html:html xmlns:html="http://www.w3.org/1999/xhtml">'
+            b'<html:body><html:br/>x<html:script>a &lt; b</html:script>'
+            b'<ns0:svg xmlns:ns0="http://www.w3.org/2000/svg"><ns0:g/></ns0:svg>'
+            b'</html:body></html:html>')
+
+    def test_encoding(self):
+        root = etree.Element("foo", attr='"✓"')
+        root.text = "ä✓"
+        self.assertEqual(
+            self._serialise(root, encoding="latin1"),
+            b"<?xml version='1.0' encoding='latin1'?>\n"
+            b'<foo attr="&quot;&#10003;&quot;">\xe4&#10003;</foo>')
+
+    def test_undeclare_default_namespace(self):
+        root = etree.Element("{{{}}}html".format(self.xhtml))
+        etree.SubElement(root, "foo")
+        self.assertEqual(
+            self._serialise(root,
+                            xml_declaration=False,
+                            default_namespaces=(self.xhtml,)),
+            b'<html xmlns="http://www.w3.org/1999/xhtml"><foo xmlns=""/>'
+            b'</html>')
+
+class TestStreamingPipeline(unittest.TestCase):
+    xmlsrc = """\
+<h:html xmlns:h="http://www.w3.org/1999/xhtml"
+        xmlns:exec="https://xmlns.zombofant.net/xsltea/exec">
+  <h:body><h:p><exec:text>arguments["text"]</exec:text></h:p></h:body>
+</h:html>"""
+
+    def _render(self, pipeline, user_agent):
+        loader = xsltea.template.XMLTemplateLoader()
+        loader.add_processor(xsltea.exec.ExecProcessor)
+        template = loader.load_template(self.xmlsrc, "<string>")
+
+        def routable():
+            yield teapot.response.Response(None)
+            yield {"text": "foo"}, {}
+
+        request = teapot.request.Request(user_agent=user_agent)
+        request.accepted_content_type = teapot.mime.Type.application_xhtml
+        response, *body = pipeline._decorated_process(
+            {}, template, request, routable())
+        return b"".join(body)
+
+    def test_matches_tree_output(self):
+        for user_agent in ["Firefox/6.0",
+                           "Firefox/8.0",
+                           "Opera/0.0 Version/13.0"]:
+            tree_result = self._render(
+                xsltea.pipeline.XHTMLPipeline(),
+                user_agent)
+            stream_result = self._render(
+                xsltea.pipeline.XHTMLPipeline(streaming=True),
+                user_agent)
+            self.assertEqual(tree_result, stream_result)
+
+    def test_transforms_disable_streaming(self):
+        pipeline = xsltea.pipeline.XHTMLPipeline(streaming=True)
+        self.assertTrue(pipeline._use_streaming())
+        pipeline.local_transforms.append(object())
+        self.assertFalse(pipeline._use_streaming())
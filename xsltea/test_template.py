@@ -1,11 +1,19 @@
 import ast
+import os
+import pickle
+import tempfile
 import unittest
+import unittest.mock
 
 import lxml.etree as etree
 
 import teapot.request
+import teapot.templating
 
+import xsltea.bytecode
 import xsltea.exec
+import xsltea.safe
+import xsltea.stream
 import xsltea.template
 import xsltea.processor
 import xsltea.namespaces
@@ -137,3 +145,501 @@ class TestTemplateLoader(unittest.TestCase):
         self.assertTrue(
             any(isinstance(obj, xsltea.exec.ExecProcessor)
                 for obj in self._loader.processors))
+
+class TestHookTable(unittest.TestCase):
+    def setUp(self):
+        self._table = xsltea.template.HookTable({
+            ("uri:a", None): ["any"],
+            ("uri:a", "b"): ["b"],
+            ("uri:a", None, "uri:c", None): ["attr"],
+        })
+
+    def test_lookup(self):
+        self.assertEqual(self._table.lookup_elem("{uri:a}b"), ["b"])
+        self.assertEqual(self._table.lookup_elem("{uri:a}x"), ["any"])
+        self.assertIsNone(self._table.lookup_elem("x"))
+        self.assertEqual(self._table.lookup_attr("{uri:a}x", "{uri:c}d"),
+                         ["attr"])
+        self.assertIsNone(self._table.lookup_attr("x", "{uri:c}d"))
+
+    def test_derive_is_copy_on_write(self):
+        derived = self._table.derive()
+        self.assertEqual(derived.lookup_elem("{uri:a}x"), ["any"])
+        derived[("uri:a", None)].insert(0, "inserted")
+        derived.setdefault(("uri:a", "x"), []).append("x")
+
+        self.assertEqual(derived.lookup_elem("{uri:a}y"),
+                         ["inserted", "any"])
+        self.assertEqual(derived.lookup_elem("{uri:a}x"), ["x"])
+        self.assertEqual(self._table.lookup_elem("{uri:a}y"), ["any"])
+        self.assertEqual(self._table.lookup_elem("{uri:a}x"), ["any"])
+
+        derived[("uri:a", None)].pop(0)
+        self.assertEqual(derived.lookup_elem("{uri:a}y"), ["any"])
+
+    def test_derive_copies_on_bulk_access(self):
+        derived = self._table.derive()
+        self.assertEqual(derived.lookup_elem("{uri:a}b"), ["b"])
+        for hooks in derived.values():
+            hooks.append("value")
+        for _, hooks in derived.items():
+            hooks.append("item")
+        self.assertEqual(derived.lookup_elem("{uri:a}b"),
+                         ["b", "value", "item"])
+        self.assertEqual(self._table.lookup_elem("{uri:a}b"), ["b"])
+
+        derived.update({("uri:a", "b"): ["updated"]})
+        self.assertEqual(derived.lookup_elem("{uri:a}b"), ["updated"])
+        derived.clear()
+        self.assertIsNone(derived.lookup_elem("{uri:a}b"))
+        self.assertEqual(self._table.lookup_elem("{uri:a}b"), ["b"])
+
+class SourceDirTest:
+    def setUp(self):
+        super().setUp()
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self._srcdir = os.path.join(self._tmpdir.name, "src")
+        os.makedirs(self._srcdir)
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+        super().tearDown()
+
+    def _write(self, name, source, mtime=None):
+        path = os.path.join(self._srcdir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(source)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def _make_source(self):
+        return teapot.templating.FileSystemSource(self._srcdir)
+
+    def _make_loader(self, *processors, **loader_kwargs):
+        loader = xsltea.template.XMLTemplateLoader(
+            self._make_source(),
+            **loader_kwargs)
+        for processor in processors:
+            loader.add_processor(processor)
+        return loader
+
+class TestBytecodeCache(SourceDirTest, unittest.TestCase):
+    xmlsrc_lib = """\
+<lib xmlns:tea="https://xmlns.zombofant.net/xsltea/processors"
+     xmlns:exec="https://xmlns.zombofant.net/xsltea/exec">
+  <tea:def name="greet">
+    <tea:arg name="who" />
+    <greeting><exec:text>"Hello, " + who</exec:text></greeting>
+  </tea:def>
+  <part>included</part>
+</lib>"""
+
+    xmlsrc_main = """\
+<test xmlns:tea="https://xmlns.zombofant.net/xsltea/processors"
+      xmlns:exec="https://xmlns.zombofant.net/xsltea/exec">
+  <tea:include src="lib.xml" xpath="/lib/part" />
+  <tea:call src="lib.xml" name="greet">
+    <tea:pass name="who">arguments["who"]</tea:pass>
+  </tea:call>
+  <global><exec:text>greeting</exec:text></global>
+</test>"""
+
+    def setUp(self):
+        super().setUp()
+        self._cache = xsltea.bytecode.FileSystemBytecodeCache(
+            os.path.join(self._tmpdir.name, "cache"))
+        self._write("lib.xml", self.xmlsrc_lib)
+        self._write("main.xml", self.xmlsrc_main)
+
+    def _make_loader(self, greeting="Hello"):
+        globals_processor = xsltea.safe.GlobalsProcessor()
+        globals_processor.names["greeting"] = greeting
+        return super()._make_loader(
+            xsltea.exec.ExecProcessor,
+            xsltea.safe.IncludeProcessor,
+            xsltea.safe.FunctionProcessor(
+                safety_level=xsltea.safe.SafetyLevel.experimental),
+            globals_processor,
+            bytecode_cache=self._cache)
+
+    def _render(self, loader):
+        tree = loader.get_template("main.xml").process({"who": "World"})
+        return (tree.getroot().find("part").text,
+                tree.getroot().find("greeting").text,
+                tree.getroot().find("global").text)
+
+    def _count_compiles(self):
+        return unittest.mock.patch.object(
+            xsltea.template.Template, "parse_tree",
+            autospec=True,
+            side_effect=xsltea.template.Template.parse_tree)
+
+    def test_restore(self):
+        self.assertEqual(
+            self._render(self._make_loader()),
+            ("included", "Hello, World", "Hello"))
+
+        with self._count_compiles() as parse_tree:
+            loader = self._make_loader()
+            self.assertEqual(
+                self._render(loader),
+                ("included", "Hello, World", "Hello"))
+        self.assertEqual(parse_tree.call_count, 0)
+
+        template = loader.get_template("main.xml")
+        self.assertIn("lib.xml", template.dependencies)
+
+    def test_globals_are_relinked(self):
+        self._render(self._make_loader())
+        with self._count_compiles() as parse_tree:
+            self.assertEqual(
+                self._render(self._make_loader(greeting="Hi")),
+                ("included", "Hello, World", "Hi"))
+        self.assertEqual(parse_tree.call_count, 0)
+
+    def test_dependency_change_recompiles(self):
+        self._render(self._make_loader())
+        self._write("lib.xml",
+                    self.xmlsrc_lib.replace("included", "changed"))
+        with self._count_compiles() as parse_tree:
+            self.assertEqual(
+                self._render(self._make_loader()),
+                ("changed", "Hello, World", "Hello"))
+        self.assertEqual(parse_tree.call_count, 2)
+
+    def test_processor_change_recompiles(self):
+        self._render(self._make_loader())
+        loader = self._make_loader()
+        loader.processors[-1].names["other"] = 1
+        with self._count_compiles() as parse_tree:
+            self._render(loader)
+        self.assertEqual(parse_tree.call_count, 2)
+
+class TestTemplateCache(SourceDirTest, unittest.TestCase):
+    xmlsrc_part = """<part>{}</part>"""
+
+    xmlsrc_main = """\
+<test xmlns:tea="https://xmlns.zombofant.net/xsltea/processors">
+  <tea:include src="part.xml" />
+</test>"""
+
+    xmlsrc_other = """<other />"""
+
+    def setUp(self):
+        super().setUp()
+        self._write("part.xml", self.xmlsrc_part.format("a"))
+        self._write("main.xml", self.xmlsrc_main)
+        self._write("other.xml", self.xmlsrc_other)
+
+    def _make_loader(self, **kwargs):
+        return super()._make_loader(xsltea.safe.IncludeProcessor, **kwargs)
+
+    def test_lru(self):
+        loader = self._make_loader(cache_size=2)
+        part = loader.get_template("part.xml")
+        other = loader.get_template("other.xml")
+        self.assertIs(loader.get_template("part.xml"), part)
+        # main pulls in part, so that other is the least recently used one
+        loader.get_template("main.xml")
+        self.assertIs(loader.get_template("part.xml"), part)
+        self.assertIsNot(loader.get_template("other.xml"), other)
+
+    def test_no_check_by_default(self):
+        loader = self._make_loader()
+        template = loader.get_template("part.xml")
+        self._write("part.xml", self.xmlsrc_part.format("b"), mtime=1)
+        self.assertIs(loader.get_template("part.xml"), template)
+
+    def test_dependency_invalidation(self):
+        loader = self._make_loader(check_interval=0)
+        main = loader.get_template("main.xml")
+        other = loader.get_template("other.xml")
+        self.assertEqual(main.process({}).getroot().find("part").text, "a")
+
+        self._write("part.xml", self.xmlsrc_part.format("b"), mtime=1)
+        self.assertIs(loader.get_template("other.xml"), other)
+        new_main = loader.get_template("main.xml")
+        self.assertIsNot(new_main, main)
+        self.assertEqual(new_main.process({}).getroot().find("part").text,
+                         "b")
+
+    def test_check_interval(self):
+        loader = self._make_loader(check_interval=3600)
+        template = loader.get_template("part.xml")
+        self._write("part.xml", self.xmlsrc_part.format("b"), mtime=1)
+        self.assertIs(loader.get_template("part.xml"), template)
+
+class TestPartials(SourceDirTest, unittest.TestCase):
+    xmlsrc_layout = """\
+<layout xmlns:exec="https://xmlns.zombofant.net/xsltea/exec">
+  <header><exec:text>arguments["title"]</exec:text></header>
+  <footer>footer</footer>
+  <row><exec:text>item</exec:text></row>
+  <ident><exec:text>id</exec:text></ident>
+</layout>"""
+
+    xmlsrc_page = """\
+<page xmlns:tea="https://xmlns.zombofant.net/xsltea/processors">
+  <tea:include src="layout.xml" xpath="/layout/header|/layout/footer" />
+</page>"""
+
+    xmlsrc_list = """\
+<list xmlns:tea="https://xmlns.zombofant.net/xsltea/processors">
+  <tea:for-each bind="item" from="arguments['items']">
+    <tea:include src="layout.xml" xpath="/layout/row" />
+  </tea:for-each>
+</list>"""
+
+    xmlsrc_idents = """\
+<list xmlns:tea="https://xmlns.zombofant.net/xsltea/processors">
+  <tea:for-each bind="id" from="arguments['items']">
+    <tea:include src="layout.xml" xpath="/layout/ident" />
+  </tea:for-each>
+</list>"""
+
+    def setUp(self):
+        super().setUp()
+        self._write("layout.xml", self.xmlsrc_layout)
+        self._write("page1.xml", self.xmlsrc_page)
+        self._write("page2.xml", self.xmlsrc_page)
+        self._write("list.xml", self.xmlsrc_list)
+        self._write("idents.xml", self.xmlsrc_idents)
+        self._loader = self._make_loader(
+            xsltea.exec.ExecProcessor,
+            xsltea.safe.IncludeProcessor,
+            xsltea.safe.ForeachProcessor(
+                safety_level=xsltea.safe.SafetyLevel.experimental))
+
+    def test_shared(self):
+        xpath = "/layout/header|/layout/footer"
+        with unittest.mock.patch.object(
+                xsltea.template.Partial, "parse_tree",
+                autospec=True,
+                side_effect=xsltea.template.Partial.parse_tree) as parse_tree:
+            page1 = self._loader.get_template("page1.xml")
+            page2 = self._loader.get_template("page2.xml")
+        self.assertEqual(parse_tree.call_count, 1)
+
+        partial = self._loader.get_partial("layout.xml", xpath)
+        self.assertIn(partial, page1.storage.values())
+        self.assertIn(partial, page2.storage.values())
+        self.assertIn("layout.xml", page1.dependencies)
+
+        for template in [page1, page2]:
+            root = template.process({"title": "foo"}).getroot()
+            self.assertEqual(
+                [(child.tag, child.text) for child in root],
+                [("header", "foo"), ("footer", "footer")])
+
+    def test_scope_dependent_selection_is_inlined(self):
+        self.assertIsNone(self._loader.get_partial("layout.xml", "/layout/row"))
+        root = self._loader.get_template("list.xml").process(
+            {"items": ["a", "b"]}).getroot()
+        self.assertEqual([child.text for child in root], ["a", "b"])
+
+    def test_builtin_shadowed_by_includer_is_inlined(self):
+        self.assertIsNone(
+            self._loader.get_partial("layout.xml", "/layout/ident"))
+        root = self._loader.get_template("idents.xml").process(
+            {"items": ["a", "b"]}).getroot()
+        self.assertEqual([child.text for child in root], ["a", "b"])
+
+    def test_invalidate(self):
+        self._loader.get_template("page1.xml")
+        partial = self._loader.get_partial("layout.xml", "/layout/footer")
+        self.assertEqual(self._loader.get_dependents("layout.xml"),
+                         {"page1.xml"})
+
+        self._loader.invalidate("layout.xml")
+        self.assertEqual(self._loader.get_dependents("layout.xml"), set())
+        self.assertIsNot(
+            self._loader.get_partial("layout.xml", "/layout/footer"),
+            partial)
+
+class TestPrecompile(SourceDirTest, unittest.TestCase):
+    xmlsrc_page = """\
+<page xmlns:exec="https://xmlns.zombofant.net/xsltea/exec">
+  <exec:text>arguments["title"]</exec:text>
+</page>"""
+
+    xmlsrc_broken = """\
+<page xmlns:exec="https://xmlns.zombofant.net/xsltea/exec">
+  <exec:text>arguments[</exec:text>
+</page>"""
+
+    def setUp(self):
+        super().setUp()
+        self._write("a.xml", self.xmlsrc_page)
+        self._write("sub/b.xml", self.xmlsrc_page)
+        self._write("broken.xml", self.xmlsrc_broken)
+        self._write("notes.txt", "not a template")
+
+    def _make_loader(self, **kwargs):
+        return super()._make_loader(xsltea.exec.ExecProcessor, **kwargs)
+
+    def _check_results(self, loader, results):
+        self.assertEqual([result.name for result in results],
+                         ["a.xml", "broken.xml", "sub/b.xml"])
+        errors = {result.name: result.error for result in results}
+        self.assertIsInstance(errors["broken.xml"], SyntaxError)
+        self.assertIsNone(errors["a.xml"])
+        self.assertIsNone(errors["sub/b.xml"])
+        for result in results:
+            self.assertGreaterEqual(result.duration, 0)
+
+        with unittest.mock.patch.object(
+                xsltea.template.Template, "parse_tree") as parse_tree:
+            tree = loader.get_template("sub/b.xml").process({"title": "foo"})
+        self.assertEqual(parse_tree.call_count, 0)
+        self.assertEqual(tree.getroot().text.strip(), "foo")
+
+    def test_iter_template_names(self):
+        loader = self._make_loader()
+        self.assertEqual(
+            sorted(loader.iter_template_names()),
+            ["a.xml", "broken.xml", "notes.txt", "sub/b.xml"])
+        self.assertEqual(
+            sorted(loader.iter_template_names("sub/*")),
+            ["sub/b.xml"])
+
+    def test_in_process(self):
+        loader = self._make_loader()
+        self._check_results(loader, loader.precompile(workers=4))
+
+    def test_names(self):
+        loader = self._make_loader()
+        results = loader.precompile(["sub/b.xml"])
+        self.assertEqual([result.name for result in results], ["sub/b.xml"])
+
+    def test_worker_processes(self):
+        cache = xsltea.bytecode.FileSystemBytecodeCache(
+            os.path.join(self._tmpdir.name, "cache"))
+        loader = self._make_loader(bytecode_cache=cache)
+        with unittest.mock.patch.object(
+                xsltea.template.Template, "parse_tree",
+                autospec=True,
+                side_effect=xsltea.template.Template.parse_tree) as parse_tree:
+            results = loader.precompile(workers=2)
+        # only the broken template is compiled again in this process
+        self.assertEqual(parse_tree.call_count, 1)
+        self._check_results(loader, results)
+
+class TestMinifyWhitespace(unittest.TestCase):
+    xmlsrc = """\
+<h:html xmlns:h="http://www.w3.org/1999/xhtml"
+        xmlns:exec="https://xmlns.zombofant.net/xsltea/exec">
+  <h:body>
+    <h:p>
+      Some   <h:b>bold</h:b>
+      text\u00a0 here
+    </h:p>
+    <h:pre>  keep
+    this  </h:pre>
+    <h:div xml:space="preserve">  and <h:i> this </h:i>  </h:div>
+    <h:p><exec:code>
+if arguments["flag"]:
+    value = "a  b"
+else:
+    value = "c"
+</exec:code><exec:text>value</exec:text>   after   code</h:p>
+  </h:body>
+</h:html>"""
+
+    def _make_loader(self, **kwargs):
+        loader = xsltea.template.XMLTemplateLoader(**kwargs)
+        loader.add_processor(xsltea.exec.ExecProcessor)
+        return loader
+
+    def _render(self, loader):
+        template = loader.load_template(self.xmlsrc, "<string>")
+        return etree.tostring(template.process({"flag": True}),
+                              encoding="unicode")
+
+    def test_minify_whitespace(self):
+        tree = etree.fromstring(
+            "<a>  x <!-- comment -->  y\n<b>\n\tz  </b>\n"
+            "<pre> p  <c>  q  </c>  </pre>  w  </a>").getroottree()
+        xsltea.template.minify_whitespace(tree)
+        self.assertEqual(
+            etree.tostring(tree, encoding="unicode"),
+            "<a> x y <b> z </b> <pre> p  <c>  q  </c>  </pre> w </a>")
+
+    def test_keep_text(self):
+        tree = etree.fromstring("<a>  x  <b>  y  </b>  z  </a>").getroottree()
+        xsltea.template.minify_whitespace(
+            tree,
+            keep_text=lambda elem: elem.tag == "b")
+        self.assertEqual(
+            etree.tostring(tree, encoding="unicode"),
+            "<a> x <b>  y  </b> z </a>")
+
+    def test_loader(self):
+        plain = self._render(self._make_loader())
+        minified = self._render(self._make_loader(minify_whitespace=True))
+        self.assertLess(len(minified), len(plain))
+        self.assertIn("<html:p> Some <html:b>bold</html:b> text\u00a0 here "
+                      "</html:p>",
+                      minified)
+        self.assertIn("<html:pre>  keep\n    this  </html:pre>", minified)
+        self.assertIn("  and <html:i> this </html:i>  ", minified)
+        # the code of the exec:code element is not touched
+        self.assertIn("a  b after code", minified)
+
+    def test_bytecode_key(self):
+        self.assertNotEqual(
+            self._make_loader()._get_bytecode_key("a.xml", ""),
+            self._make_loader(minify_whitespace=True)._get_bytecode_key(
+                "a.xml", ""))
+
+class TestStaticFolding(unittest.TestCase):
+    xmlsrc = """\
+<test xmlns:exec="https://xmlns.zombofant.net/xsltea/exec">
+  <nav><a href="/">home</a>tail<b>static</b></nav>
+  <main><p><exec:text>arguments["text"]</exec:text></p><hr /></main>
+</test>"""
+
+    def setUp(self):
+        self._loader = xsltea.template.XMLTemplateLoader()
+        self._loader.add_processor(xsltea.exec.ExecProcessor)
+        self._template = self._loader.load_template(self.xmlsrc, "<string>")
+
+    def test_counts(self):
+        # nav, a, b and hr are folded; test, main, p and exec:text are not
+        self.assertEqual(self._template.folded_elements, 4)
+        self.assertEqual(self._template.compiled_elements, 8)
+
+    def test_process(self):
+        tree = self._template.process({"text": "foo"})
+        self.assertEqual(
+            etree.tostring(tree),
+            b'<test><nav><a href="/">home</a>tail<b>static</b></nav>'
+            b'<main><p>foo</p><hr/></main></test>')
+
+        # folded subtrees must not be shared between evaluations
+        tree.find("nav/a").text = "changed"
+        tree = self._template.process({"text": "foo"})
+        self.assertEqual(tree.find("nav/a").text, "home")
+
+    def test_stream(self):
+        for i in range(2):
+            self.assertEqual(
+                b"".join(self._template.stream({"text": "foo"})),
+                b"<?xml version='1.0' encoding='utf-8'?>\n"
+                b'<test><nav><a href="/">home</a>tail<b>static</b></nav>'
+                b'<main><p>foo</p><hr/></main></test>')
+
+    def test_pickle(self):
+        fragment = xsltea.stream.StaticFragment(
+            etree.fromstring("<a><b>c</b></a>"))
+        fragment.prototype.tail = "tail"
+        fragment = pickle.loads(pickle.dumps(fragment))
+        self.assertEqual(etree.tostring(fragment.clone()),
+                         b"<a><b>c</b></a>tail")
+
+    def test_folding_report(self):
+        loader = xsltea.template.XMLTemplateLoader()
+        loader._cache["foo"] = self._template
+        self.assertSequenceEqual(
+            loader.get_folding_report(),
+            [("foo", 4, 8)])
@@ -9,10 +9,19 @@ Uniquely identifying elements
 
 .. autofunction:: get_element_by_id
 
+Sharing lxml objects between threads
+====================================
+
+Parsers, XSLT and XPath objects of lxml must not be used by several threads at
+the same time.
+
+.. autoclass:: PerThread
+
 """
 
 import binascii
 import random
+import threading
 
 from teapot.utils import sortedlist
 
@@ -20,6 +29,7 @@ from .namespaces import xml
 
 __all__ = [
     "get_element_by_id",
+    "PerThread",
     ]
 
 def get_element_by_id(tree, element_id):
@@ -30,3 +40,26 @@ def get_element_by_id(tree, element_id):
     global xml
     return tree.xpath("//*[@xml:id = '"+element_id+"']",
                       namespaces={"xml": str(xml)}).pop()
+
+class PerThread:
+    """
+    Provide a separate object to each thread, which is created by calling
+    *factory* without arguments when a thread first calls :meth:`get`. Calls
+    to *factory* are serialised, so that it may use objects which are not
+    thread-safe themselves.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def get(self):
+        try:
+            return self._local.value
+        except AttributeError:
+            pass
+        with self._lock:
+            value = self._factory()
+        self._local.value = value
+        return value